@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import configparser
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ("home", "list", "info", "browse", "search", "range", "thumbs", "import")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark VisiVerse against a synthetic library.")
+    parser.add_argument("--rows", type=int, default=1000, help="Media rows in the synthetic library.")
+    parser.add_argument("--videos", type=int, default=8, help="Real files generated with ffmpeg lavfi.")
+    parser.add_argument("--video-duration", type=int, default=10, help="Seconds per generated video.")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once.")
+    parser.add_argument("--import-runs", type=int, default=3, help="Timed runs of the import scenario.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated scenarios to run.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic library and requests.")
+    parser.add_argument("--workdir", help="Reuse this directory instead of a temporary one.")
+    parser.add_argument("--output", default="-", help="JSON results file, - for stdout.")
+    parser.add_argument("--compare", help="Earlier JSON results to compare against.")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario '{name}'")
+
+    original_dir = os.getcwd()
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="visiverse-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    write_config(workdir)
+    # create_app reads config.cfg and secret.key from the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    # failed requests are counted, not logged
+    logging.disable(logging.ERROR)
+
+    try:
+        results = asyncio.run(run_benchmarks(args, workdir, scenarios))
+    finally:
+        os.chdir(original_dir)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    output = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    print_summary(results, sys.stderr)
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            print_comparison(json.load(baseline_file), results, sys.stderr)
+
+def write_config(workdir):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "library": {
+            "db_url": f"sqlite+aiosqlite:///{workdir}/library.db",
+            "media_path": f"{workdir}/media",
+        },
+        "storage": {
+            "path": f"{workdir}/storage",
+        },
+    })
+    with open(os.path.join(workdir, "config.cfg"), "w") as config_file:
+        config.write(config_file)
+
+
+# ********** Benchmark Runner **********
+
+async def run_benchmarks(args, workdir, scenarios):
+    started = time.perf_counter()
+    import visiverse
+    from benchmarks import synthetic
+    import_seconds = time.perf_counter() - started
+
+    app = visiverse.create_app()
+    has_ffmpeg = shutil.which("ffmpeg") is not None
+    media_dir = app.app_config["library"]["media_path"]
+    video_dir = os.path.join(media_dir, "videos")
+    results = {
+        "meta": get_meta(args, has_ffmpeg),
+        "setup": {},
+        "scenarios": {},
+    }
+
+    started = time.perf_counter()
+    if has_ffmpeg:
+        real_filenames = synthetic.generate_videos(video_dir, args.videos, args.video_duration)
+    else:
+        real_filenames = synthetic.generate_blobs(video_dir, args.videos, 8 * 1024 ** 2)
+    results["setup"]["media_seconds"] = time.perf_counter() - started
+
+    db_filename = os.path.join(workdir, "library.db")
+    if os.path.isfile(db_filename):
+        os.remove(db_filename)
+    started = time.perf_counter()
+    media_ids = synthetic.generate_library(
+        f"sqlite:///{db_filename}", args.rows, media_dir, real_filenames, has_ffmpeg, args.seed
+    )
+    results["setup"]["library_seconds"] = time.perf_counter() - started
+
+    results["setup"]["import_seconds"] = import_seconds
+    started = time.perf_counter()
+    async with app.test_app() as test_app:
+        results["setup"]["startup_seconds"] = time.perf_counter() - started
+        for step, seconds in app.startup_timings.items():
+            results["setup"][f"startup_{step}_seconds"] = seconds
+        client = test_app.test_client()
+        context = BenchmarkContext(
+            args, client, media_ids, media_ids[:len(real_filenames)], random.Random(args.seed)
+        )
+        for name in scenarios:
+            if name in ("thumbs", "import") and not has_ffmpeg:
+                results["scenarios"][name] = {"skipped": "ffmpeg not found"}
+                continue
+            if name == "import":
+                results["scenarios"][name] = await bench_import(context, app.app_config, video_dir, workdir)
+                continue
+            for label, requests in await SCENARIO_REQUESTS[name](context):
+                results["scenarios"][label] = await measure(client, requests, args.concurrency)
+    return results
+
+async def measure(client, requests, concurrency):
+    # requests are (path, headers) pairs, shared by the workers
+    pending = iter(requests)
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for path, headers in pending:
+            started = time.perf_counter()
+            response = await client.get(path, headers=headers)
+            await response.get_data()
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stats = summarize(latencies)
+    stats["errors"] = errors
+    stats["throughput_rps"] = len(latencies) / elapsed if elapsed else 0.0
+    return stats
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p90_ms": percentile(samples, 90) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+def percentile(samples, q):
+    # nearest rank of sorted samples
+    rank = max(1, round(q / 100 * len(samples) + 0.5))
+    return samples[min(len(samples), rank) - 1]
+
+def get_meta(args, has_ffmpeg):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlite": sqlite3.sqlite_version,
+        "ffmpeg": has_ffmpeg,
+        "args": vars(args),
+    }
+
+
+class BenchmarkContext():
+
+    def __init__(self, args, client, media_ids, real_media_ids, rng):
+        self.args = args
+        self.client = client
+        self.media_ids = media_ids
+        self.real_media_ids = real_media_ids
+        self.rng = rng
+        self.cursors = None
+
+    async def get_cursors(self, pages=20):
+        # cursors of the first pages, walked once
+        if self.cursors is None:
+            self.cursors = [""]
+            while len(self.cursors) < pages:
+                response = await self.client.get(f"/api/media/list?cursor={self.cursors[-1]}")
+                next_cursor = (await response.get_json())["data"]["next_cursor"]
+                if not next_cursor:
+                    break
+                self.cursors.append(next_cursor)
+        return self.cursors
+
+    def repeat(self, paths, headers=None):
+        return [(self.rng.choice(paths), headers) for _ in range(self.args.requests)]
+
+
+# ********** Scenarios **********
+
+async def requests_home(context):
+    cursors = await context.get_cursors()
+    return [("home", context.repeat([f"/?cursor={cursor}" for cursor in cursors]))]
+
+async def requests_list(context):
+    cursors = await context.get_cursors()
+    return [("list", context.repeat([f"/api/media/list?cursor={cursor}" for cursor in cursors]))]
+
+async def requests_info(context):
+    # one grid page of ids per batch request, against one request per id
+    batch_size = min(48, len(context.media_ids))
+    batches = [
+        "/api/media/batch?ids=" + ",".join(map(str, context.rng.sample(context.media_ids, batch_size)))
+        for _ in range(context.args.requests)
+    ]
+    return [
+        ("info", context.repeat([f"/api/media/info/{media_id}" for media_id in context.media_ids])),
+        ("info_batch", [(path, None) for path in batches]),
+    ]
+
+async def requests_browse(context):
+    response = await context.client.get("/api/media/browse?limit=1")
+    tags = [count["value"] for count in (await response.get_json())["data"]["facets"]["tag"][:10]]
+    return [
+        ("browse", context.repeat(["/api/media/browse"])),
+        ("browse_filtered", context.repeat([f"/api/media/browse?tag={tag}" for tag in tags])),
+    ]
+
+async def requests_search(context):
+    from benchmarks.synthetic import WORDS
+    return [
+        ("search", context.repeat([f"/api/search?q={word}" for word in WORDS])),
+        ("search_prefix", context.repeat([f"/api/search?q={word[:4]}" for word in WORDS])),
+    ]
+
+async def requests_range(context):
+    paths = [f"/files/media/{media_id}" for media_id in context.real_media_ids]
+    ranged = []
+    for _ in range(context.args.requests):
+        start = context.rng.randrange(0, 512 * 1024)
+        length = context.rng.randrange(64 * 1024, 1024 ** 2)
+        ranged.append((context.rng.choice(paths), {"Range": f"bytes={start}-{start + length - 1}"}))
+    return [
+        ("range", ranged),
+        ("range_full", context.repeat(paths)[:max(1, context.args.requests // 10)]),
+    ]
+
+async def requests_thumbs(context):
+    paths = [f"/files/thumbs/{media_id}?fmt=jpeg" for media_id in context.real_media_ids]
+    # first request per file renders the thumbnail, the rest are served from storage
+    return [
+        ("thumbs_cold", [(path, None) for path in paths]),
+        ("thumbs_warm", context.repeat(paths)),
+    ]
+
+SCENARIO_REQUESTS = {
+    "home": requests_home,
+    "list": requests_list,
+    "info": requests_info,
+    "browse": requests_browse,
+    "search": requests_search,
+    "range": requests_range,
+    "thumbs": requests_thumbs,
+}
+
+async def bench_import(context, app_config, video_dir, workdir):
+    # imports the generated videos into a scratch database, leaving the app's alone
+    from visiverse.database import Database
+    from visiverse.jobs import JobScheduler
+    from visiverse.library import Importer
+    from visiverse.library import MediaLookup
+    from visiverse.transcoder import Transcoder
+
+    import_config = configparser.ConfigParser()
+    import_config.read_dict(app_config)
+    import_config["library"]["media_path"] = video_dir
+    import_config["storage"]["path"] = os.path.join(workdir, "import-storage")
+    db_filename = os.path.join(workdir, "import.db")
+    import_config["library"]["db_url"] = f"sqlite+aiosqlite:///{db_filename}"
+
+    samples = []
+    file_count = 0
+    for _ in range(context.args.import_runs):
+        if os.path.isfile(db_filename):
+            os.remove(db_filename)
+        db = Database(import_config)
+        await db.begin()
+        transcoder = Transcoder(import_config)
+        # never started, the import only queues jobs
+        jobs = JobScheduler(db, transcoder, MediaLookup(db, import_config), import_config)
+        importer = Importer(db, transcoder, jobs, import_config)
+        try:
+            started = time.perf_counter()
+            plan = await importer.import_library()
+            samples.append(time.perf_counter() - started)
+            file_count = len(plan.new)
+        finally:
+            await db.close()
+    stats = summarize(samples)
+    stats["files"] = file_count
+    stats["files_per_second"] = file_count / stats["p50_ms"] * 1000 if file_count else 0.0
+    return stats
+
+
+# ********** Reporting **********
+
+def print_summary(results, out):
+    for name, value in results["setup"].items():
+        print(f"{name:>24} {value:10.2f}", file=out)
+    print(f"{'scenario':>24} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'req/s':>10}", file=out)
+    for name, stats in results["scenarios"].items():
+        if "skipped" in stats:
+            print(f"{name:>24} skipped: {stats['skipped']}", file=out)
+            continue
+        if not stats["count"]:
+            # no successful samples, e.g. --videos 0 or every request failed
+            print(f"{name:>24} no samples, {stats.get('errors', 0)} errors", file=out)
+            continue
+        print(
+            f"{name:>24} {stats['p50_ms']:10.2f} {stats['p90_ms']:10.2f} {stats['p99_ms']:10.2f} "
+            f"{stats.get('throughput_rps', 0.0):10.1f}",
+            file=out,
+        )
+
+def print_comparison(baseline, results, out):
+    # positive is slower for latency, faster for throughput
+    print(f"{'change vs baseline':>24} {'p50':>10} {'p99':>10} {'req/s':>10}", file=out)
+    for name, stats in results["scenarios"].items():
+        old_stats = baseline.get("scenarios", {}).get(name)
+        if not old_stats or "skipped" in stats or "skipped" in old_stats:
+            continue
+        changes = [
+            format_change(old_stats.get(key), stats.get(key))
+            for key in ("p50_ms", "p99_ms", "throughput_rps")
+        ]
+        print(f"{name:>24} {changes[0]:>10} {changes[1]:>10} {changes[2]:>10}", file=out)
+
+def format_change(old_value, new_value):
+    if not old_value or new_value is None:
+        return "-"
+    return f"{(new_value - old_value) / old_value * 100:+.1f}%"
+
+
+if __name__ == "__main__":
+    main()
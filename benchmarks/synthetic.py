@@ -0,0 +1,153 @@
+import os
+import random
+from datetime import datetime
+from datetime import timedelta
+from uuid import UUID
+
+import ffmpeg
+from sqlalchemy import create_engine
+from sqlalchemy import insert
+
+from visiverse.database import Base
+from visiverse.database import Media
+from visiverse.database import MediaProbe
+from visiverse.database import MediaType
+from visiverse.database import Organization
+from visiverse.database import Person
+from visiverse.database import Tag
+from visiverse.database import assoc_media_organization_table
+from visiverse.database import assoc_media_person_table
+from visiverse.database import assoc_media_tag_table
+from visiverse.transcoder import probe_media
+
+
+INSERT_BATCH_SIZE = 10000
+
+WORDS = (
+    "amber", "harbor", "quiet", "signal", "orbit", "meadow", "copper", "lantern",
+    "river", "summit", "velvet", "echo", "falcon", "garden", "island", "journey",
+    "kettle", "lunar", "marble", "nectar", "oasis", "prism", "quartz", "rocket",
+    "saffron", "timber", "ultra", "violet", "willow", "xenon", "yonder", "zephyr",
+)
+
+# type weights of a typical library
+MEDIA_TYPES = ((MediaType.video, 6), (MediaType.image, 3), (MediaType.audio, 1))
+
+
+# ********** Synthetic Media **********
+
+def generate_videos(media_dir, count, duration=10, size="1280x720"):
+    # test pattern and tone from lavfi, no real media needed
+    os.makedirs(media_dir, exist_ok=True)
+    filenames = []
+    for index in range(count):
+        filename = os.path.join(media_dir, f"synthetic-{index:04}.mp4")
+        if not os.path.isfile(filename):
+            video = ffmpeg.input(f"testsrc2=size={size}:rate=30", f="lavfi", t=duration)
+            audio = ffmpeg.input(f"sine=frequency={220 + index * 10}", f="lavfi", t=duration)
+            (
+                ffmpeg
+                .output(video, audio, filename, vcodec="libx264", acodec="aac", pix_fmt="yuv420p",
+                        preset="veryfast", movflags="+faststart")
+                .overwrite_output()
+                .run(quiet=True)
+            )
+        filenames.append(filename)
+    return filenames
+
+def generate_blobs(media_dir, count, size):
+    # stand-ins for range serving when ffmpeg is unavailable
+    os.makedirs(media_dir, exist_ok=True)
+    rng = random.Random(count)
+    filenames = []
+    for index in range(count):
+        filename = os.path.join(media_dir, f"synthetic-{index:04}.mp4")
+        if not os.path.isfile(filename):
+            with open(filename, "wb") as blob_file:
+                blob_file.write(rng.randbytes(size))
+        filenames.append(filename)
+    return filenames
+
+
+# ********** Synthetic Library **********
+
+def generate_library(db_url, count, media_dir, real_filenames=(), probe=False, seed=0):
+    # media rows with tags, people and organizations, the first ones backed by real files
+    rng = random.Random(seed)
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+
+    tag_names = [f"{rng.choice(WORDS)}-{index}" for index in range(max(50, count // 100))]
+    person_ids = [random_uuid(rng) for _ in range(max(20, count // 50))]
+    organization_ids = [random_uuid(rng) for _ in range(max(10, count // 200))]
+    # a few popular values and a long tail, like real tags
+    tag_weights = [1 / (rank + 1) for rank in range(len(tag_names))]
+    person_weights = [1 / (rank + 1) for rank in range(len(person_ids))]
+    media_types, type_weights = zip(*MEDIA_TYPES)
+
+    with engine.begin() as conn:
+        conn.execute(insert(Tag), [{"name": name} for name in tag_names])
+        conn.execute(insert(Person), [
+            {"id": person_id, "name": make_title(rng, 2)} for person_id in person_ids
+        ])
+        conn.execute(insert(Organization), [
+            {"id": organization_id, "name": make_title(rng, 2)} for organization_id in organization_ids
+        ])
+
+    created = datetime(2020, 1, 1)
+    media_ids = []
+    for start in range(0, count, INSERT_BATCH_SIZE):
+        media_rows, tag_rows, person_rows, organization_rows = [], [], [], []
+        for index in range(start, min(count, start + INSERT_BATCH_SIZE)):
+            media_id = random_uuid(rng)
+            media_ids.append(media_id)
+            if index < len(real_filenames):
+                filename, media_type = real_filenames[index], MediaType.video
+            else:
+                media_type = rng.choices(media_types, type_weights)[0]
+                filename = os.path.join(media_dir, "missing", f"{index:07}.{media_type.name}")
+            created += timedelta(seconds=rng.randint(1, 600))
+            media_rows.append({
+                "id": media_id,
+                "filename": filename,
+                "title": make_title(rng, rng.randint(2, 6)),
+                "description": make_title(rng, rng.randint(5, 30)) if rng.random() < 0.5 else None,
+                "duration": rng.randint(5, 3600) if MediaType.video == media_type else None,
+                "type": media_type,
+                "created": created,
+            })
+            tag_rows += [
+                {"media_id": media_id, "tag_name": tag_name}
+                for tag_name in set(rng.choices(tag_names, tag_weights, k=rng.randint(0, 5)))
+            ]
+            person_rows += [
+                {"media_id": media_id, "person_id": person_id}
+                for person_id in set(rng.choices(person_ids, person_weights, k=rng.randint(0, 2)))
+            ]
+            if rng.random() < 0.3:
+                organization_rows.append(
+                    {"media_id": media_id, "organization_id": rng.choice(organization_ids)}
+                )
+        with engine.begin() as conn:
+            conn.execute(insert(Media), media_rows)
+            if tag_rows:
+                conn.execute(insert(assoc_media_tag_table), tag_rows)
+            if person_rows:
+                conn.execute(insert(assoc_media_person_table), person_rows)
+            if organization_rows:
+                conn.execute(insert(assoc_media_organization_table), organization_rows)
+
+    if probe and real_filenames:
+        with engine.begin() as conn:
+            conn.execute(insert(MediaProbe), [
+                {"media_id": media_id, **probe_media(filename)}
+                for media_id, filename in zip(media_ids, real_filenames)
+            ])
+    engine.dispose()
+    return media_ids
+
+def random_uuid(rng):
+    return UUID(int=rng.getrandbits(128), version=4)
+
+def make_title(rng, word_count):
+    return " ".join(rng.choice(WORDS) for _ in range(word_count)).capitalize()
@@ -1,4 +1,11 @@
-from visiverse import app
+from hypercorn.run import run
+
+from visiverse.config import load_config
+from visiverse.config import load_secret_key
+from visiverse.server import get_server_config
 
 if __name__ == "__main__":
-    app.run()
+    # written once here, the worker processes only read them
+    app_config = load_config("config.cfg")
+    load_secret_key(app_config["server"]["secret_key_path"])
+    run(get_server_config(app_config))
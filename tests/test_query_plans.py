@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from visiverse.config import load_config
+from visiverse.database import Database
+from visiverse.migrations import HOT_QUERIES
+from visiverse.migrations import Migrator
+
+
+async def collect_reports(app_config):
+    db = Database(app_config)
+    try:
+        await db.begin()
+        migrator = Migrator(db)
+        await migrator.begin()
+        return await migrator.check_query_plans()
+    finally:
+        await db.close()
+
+@pytest.fixture(scope="module")
+def reports(tmp_path_factory):
+    # a file database, as a deployed library uses
+    path = tmp_path_factory.mktemp("plans")
+    app_config = load_config(str(path / "config.cfg"), autosave=False)
+    app_config["library"]["db_url"] = f"sqlite+aiosqlite:///{path / 'visiverse.db'}"
+    app_config["storage"]["path"] = str(path / "storage")
+    return asyncio.run(collect_reports(app_config))
+
+@pytest.mark.parametrize("name", [name for name, _, _ in HOT_QUERIES])
+def test_hot_query_uses_indexes(reports, name):
+    query_reports = [report for report in reports if report[0] == name]
+    assert query_reports, f"{name} ran no statement"
+    for _, statement, plan, problems in query_reports:
+        assert not problems, f"{' '.join(statement.split())}\n{plan}"
@@ -1,68 +1,67 @@
-import base64
+import asyncio
+import contextlib
 import os
+import time
+from functools import partial
 from logging.config import dictConfig
-from traceback import format_exception
-from uuid import UUID, uuid4
 
+# Click command line
+import click
 # Quart
 from quart import Quart
-from quart import jsonify
-from quart import redirect
-from quart import render_template
+from quart import current_app
+from quart import g
 from quart import request
-from quart import send_file
-from quart.helpers import safe_join
 from quart.utils import run_sync
 # Quart-Auth extenstion
 from quart_auth import QuartAuth
-from quart_auth import AuthUser as QuartAuthUser
-from quart_auth import current_user
-from quart_auth import login_user
-from quart_auth import login_required
-from quart_auth import logout_user
-from quart_auth import Unauthorized
-# Werkzeug library
-from werkzeug.exceptions import HTTPException
 
 # Custom authenticator class
 from visiverse.authenticator import Authenticator
-from visiverse.authenticator import AuthError
+# Response cache
+from visiverse.cache import LRUCache
 # Custom config class
 from visiverse.config import load_config
+from visiverse.config import load_secret_key
 # Custom database and types
 from visiverse.database import Database
-from visiverse.database import MediaType
 from visiverse.database import Media
-from visiverse.database import Person
-from visiverse.database import Organization
-from visiverse.database import Tag
+from visiverse.database import is_memory_url
+# Near-duplicate detection
+from visiverse.duplicates import DuplicateFinder
+# Faceted browsing
+from visiverse.facets import FacetIndex
+# Background jobs
+from visiverse.jobs import JobScheduler
+# Library importer
+from visiverse.library import Importer
+from visiverse.library import MediaLookup
+# Library watcher
+from visiverse.watcher import LibraryWatcher
+# Instrumentation
+from visiverse.metrics import Metrics
+# Schema migrations
+from visiverse.migrations import Migrator
+# JSON serialization
+from visiverse.serializers import JSONProvider
+# Full-text search
+from visiverse.search import SearchIndex
+# Collections and playback prefetch
+from visiverse.playlists import CollectionStore
+from visiverse.playlists import Prefetcher
+# Multi-process serving
+from visiverse.server import ProcessLock
+# Media file streaming
+from visiverse.streaming import MediaStreamer
 # Custom FFmpeg wrapper
 from visiverse.transcoder import Transcoder
-from visiverse.transcoder import get_video_duration
+# Routes
+from visiverse.views import AuthUser
+from visiverse.views import bp
 
 
-app = Quart(__name__)
-app.config["TEMPLATES_AUTO_RELOAD"] = True
-
 # https://github.com/m1k1o/go-transcode
 
-auth_manager = QuartAuth()
-
-config_path = "config.cfg"
-config = load_config(config_path)
-
-secret_key_path = "secret.key"
-if os.path.isfile(secret_key_path):
-    # Read existing secret key
-    with open(secret_key_path, "r") as key_file:
-        key = key_file.read().strip()
-else:
-    # Generate new secret key
-    with open(secret_key_path, "w") as key_file:
-        key = uuid4().hex
-        key_file.write(key)
-app.secret_key = key
-
 # logging config
 # dictConfig({
 #     'version': 1,
@@ -77,255 +76,293 @@ app.secret_key = key
 # })
 
 
-# ********** Frontend Page Routes **********
-
-@app.route("/")
-async def page_home():
-    async with app.db.async_session() as session:
-        all_media = await app.db.select_all_objects(session, Media)
-        return await render_template("pages/home.html", all_media=all_media)
-
-@app.route("/view/<string:media_id>")
-async def page_view(media_id: str):
+# ********** App Factory **********
+
+def create_app(app_config=None):
+    # nothing touches the database or storage until serving starts
+    if app_config is None:
+        # written back with new defaults by run.py only, workers read it concurrently
+        app_config = load_config("config.cfg", autosave=False)
+    workers = app_config.getint("server", "workers")
+    if workers > 1 and is_memory_url(app_config["library"]["db_url"]):
+        raise ValueError("Every worker would get its own in-memory database, use a database file")
+
+    app = Quart(__name__)
+    app.json = JSONProvider(app)
+    app.app_config = app_config
+    app.secret_key = load_secret_key(app_config["server"]["secret_key_path"])
+    # production compiles templates once at startup and caches responses
+    app.development_mode = app_config["server"]["mode"] == "development"
+    app.config["TEMPLATES_AUTO_RELOAD"] = app.development_mode
+
+    auth_manager = QuartAuth()
+    auth_manager.user_class = AuthUser
+    auth_manager.init_app(app)
+    app.register_blueprint(bp)
+
+    # app_prepare first, the watcher is left out of command line runs that share it
+    app.before_serving(partial(app_prepare, app))
+    app.before_serving(partial(start_watcher, app))
+    app.before_serving(partial(start_primary_check, app))
+    app.after_serving(partial(app_cleanup, app))
+    # registered before serve_offloaded so it runs last and sees the final status
+    app.before_request(metrics_start_request)
+    app.after_request(metrics_finish_request)
+    app.teardown_request(metrics_end_request)
+    app.after_request(serve_offloaded)
+    register_commands(app)
+    return app
+
+
+# ********** Lifecycle **********
+
+async def app_prepare(app):
+    app_config = app.app_config
+    app.startup_timings = {}
+    started = time.perf_counter()
+    storage_path = app_config["storage"]["path"]
+    # the first process up recovers interrupted jobs and watches the library, the others only serve
+    app.primary_lock = ProcessLock(os.path.join(storage_path, "primary.lock"))
+    app.is_primary = app.primary_lock.acquire(blocking=False)
+    app.primary_task = None
+    with startup_step(app, "components"):
+        app.metrics = Metrics(app_config)
+        app.db = Database(app_config)
+        for engine in app.db.engines:
+            app.metrics.instrument_engine(engine)
+        app.transcoder = Transcoder(app_config, app.metrics)
+        app.streamer = MediaStreamer(app_config)
+        app.response_cache = None
+        if not app.development_mode:
+            app.response_cache = LRUCache(
+                app_config.getint("cache", "response_size"), app_config.getfloat("cache", "response_ttl")
+            )
+    if not app.development_mode:
+        with startup_step(app, "templates"):
+            precompile_templates(app)
+    # schema changes and index rebuilds run in one process at a time
+    startup_lock = ProcessLock(os.path.join(storage_path, "startup.lock"))
+    with startup_step(app, "lock_wait"):
+        await run_sync(startup_lock.acquire)()
     try:
-        async with app.db.async_session() as session:
-            media_uuid = b64_to_uuid(media_id)
-            result = await app.db.select_object(session, Media, media_uuid)
-            if result is None:
-                return await page_error("Not found", 404)
-            # TODO render page
-            return await render_template("pages/view.html", media=result)
-    except ValueError as e:
-        return await page_exception(e)
-
-@app.route("/login")
-async def page_login():
-    return await render_template("pages/login.html")
-
-
-# ********** Frontend Error Templates **********
-
-async def page_error(message, code=400):
-    # TODO render error page
-    return api_error(message, code)
-
-async def page_exception(e, code=400):
-    return await page_error(f"{type(e).__name__}: {e}", code)
-
-
-# ********** Backend API Routes **********
-
-@app.route("/api/media/info/<string:media_id>")
-async def api_media_info(media_id: str):
-    try:
-        media_uuid = UUID(media_id)
-        async with app.db.async_session() as session:
-            result = await app.db.select_object(session, Media, media_uuid)
-            if result is None:
-                return api_error("Not found", 404)
-            return api_success(result)
-    except ValueError as e:
-        return api_exception(e)
-
-@app.route("/api/person/info/<string:person_id>")
-async def api_person_info(person_id: str):
-    try:
-        person_uuid = UUID(person_id)
-        async with app.db.async_session() as session:
-            result = await app.db.select_object(session, Person, person_uuid)
-            if result is None:
-                return api_error("Not found", 404)
-            return api_success(result)
-    except ValueError as e:
-        return api_exception(e)
-
-@app.route("/api/organization/info/<string:org_id>")
-async def api_organization_info(org_id: str):
-    try:
-        org_uuid = UUID(org_id)
-        async with app.db.async_session() as session:
-            result = await app.db.select_object(session, Organization, org_uuid)
-            if result is None:
-                return api_error("Not found", 404)
-            return api_success(result)
-    except ValueError as e:
-        return api_exception(e)
-
-
-# ********** Backend Files Routes **********
-
-@app.route("/assets/<path:filename>")
-async def template_assets(filename: str):
-    return await render_template(safe_join("assets", filename))
-
-@app.route("/files/media/<string:media_id>")
-async def files_media(media_id: str):
-    try:
-        media_uuid = UUID(media_id)
-        async with app.db.async_session() as session:
-            result = await app.db.select_object(session, Media, media_uuid)
-            if result is None:
-                return api_error("Not found", 404)
-            return await send_file(result.filename, conditional=True)
-    except ValueError as e:
-        return api_exception(e)
-
-@app.route("/files/thumbs/<string:media_id>")
-async def files_thumbs(media_id: str):
-    try:
-        media_uuid = UUID(media_id)
-        async with app.db.async_session() as session:
-            result = await app.db.select_object(session, Media, media_uuid)
-            if result is None:
-                return api_error("Not found", 404)
-            return await send_file(app.transcoder.get_thumb_filename(result.id))
-    except ValueError as e:
-        return api_exception(e)
-
-
-# ********** Authentication & Routes **********
-
-class AuthUser(QuartAuthUser):
-
-    def __init__(self, auth_id):
-        super().__init__(auth_id)
-        self._resolved = False
-        self._db_user = None
-
-    async def _resolve(self):
-        if not self._resolved:
-            async with app.db.async_session() as session:
-                self._db_user = await app.db.get_user(session, self.auth_id)
-
-    @property
-    async def db_user(self):
-        await self._resolve()
-        return self._db_user
-
-auth_manager.user_class = AuthUser
-
-
-@app.route("/auth/login", methods=["POST"])
-async def auth_login():
-    try:
-        login_data = await request.get_json()
-        user = await app.auth.authenticate(
-            login_data["username"],
-            login_data["password"],
-        )
-    except KeyError:
-        return api_error("Missing credentials")
-    except AuthError as e:
-        return api_error(e.message)
-    login_user(AuthUser(user.username))
-    return api_success()
-
-@app.route("/auth/logout")
-async def auth_logout():
-    logout_user()
-    return api_success()
-
-
-# ********** Backend Response Templates **********
-
-def api_success(data={}):
-    return jsonify({
-        "result": "success",
-        "data": data
-    }), 200
-
-def api_error(message, code=400):
-    return jsonify({
-        "result": "error",
-        "message": message
-    }), code
-
-def api_exception(e, code=400):
-    return api_error(f"{type(e).__name__}: {e}", code)
-
-
-# ********** Library Operations **********
-
-async def import_media(session, media_filename, **media_args):
-    # create media object
-    new_media = Media(
-        id=uuid4(),
-        filename=media_filename,
-        **media_args
+        with startup_step(app, "schema"):
+            await app.db.begin()
+            app.migrator = Migrator(app.db)
+            await app.migrator.begin()
+        with startup_step(app, "search"):
+            app.search = SearchIndex(app.db)
+            await app.search.begin()
+        with startup_step(app, "facets"):
+            app.facets = FacetIndex(app.db, app_config)
+            await app.facets.begin()
+    finally:
+        startup_lock.release()
+    app.auth = Authenticator(app.db, app_config)
+    app.media_lookup = MediaLookup(app.db, app_config)
+    app.jobs = JobScheduler(app.db, app.transcoder, app.media_lookup, app_config)
+    with startup_step(app, "jobs"):
+        await app.jobs.start(recover=app.is_primary)
+    app.importer = Importer(app.db, app.transcoder, app.jobs, app_config)
+    app.duplicates = DuplicateFinder(app.db, app_config)
+    app.collections = CollectionStore(app.db)
+    app.prefetcher = Prefetcher(app.transcoder, app.jobs, app.media_lookup, app_config)
+    app.watcher = None
+    register_metrics(app)
+    steps = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in app.startup_timings.items())
+    app.startup_timings["total"] = time.perf_counter() - started
+    app.logger.info(
+        f"Started {'primary' if app.is_primary else 'secondary'} process"
+        f" in {app.startup_timings['total']:.3f}s ({steps})"
     )
-    tag = await app.db.get_or_create_tag(session, "test1")
-    new_media.tags = set([tag])
-    # set duration for videos
-    if MediaType.video == new_media.type:
-        new_media.duration = await run_sync(get_video_duration)(new_media.filename)
-    # insert media into db
-    await app.db.insert_object(session, new_media)
-    # generate thumbnails for videos
-    if MediaType.video == new_media.type:
-        await run_sync(app.transcoder.create_thumbnail)(new_media)
-
-
-# ********** Miscellaneous Helpers **********
-
-@app.before_serving
-async def app_prepare():
-    app.db = Database(config)
-    app.transcoder = Transcoder(config)
-    await app.db.begin()
-    app.auth = Authenticator(app.db)
     # admin: PASSWORD
     # await app.auth.register_user("admin", "0be64ae89ddd24e225434de95d501711339baeee18f009ba9b4369af27d30d60")
 
-    # import os
-    # import_dir = "media"
-    # async with app.db.async_session() as session:
-    #     async with session.begin():
-    #         for filename in os.listdir(import_dir):
-    #             await import_media(session, f"{import_dir}/{filename}", title=filename, type=MediaType.video)
-
-    #     results = await app.db.select_all_objects(session, Media)
-    #     for result in results:
-    #         print(result)
-
-@app.after_serving
-async def app_cleanup():
+async def start_watcher(app):
+    if app.is_primary and app.app_config.getboolean("watcher", "enabled"):
+        app.watcher = LibraryWatcher(app.importer, app.app_config)
+        await app.watcher.start()
+
+async def start_primary_check(app):
+    app.primary_task = asyncio.create_task(check_primary(app))
+
+async def check_primary(app):
+    # a secondary takes over once the primary exits, the primary recovers jobs of exited processes
+    interval = app.app_config.getfloat("server", "primary_interval")
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not app.is_primary and app.primary_lock.acquire(blocking=False):
+                app.is_primary = True
+                app.logger.info("Took over as primary process")
+                await start_watcher(app)
+            if app.is_primary:
+                await app.jobs.recover()
+        except Exception as e:
+            app.logger.warning(f"Primary process check failed: {type(e).__name__}: {e}")
+
+async def app_cleanup(app):
+    if app.primary_task is not None:
+        app.primary_task.cancel()
+        await asyncio.gather(app.primary_task, return_exceptions=True)
+    if app.watcher is not None:
+        await app.watcher.close()
+    await app.jobs.close()
+    app.auth.close()
     await app.db.close()
+    app.primary_lock.release()
 
-@app.context_processor
-def utility_processor():
-    # Template utility functions
-    return dict(
-        uuid_to_b64=uuid_to_b64,
-        format_duration=format_duration,
+@contextlib.contextmanager
+def startup_step(app, name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        app.startup_timings[name] = time.perf_counter() - started
+
+def register_metrics(app):
+    app.metrics.add_cache("media_lookup", app.media_lookup.cache)
+    app.metrics.add_cache("facets", app.facets.cache)
+    if app.response_cache is not None:
+        app.metrics.add_cache("responses", app.response_cache)
+    if app.auth.user_cache is not None:
+        app.metrics.add_cache("auth_users", app.auth.user_cache)
+    app.metrics.add_collector(
+        "visiverse_auth_queue_depth", "Password hashes waiting for a worker", "gauge",
+        lambda: [({}, app.auth.queue_depth)],
+    )
+    app.metrics.add_collector(
+        "visiverse_segment_cache_bytes", "On-demand HLS segments on disk", "gauge",
+        lambda: [({}, app.transcoder.segment_cache.total_bytes)],
+    )
+    app.metrics.add_collector(
+        "visiverse_jobs_running", "Background jobs being executed", "gauge",
+        lambda: [({}, len(app.jobs.progress))],
+    )
+    app.metrics.add_collector(
+        "visiverse_ffmpeg_slots_waiting", "Callers waiting for an ffmpeg slot", "gauge",
+        lambda: [({}, len(app.jobs.slots.waiters))],
+    )
+    app.metrics.add_collector(
+        "visiverse_watcher_pending_paths", "Changed library paths waiting to settle", "gauge",
+        lambda: [({}, len(app.watcher.pending) if app.watcher is not None else 0)],
+    )
+    app.metrics.add_collector(
+        "visiverse_library_generation", "Commits that changed the library since startup", "counter",
+        lambda: [({}, app.db.generation)],
+    )
+    app.metrics.add_collector(
+        "visiverse_prefetched_media", "Collection items warmed ahead of playback", "counter",
+        lambda: [({}, app.prefetcher.warmed)],
+    )
+    app.metrics.add_collector(
+        "visiverse_startup_seconds", "Time each startup step of this process took", "gauge",
+        lambda: [({"step": name}, seconds) for name, seconds in app.startup_timings.items()],
     )
 
-@app.errorhandler(Unauthorized)
-async def redirect_to_login(*_: Exception):
-    return redirect(url_for("page_login"))
-
-@app.errorhandler(Exception)
-async def handle_exception(e: Exception):
-    # pass through HTTP errors
-    if isinstance(e, HTTPException):
-        return e
-    app.logger.error(f"Uncaught exception")
-    for line in format_exception(e):
-        app.logger.error(line.rstrip("\n"))
-    return api_exception(e, 500)
-
-def uuid_to_b64(uuid_value):
-    return base64.urlsafe_b64encode(uuid_value.bytes).decode("utf-8").rstrip("=")
-
-def b64_to_uuid(b64_value):
-    return UUID(bytes=base64.urlsafe_b64decode(b64_value + "=="))
-
-def format_duration(seconds):
-    minutes, seconds = divmod(seconds, 60)
-    hours, minutes = divmod(minutes, 60)
-    if hours == 0:
-        return f"{minutes}:{seconds:02}"
-    else:
-        return f"{hours}:{minutes:02}:{seconds:02}"
-
-
-auth_manager.init_app(app)
+def precompile_templates(app):
+    # with auto reload off, compiled templates are never checked against their files again
+    started = time.perf_counter()
+    template_names = app.jinja_env.list_templates()
+    for template_name in template_names:
+        app.jinja_env.get_template(template_name)
+    app.logger.info(f"Compiled {len(template_names)} templates in {time.perf_counter() - started:.3f}s")
+
+
+# ********** Request Hooks **********
+
+async def metrics_start_request():
+    g.metrics_route = get_metrics_route()
+    g.metrics_started = current_app.metrics.start_request(g.metrics_route)
+
+async def metrics_finish_request(response):
+    if "metrics_started" in g:
+        current_app.metrics.finish_request(request.method, g.metrics_route, response.status_code, g.metrics_started)
+    return response
+
+async def metrics_end_request(exception=None):
+    if "metrics_started" in g:
+        current_app.metrics.end_request(g.metrics_route)
+
+def get_metrics_route():
+    # the rule rather than the path keeps label values bounded
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+async def serve_offloaded(response):
+    if current_app.streamer.offload_local:
+        return await current_app.streamer.resolve_offload(request, response)
+    return response
+
+
+# ********** Command Line **********
+
+def register_commands(app):
+
+    @app.cli.command("import")
+    @click.option("--tag", "tags", multiple=True, help="Tag applied to every imported file.")
+    def cli_import(tags):
+        """Import new and changed files from the library media path."""
+        async def run_import():
+            await app_prepare(app)
+            try:
+                plan = await app.importer.import_library(tags=tags)
+            finally:
+                await app_cleanup(app)
+            return plan
+        plan = asyncio.run(run_import())
+        click.echo(f"Scanned library: {plan}")
+        click.echo(f"Imported {app.importer.progress}")
+
+    @app.cli.command("duplicates")
+    @click.option("--distance", type=int, default=None, help="Frame hash bits near duplicates may differ in.")
+    def cli_duplicates(distance):
+        """Report groups of near-duplicate media by thumbnail frame hash."""
+        async def run_report():
+            await app_prepare(app)
+            try:
+                groups = await app.duplicates.find_groups(distance)
+                async with app.db.read_session() as session:
+                    # one pass over the library, groups can hold more ids than an IN list takes
+                    filenames = dict(await app.db.select_columns(session, Media, ("id", "filename")))
+            finally:
+                await app_cleanup(app)
+            return groups, filenames
+        groups, filenames = asyncio.run(run_report())
+        for group in groups:
+            click.echo("")
+            for media_id in group:
+                click.echo(f"{media_id}  {filenames.get(media_id, '?')}")
+        click.echo(f"{len(groups)} groups, {sum(len(group) for group in groups)} media")
+
+    @app.cli.command("check-plans")
+    @click.option("--verbose", is_flag=True, help="Print every plan, not only problems.")
+    def cli_check_plans(verbose):
+        """Check that the hot queries are answered from indexes."""
+        async def run_check():
+            db = Database(app.app_config)
+            # a starting server may be upgrading the same database
+            startup_lock = ProcessLock(os.path.join(app.app_config["storage"]["path"], "startup.lock"))
+            try:
+                await run_sync(startup_lock.acquire)()
+                try:
+                    await db.begin()
+                    migrator = Migrator(db)
+                    await migrator.begin()
+                finally:
+                    startup_lock.release()
+                return await migrator.check_query_plans()
+            finally:
+                await db.close()
+        failed = 0
+        for name, statement, plan, problems in asyncio.run(run_check()):
+            if problems:
+                failed += 1
+            if problems or verbose:
+                click.echo(f"{name}: {', '.join(problems) or 'ok'}")
+                click.echo(f"  {' '.join(statement.split())}")
+                for detail in plan:
+                    click.echo(f"    {detail}")
+        if failed:
+            raise click.ClickException(f"{failed} statements scan or sort without an index")
+        click.echo("All hot queries use indexes")
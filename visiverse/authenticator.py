@@ -1,19 +1,47 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
 
+from visiverse.cache import LRUCache
 from visiverse.database import User
 
 
 class Authenticator():
 
-    def __init__(self, db):
+    def __init__(self, db, app_config):
         self.db = db
         self.hasher = PasswordHasher()
+        # hashing is CPU bound, keep it off the event loop
+        self.hash_workers = app_config.getint("auth", "hash_workers")
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.hash_workers,
+            thread_name_prefix="argon2",
+        )
+        self.queue_depth = 0
+        # optional cross-request user cache
+        self.user_cache = None
+        user_cache_ttl = app_config.getfloat("auth", "user_cache_ttl")
+        if user_cache_ttl > 0:
+            self.user_cache = LRUCache(app_config.getint("auth", "user_cache_size"), user_cache_ttl)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def _run_hasher(self, func, *args):
+        # queued and running hash operations
+        self.queue_depth += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.queue_depth -= 1
 
     async def register_user(self, username, password):
+        password_hash = await self._run_hasher(self.hasher.hash, password)
         async with self.db.async_session() as session, session.begin():
             try:
-                password_hash = self.hasher.hash(password)
                 user = User(
                     username=username,
                     password_hash=password_hash,
@@ -21,21 +49,46 @@ class Authenticator():
                 await self.db.insert_object(session, user)
             except:
                 raise ValueError("Duplicate user")
+        self.discard_user(username)
 
     async def authenticate(self, username, password):
         async with self.db.async_session() as session:
             try:
                 user = await self.db.get_user(session, username)
-                self.hasher.verify(user.password_hash, password)
+                await self._run_hasher(self.hasher.verify, user.password_hash, password)
             except:
                 raise AuthError("Invalid credentials")
             # Update password hash if needed
             if self.hasher.check_needs_rehash(user.password_hash):
-                async with session.begin():
-                    new_hash = self.hasher.hash(password)
-                    await self.db.update_user(session, user.username, password_hash=new_hash)
+                new_hash = await self._run_hasher(self.hasher.hash, password)
+                # the lookup above already began a transaction
+                await self.db.update_user(session, user.username, password_hash=new_hash)
+                await session.commit()
+                self.discard_user(user.username)
+        return user
+
+    async def get_user(self, username):
+        if self.user_cache is not None:
+            user = self.user_cache.get(username)
+            if user is not None:
+                return user
+        async with self.db.async_session() as session:
+            user = await self.db.get_user(session, username)
+        if user is not None and self.user_cache is not None:
+            self.user_cache.set(username, user)
         return user
 
+    def discard_user(self, username):
+        if self.user_cache is not None:
+            self.user_cache.discard(username)
+
+    def stats(self):
+        return {
+            "hash_workers": self.hash_workers,
+            "queue_depth": self.queue_depth,
+            "user_cache": None if self.user_cache is None else self.user_cache.stats(),
+        }
+
 
 class AuthError(Exception):
 
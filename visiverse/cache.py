@@ -0,0 +1,206 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+# Files used this recently are never evicted, their responses may not have opened them yet
+PIN_SECONDS = 30
+
+# Temporary files older than this are left over from an ffmpeg run that died
+PART_MAX_SECONDS = 3600
+
+
+class DiskCache():
+
+    def __init__(self, path, max_bytes, rescan_interval=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        # other processes writing to the same directory are only seen by a rescan
+        self.rescan_interval = rescan_interval
+        self.lock = threading.Lock()
+        # filename -> size, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.scanned = None
+        self._scan()
+
+    def _scan(self):
+        # rebuild index from the files on disk, least recently used by mtime
+        found = []
+        stale_since = time.time() - PART_MAX_SECONDS
+        for parent_dir, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                full_filename = os.path.join(parent_dir, filename)
+                try:
+                    stat = os.stat(full_filename)
+                    if filename.endswith(".part"):
+                        # newer ones may still be written by another process
+                        if stat.st_mtime < stale_since:
+                            os.remove(full_filename)
+                        continue
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, full_filename, stat.st_size))
+        with self.lock:
+            self.entries = OrderedDict((filename, size) for _, filename, size in sorted(found))
+            self.total_bytes = sum(self.entries.values())
+            self.scanned = time.monotonic()
+        self.evict()
+
+    def touch(self, filename):
+        with self.lock:
+            try:
+                # the mtime records the last use, pinning the file for a while
+                os.utime(filename)
+                size = os.path.getsize(filename)
+            except FileNotFoundError:
+                # removed from outside the cache
+                self.total_bytes -= self.entries.pop(filename, 0)
+                return False
+            # possibly written by another process
+            self.total_bytes += size - self.entries.pop(filename, 0)
+            self.entries[filename] = size
+            return True
+
+    def add(self, filename):
+        if self.rescan_interval is not None and time.monotonic() - self.scanned > self.rescan_interval:
+            self._scan()
+        size = os.path.getsize(filename)
+        with self.lock:
+            self.total_bytes -= self.entries.pop(filename, 0)
+            self.entries[filename] = size
+            self.total_bytes += size
+        self.evict(keep=filename)
+
+    def discard_dir(self, path):
+        # drop every cached file below a directory
+        prefix = os.path.join(path, "")
+        with self.lock:
+            for filename in [f for f in self.entries if f.startswith(prefix)]:
+                self.total_bytes -= self.entries.pop(filename)
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+
+    def evict(self, keep=None):
+        pinned_since = time.time() - PIN_SECONDS
+        with self.lock:
+            for filename in list(self.entries):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if filename == keep:
+                    continue
+                try:
+                    if os.stat(filename).st_mtime > pinned_since:
+                        continue
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+                self.total_bytes -= self.entries.pop(filename)
+
+
+class LRUCache():
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (expiry, value), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expiry, value = entry
+                if expiry is None or expiry > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expiry = None if not self.ttl else time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (expiry, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SingleFlight():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+        # wait for the running call to finish
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class AsyncSingleFlight():
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        # followers await the running call instead of holding a thread each,
+        # and a caller giving up does not cancel it for the others
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.create_task(func(*args, **kwargs))
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # retrieved here in case every caller gave up
+        if not task.cancelled():
+            task.exception()
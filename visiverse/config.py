@@ -1,4 +1,6 @@
 import configparser
+import os
+from uuid import uuid4
 
 
 def load_config(filename, autosave=True):
@@ -15,13 +17,158 @@ def load_config(filename, autosave=True):
 
     default_values = {
         "library": {
-            "db_url": "sqlite+aiosqlite:///:memory:",
+            "db_url": "sqlite+aiosqlite:///visiverse.db",
             "media_path": "./media",
+            "page_size": "48",
+            "max_page_size": "200",
         },
         "storage": {
             "path": "./storage",
-            "thumb_suffix": "-thumb.jpg",
-        }
+        },
+        "server": {
+            # development reloads changed templates and skips the response cache
+            "mode": "production",
+            # comma separated, used by run.py
+            "bind": "127.0.0.1:5000",
+            # processes serving requests, they share the database and storage but not caches
+            "workers": "1",
+            # seconds between takeover attempts while another process is primary,
+            # and between recoveries of jobs left by exited processes once primary
+            "primary_interval": "30",
+            "secret_key_path": "secret.key",
+        },
+        "database": {
+            # log every statement
+            "echo": "false",
+            # SQLite pragmas applied on connect, empty to keep the default
+            "journal_mode": "wal",
+            "synchronous": "normal",
+            # negative values are KiB
+            "cache_size": "-65536",
+            "mmap_size": str(256 * 1024 ** 2),
+            "busy_timeout": "5000",
+            "temp_store": "memory",
+            # connection pool of server databases
+            "pool_size": "5",
+            "max_overflow": "10",
+            "pool_timeout": "30",
+            "pool_recycle": "1800",
+            # separate read-only engine for listing and streaming, on db_url unless read_url is set
+            "read_engine": "false",
+            "read_url": "",
+        },
+        "thumbs": {
+            "widths": "240,480,720",
+            "formats": "avif,webp,jpeg",
+            "seek": "5",
+            "max_age": "31536000",
+        },
+        "storyboard": {
+            "interval": "10",
+            "tile_width": "160",
+            "tile_height": "90",
+            "columns": "10",
+            "rows": "10",
+            "keyframes_only": "true",
+            "max_age": "31536000",
+        },
+        "hls": {
+            "segment_duration": "6",
+            "readahead": "3",
+            "cache_size": str(2 * 1024 ** 3),
+            # seconds between recounts of the segments all processes wrote, cache_size is shared
+            "cache_rescan": "60",
+        },
+        "renditions": {
+            # height:video bitrate:audio bitrate, never scaled above the source
+            "ladder": "360:800k:96k,720:2800k:128k,1080:5000k:192k",
+            # views before every rendition is transcoded ahead of time
+            "popular_views": "10",
+            "max_age": "31536000",
+        },
+        "streaming": {
+            "chunk_size": str(1024 ** 2),
+            "max_ranges": "16",
+            # none, x-accel (nginx) or x-sendfile (apache, lighttpd)
+            "offload": "none",
+            "offload_prefix": "/internal/media/",
+            "offload_local": "false",
+        },
+        "auth": {
+            "hash_workers": "2",
+            "user_cache_ttl": "0",
+            "user_cache_size": "1000",
+        },
+        "cache": {
+            "media_size": "10000",
+            "media_ttl": "300",
+            # rendered pages and API reads, also dropped by every library commit
+            "response_size": "1000",
+            # seconds, bounds staleness from writes by other processes
+            "response_ttl": "60",
+        },
+        "facets": {
+            "limit": "50",
+            "cache_size": "1000",
+            # seconds, bounds staleness from writes by other processes
+            "cache_ttl": "60",
+        },
+        "jobs": {
+            # concurrent ffmpeg processes
+            "workers": "2",
+            "max_attempts": "3",
+            # seconds, doubled after every failed attempt
+            "retry_delay": "30",
+            "poll_interval": "5",
+            # seconds finished jobs are kept
+            "retention": "86400",
+        },
+        "metrics": {
+            # seconds before a statement is logged, its parameters only at debug level
+            "slow_query": "0.25",
+            # serve /metrics without login, only where the port is not reachable from outside
+            "public": "false",
+        },
+        "watcher": {
+            # import changes to media_path as they happen
+            "enabled": "false",
+            # auto, inotify or poll, auto polls where inotify is unavailable
+            "backend": "auto",
+            # seconds a file must stay unchanged before it is imported
+            "debounce": "2",
+            "poll_interval": "30",
+            # changed paths followed one by one, beyond that the library is rescanned
+            "max_pending": "100000",
+            # catch up with changes made while the server was down
+            "initial_import": "true",
+        },
+        "import": {
+            "workers": "4",
+            "batch_size": "500",
+            "thumbnails": "false",
+            "storyboards": "false",
+            "content_hash": "true",
+        },
+        "duplicates": {
+            # bits of the 64 bit frame hashes two near duplicates may differ in
+            "threshold": "4",
+            # largest distance a request may ask for, the library report slows down quickly above 5
+            "max_distance": "6",
+            # seconds before hashes from background jobs show up
+            "index_ttl": "300",
+            # hash media without a thumbnail frame hash after every import
+            "backfill": "false",
+        },
+        "playback": {
+            # next collection items warmed when one starts playing
+            "prefetch_items": "1",
+            # HLS segments of the first variant prepared ahead
+            "prefetch_segments": "2",
+            # bytes of each file asked into the page cache
+            "prefetch_bytes": str(8 * 1024 ** 2),
+            # seconds before the same item is warmed again
+            "prefetch_ttl": "600",
+        },
     }
 
     # Set default values if needed
@@ -42,3 +189,24 @@ def save_config(config, filename):
     # Write updated config file
     with open(filename, "w") as config_file:
         config.write(config_file)
+
+def load_secret_key(filename):
+    # workers starting together must end up with the same key
+    try:
+        with open(filename, "r") as key_file:
+            return key_file.read().strip()
+    except FileNotFoundError:
+        pass
+    key = uuid4().hex
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temp_filename, "w") as key_file:
+        key_file.write(key)
+    try:
+        # fails instead of replacing a key written meanwhile
+        os.link(temp_filename, filename)
+    except FileExistsError:
+        with open(filename, "r") as key_file:
+            key = key_file.read().strip()
+    finally:
+        os.remove(temp_filename)
+    return key
@@ -1,18 +1,33 @@
 from __future__ import annotations
 
 import enum
+import itertools
+import logging
+import re
 from dataclasses import dataclass
+from functools import partial
+from datetime import datetime
 from typing import Optional
 
 from sqlalchemy import event
+from sqlalchemy.engine import make_url
 # Metadata
+from sqlalchemy import BigInteger
+from sqlalchemy import Integer
 from sqlalchemy import Column
 from sqlalchemy import Table
 from sqlalchemy import ForeignKey
 from sqlalchemy import Enum
 from sqlalchemy import Uuid
+# SQL expressions
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import or_
 # SQL commands
+from sqlalchemy import delete
 from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
 from sqlalchemy import select
 from sqlalchemy import update
 # SQLAlchemy AsyncIO requirements
@@ -22,8 +37,48 @@ from sqlalchemy.ext.asyncio import create_async_engine
 # SQLAlchemy ORM requirements
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
+# SQLAlchemy relationship loading
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import noload
+from sqlalchemy.orm import raiseload
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import subqueryload
+
+
+logger = logging.getLogger(__name__)
+
+# Pragmas set on every SQLite connection, in this order
+SQLITE_PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "busy_timeout", "temp_store")
+
+# Relationship loading strategies usable in load plans
+LOAD_STRATEGIES = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "subquery": subqueryload,
+    "raise": raiseload,
+    "noload": noload,
+}
+
+# Load plans for common views, relationships not named are never lazy loaded
+MEDIA_TILE_LOAD = {"people": "selectin", "*": "raise"}
+MEDIA_VIEW_LOAD = {
+    "collections": "selectin",
+    "people": "selectin",
+    "organizations": "selectin",
+    "tags": "selectin",
+    "*": "raise",
+}
+# Columns needed to list media without loading full rows
+MEDIA_LIST_COLUMNS = ("id", "title", "type", "duration", "created")
+
+# Dialect inserts supporting ON CONFLICT DO NOTHING
+UPSERT_INSERTS = {
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+}
 
 
 class Database():
@@ -32,36 +87,328 @@ class Database():
         self.app_config = app_config
         # setup db engine and session maker
         self.db_url = app_config["library"]["db_url"]
-        self.engine = create_async_engine(self.db_url, echo=True)
+        self.engine = self.create_engine(self.db_url)
         self.async_session = async_sessionmaker(self.engine, expire_on_commit=False)
+        # reads that may run beside imports without queueing for the same connections
+        self.read_engine = None
+        if app_config.getboolean("database", "read_engine"):
+            read_url = app_config["database"]["read_url"] or self.db_url
+            if is_memory_url(read_url):
+                logger.warning("In-memory databases cannot be shared, reading through the main engine")
+            else:
+                self.read_engine = self.create_engine(read_url, read_only=True)
+        self.read_session = async_sessionmaker(self.read_engine or self.engine, expire_on_commit=False)
+        # callbacks given changed media ids after each commit, None meaning all
+        self.media_listeners = []
+        # bumped after every commit that wrote to the library
+        self.generation = 0
+        self.session_events = []
+        self.listen_session("after_flush", self._collect_flushed_media)
+        self.listen_session("do_orm_execute", self._collect_executed_media)
+        self.listen_session("after_commit", self._notify_media_changed)
+        self.listen_session("after_rollback", self._discard_media_changes)
 
     async def begin(self) -> None:
         async with self.engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
 
     async def close(self) -> None:
-        await self.engine.dispose()
+        for event_name, listener in self.session_events:
+            event.remove(Session, event_name, listener)
+        for engine in self.engines:
+            await engine.dispose()
+
+    @property
+    def engines(self):
+        if self.read_engine is None:
+            return [self.engine]
+        return [self.engine, self.read_engine]
+
+    def create_engine(self, db_url, read_only=False):
+        db_config = self.app_config["database"]
+        engine_options = {"echo": db_config.getboolean("echo")}
+        is_sqlite = make_url(db_url).get_backend_name() == "sqlite"
+        if not is_sqlite:
+            engine_options.update(
+                pool_size=db_config.getint("pool_size"),
+                max_overflow=db_config.getint("max_overflow"),
+                pool_timeout=db_config.getfloat("pool_timeout"),
+                pool_recycle=db_config.getint("pool_recycle"),
+                pool_pre_ping=True,
+            )
+        engine = create_async_engine(db_url, **engine_options)
+        if is_sqlite:
+            pragmas = [(name, db_config[name]) for name in SQLITE_PRAGMAS if db_config[name]]
+            if read_only:
+                pragmas.append(("query_only", "on"))
+            event.listen(engine.sync_engine, "connect", partial(set_sqlite_pragmas, pragmas))
+        return engine
+
+    # ********** Change Tracking **********
+
+    def on_media_changed(self, callback):
+        self.media_listeners.append(callback)
+
+    def listen_session(self, event_name, listener):
+        # session events are global, listeners filter with owns_session
+        event.listen(Session, event_name, listener)
+        self.session_events.append((event_name, listener))
+
+    def owns_session(self, session):
+        return session.bind is self.engine.sync_engine
+
+    def _collect_flushed_media(self, session, flush_context):
+        if not self.owns_session(session):
+            return
+        if any(
+            not is_bookkeeping(changed_object)
+            for changed_object in itertools.chain(session.new, session.dirty, session.deleted)
+        ):
+            session.info["library_changed"] = True
+        changed = session.info.setdefault("changed_media", set())
+        for changed_object in itertools.chain(session.dirty, session.deleted):
+            if isinstance(changed_object, Media):
+                changed.add(changed_object.id)
+
+    def _collect_executed_media(self, orm_execute_state):
+        # bulk statements skip the unit of work
+        if orm_execute_state.is_select:
+            return
+        if not self.owns_session(orm_execute_state.session):
+            return
+        mapper = orm_execute_state.bind_mapper
+        if mapper is None or not issubclass(mapper.class_, BOOKKEEPING_CLASSES):
+            orm_execute_state.session.info["library_changed"] = True
+        if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+            return
+        if mapper is None or mapper.class_ is not Media:
+            return
+        changed = orm_execute_state.session.info.setdefault("changed_media", set())
+        parameters = orm_execute_state.parameters
+        if isinstance(parameters, list) and all("id" in p for p in parameters):
+            changed.update(p["id"] for p in parameters)
+        else:
+            # rows matched by a WHERE clause are unknown
+            changed.add(None)
+
+    def _notify_media_changed(self, session):
+        if session.info.pop("library_changed", False):
+            self.generation += 1
+        changed = session.info.pop("changed_media", None)
+        if not changed:
+            return
+        media_ids = None if None in changed else changed
+        for listener in self.media_listeners:
+            listener(media_ids)
+
+    def _discard_media_changes(self, session):
+        session.info.pop("library_changed", None)
+        session.info.pop("changed_media", None)
 
     # ********** Generic Actions **********
 
     async def insert_object(self, session, new_object):
         session.add(new_object)
 
-    async def select_object(self, session, object_class, object_uuid):
+    async def insert_objects(self, session, object_class, rows):
+        # bulk insert from a list of column dicts
+        if rows:
+            await session.execute(insert(object_class), rows)
+
+    async def insert_associations(self, session, assoc_table, rows):
+        if rows:
+            await session.execute(insert(assoc_table), rows)
+
+    async def update_objects(self, session, object_class, rows):
+        # bulk update by primary key from a list of column dicts
+        if rows:
+            await session.execute(update(object_class), rows)
+
+    async def upsert_objects(self, session, object_class, rows):
+        # insert or replace by primary key from a list of column dicts
+        if not rows:
+            return
+        dialect_insert = UPSERT_INSERTS.get(self.engine.dialect.name)
+        if dialect_insert is None:
+            for row in rows:
+                await session.merge(object_class(**row))
+            return
+        statement = dialect_insert(object_class)
+        primary_key = [column.name for column in object_class.__table__.primary_key]
+        await session.execute(
+            statement.on_conflict_do_update(
+                index_elements=primary_key,
+                set_={
+                    column: statement.excluded[column]
+                    for column in rows[0] if column not in primary_key
+                },
+            ),
+            rows,
+        )
+
+    async def select_object(self, session, object_class, object_uuid, load=None):
         result = await session.execute(
             select(object_class)
             .where(object_class.id == object_uuid)
+            .options(*build_load_options(object_class, load))
         )
-        return result.scalar()
+        return result.unique().scalar()
+
+    async def select_objects(self, session, object_class, object_uuids, load=None):
+        # many objects in one IN (...) query, in no particular order
+        result = await session.execute(
+            select(object_class)
+            .where(object_class.id.in_(object_uuids))
+            .options(*build_load_options(object_class, load))
+        )
+        return result.unique().scalars().all()
 
-    async def select_all_objects(self, session, object_class):
+    async def select_all_objects(self, session, object_class, load=None):
         result = await session.execute(
             select(object_class)
+            .options(*build_load_options(object_class, load))
         )
-        return result.scalars()
+        return result.unique().scalars()
+
+    async def select_columns(self, session, object_class, columns, *where):
+        # lightweight rows instead of full ORM objects
+        result = await session.execute(
+            select(*build_columns(object_class, columns))
+            .where(*where)
+        )
+        return result.all()
 
     # ********** Access Helpers **********
 
+    async def select_media_page(self, session, cursor=None, limit=50, load=None, columns=None, where=()):
+        # keyset pagination, newest first
+        if columns is None:
+            query = select(Media).options(*build_load_options(Media, load))
+        else:
+            # the cursor needs the sort key columns
+            columns = tuple(columns) + tuple(c for c in ("id", "created") if c not in columns)
+            query = select(*build_columns(Media, columns))
+        query = (
+            query
+            .where(Media.missing.is_(False), *where)
+            .order_by(Media.created.desc(), Media.id.desc())
+            .limit(limit + 1)
+        )
+        if cursor is not None:
+            created, media_id = cursor
+            query = query.where(or_(
+                Media.created < created,
+                and_(Media.created == created, Media.id < media_id),
+            ))
+        result = await session.execute(query)
+        if columns is None:
+            media_items = result.unique().scalars().all()
+        else:
+            media_items = result.all()
+        next_cursor = None
+        if len(media_items) > limit:
+            media_items = media_items[:limit]
+            next_cursor = (media_items[-1].created, media_items[-1].id)
+        return media_items, next_cursor
+
+    async def get_file_index(self, session, filenames=None, prefixes=()):
+        # the whole library, or the given files and everything below the given prefixes
+        query = (
+            select(
+                Media.id,
+                Media.filename,
+                Media.missing,
+                FileSignature.size,
+                FileSignature.mtime,
+                FileSignature.content_hash,
+            )
+            .outerjoin(FileSignature)
+        )
+        if filenames is not None:
+            # ranges rather than LIKE so the filename index is used
+            query = query.where(or_(
+                Media.filename.in_(filenames),
+                *(and_(Media.filename >= prefix, Media.filename < get_prefix_end(prefix)) for prefix in prefixes),
+            ))
+        result = await session.execute(query)
+        return result.all()
+
+    async def count_view(self, session, media_id):
+        # returns the new view count
+        now = datetime.now()
+        dialect_insert = UPSERT_INSERTS.get(self.engine.dialect.name)
+        if dialect_insert is not None:
+            statement = dialect_insert(MediaViews).values(media_id=media_id, views=1, last_viewed=now)
+            result = await session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[MediaViews.media_id],
+                    set_={"views": MediaViews.views + 1, "last_viewed": now},
+                )
+                .returning(MediaViews.views)
+            )
+            return result.scalar()
+        media_views = await session.get(MediaViews, media_id)
+        if media_views is None:
+            media_views = MediaViews(media_id=media_id, views=0)
+            session.add(media_views)
+        media_views.views += 1
+        media_views.last_viewed = now
+        return media_views.views
+
+    async def get_unprobed_media(self, session):
+        result = await session.execute(
+            select(Media.id)
+            .outerjoin(MediaProbe)
+            .where(MediaProbe.media_id.is_(None))
+            .where(Media.type.in_([MediaType.video, MediaType.audio]))
+            .where(Media.missing.is_(False))
+        )
+        return result.scalars().all()
+
+    async def delete_renditions(self, session, media_ids):
+        if media_ids:
+            await session.execute(
+                delete(Rendition)
+                .where(Rendition.media_id.in_(media_ids))
+            )
+
+    async def get_frame_hashes(self, session):
+        result = await session.execute(
+            select(MediaHash.media_id, MediaHash.dhash)
+            .join(Media)
+            .where(Media.missing.is_(False))
+        )
+        return result.all()
+
+    async def get_unhashed_media(self, session):
+        # images, and videos known to have a picture
+        result = await session.execute(
+            select(Media.id)
+            .outerjoin(MediaHash)
+            .outerjoin(MediaProbe)
+            .where(MediaHash.media_id.is_(None))
+            .where(or_(
+                Media.type == MediaType.image,
+                and_(Media.type == MediaType.video, MediaProbe.video_codec.is_not(None)),
+            ))
+            .where(Media.missing.is_(False))
+        )
+        return result.scalars().all()
+
+    async def delete_frame_hashes(self, session, media_ids):
+        if media_ids:
+            await session.execute(
+                delete(MediaHash)
+                .where(MediaHash.media_id.in_(media_ids))
+            )
+
+    async def get_rendition_usage(self, session):
+        result = await session.execute(
+            select(Rendition.height, func.count(), func.sum(Rendition.size))
+            .group_by(Rendition.height)
+        )
+        return result.all()
+
     async def get_user(self, session, username):
         result = await session.execute(
             select(User)
@@ -85,19 +432,78 @@ class Database():
             .values(**kwargs)
         )
 
+    async def upsert_tags(self, session, tag_names):
+        # one set-based statement instead of a lookup per tag
+        tag_names = sorted(set(tag_names))
+        if not tag_names:
+            return tag_names
+        dialect_insert = UPSERT_INSERTS.get(self.engine.dialect.name)
+        if dialect_insert is not None:
+            await session.execute(
+                dialect_insert(Tag).on_conflict_do_nothing(),
+                [{"name": tag_name} for tag_name in tag_names],
+            )
+            return tag_names
+        result = await session.execute(
+            select(Tag.name)
+            .where(Tag.name.in_(tag_names))
+        )
+        existing = set(result.scalars())
+        await self.insert_objects(session, Tag, [
+            {"name": tag_name} for tag_name in tag_names if tag_name not in existing
+        ])
+        return tag_names
+
     async def get_or_create_tag(self, session, tag_name):
-        # try obtaining
+        await self.upsert_tags(session, [tag_name])
         result = await session.execute(
             select(Tag)
             .where(Tag.name == tag_name)
         )
-        result = result.scalar()
-        if result is not None:
-            return result
-        # create and insert
-        new_tag = Tag(name=tag_name)
-        session.add(new_tag)
-        return new_tag
+        return result.scalar()
+
+
+def set_sqlite_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        # values come from the config file, but are still spliced into SQL
+        if not re.fullmatch(r"-?\w+", value):
+            raise ValueError(f"Invalid value '{value}' for pragma {name}")
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+def is_memory_url(db_url):
+    url = make_url(db_url)
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+def get_prefix_end(prefix):
+    # smallest string sorting after everything starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def build_load_options(object_class, load_plan):
+    # e.g. {"tags": "selectin", "people": "joined", "*": "raise"}
+    options = []
+    for relationship_name, strategy in (load_plan or {}).items():
+        if strategy not in LOAD_STRATEGIES:
+            raise ValueError(f"Unknown load strategy '{strategy}'")
+        if relationship_name == "*":
+            options.append(LOAD_STRATEGIES[strategy]("*"))
+            continue
+        if relationship_name not in object_class.__mapper__.relationships:
+            raise ValueError(f"Unknown relationship '{relationship_name}'")
+        options.append(LOAD_STRATEGIES[strategy](getattr(object_class, relationship_name)))
+    return options
+
+def is_bookkeeping(changed_object):
+    return isinstance(changed_object, BOOKKEEPING_CLASSES)
+
+def build_columns(object_class, column_names):
+    columns = []
+    for column_name in column_names:
+        if column_name not in object_class.__mapper__.columns:
+            raise ValueError(f"Unknown column '{column_name}'")
+        columns.append(getattr(object_class, column_name))
+    return columns
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -110,6 +516,8 @@ assoc_media_collection_table = Table(
     Base.metadata,
     Column("media_id", ForeignKey("media.id"), primary_key=True),
     Column("collection_id", ForeignKey("collections.id"), primary_key=True),
+    # playback order, spaced out so moving a member rewrites only its own row
+    Column("position", Integer, nullable=False, default=0),
 )
 
 # Media <---> Person associations
@@ -154,6 +562,8 @@ class Media(Base):
     duration: Mapped[Optional[int]]
     urls: Mapped[Optional[str]]
     type: Mapped[enum.Enum] = mapped_column(Enum(MediaType))
+    missing: Mapped[bool] = mapped_column(default=False)
+    created: Mapped[datetime] = mapped_column(default=datetime.now)
 
     collections: Mapped[set[Collection]] = relationship(
         secondary=assoc_media_collection_table, back_populates="media"
@@ -178,6 +588,67 @@ class Media(Base):
         return f"{self.title} [{self.filename}]"
 
 
+@dataclass
+class FileSignature(Base):
+    __tablename__ = "file_signatures"
+
+    media_id: Mapped[str] = mapped_column(ForeignKey("media.id"), primary_key=True)
+    size: Mapped[int]
+    mtime: Mapped[int]
+    content_hash: Mapped[Optional[str]]
+
+
+@dataclass
+class MediaProbe(Base):
+    __tablename__ = "media_probes"
+
+    # technical metadata from the one ffprobe run at import
+    media_id: Mapped[str] = mapped_column(ForeignKey("media.id"), primary_key=True)
+    container: Mapped[Optional[str]]
+    duration: Mapped[Optional[float]]
+    bitrate: Mapped[Optional[int]]
+    video_codec: Mapped[Optional[str]]
+    width: Mapped[Optional[int]]
+    height: Mapped[Optional[int]]
+    frame_rate: Mapped[Optional[float]]
+    pixel_format: Mapped[Optional[str]]
+    audio_codec: Mapped[Optional[str]]
+    audio_channels: Mapped[Optional[int]]
+    # JSON list of every audio stream
+    audio_tracks: Mapped[str] = mapped_column(default="[]")
+
+
+@dataclass
+class MediaViews(Base):
+    __tablename__ = "media_views"
+
+    # kept apart from media so counting views never touches library rows
+    media_id: Mapped[str] = mapped_column(ForeignKey("media.id"), primary_key=True)
+    views: Mapped[int] = mapped_column(default=0)
+    last_viewed: Mapped[Optional[datetime]]
+
+
+@dataclass
+class Rendition(Base):
+    __tablename__ = "renditions"
+
+    media_id: Mapped[str] = mapped_column(ForeignKey("media.id"), primary_key=True)
+    height: Mapped[int] = mapped_column(primary_key=True)
+    # bytes on disk, playlist and init segment included
+    size: Mapped[int]
+    created: Mapped[datetime] = mapped_column(default=datetime.now)
+
+
+@dataclass
+class MediaHash(Base):
+    __tablename__ = "media_hashes"
+
+    media_id: Mapped[str] = mapped_column(ForeignKey("media.id"), primary_key=True)
+    # perceptual hash of the thumbnail frame, 64 bits stored signed
+    dhash: Mapped[int] = mapped_column(BigInteger)
+    created: Mapped[datetime] = mapped_column(default=datetime.now)
+
+
 @dataclass
 class User(Base):
     __tablename__ = "users"
@@ -188,6 +659,35 @@ class User(Base):
     description: Mapped[Optional[str]]
 
 
+class JobState(enum.Enum):
+    queued = 1
+    running = 2
+    done = 3
+    failed = 4
+
+
+@dataclass
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str]
+    media_id: Mapped[Optional[str]] = mapped_column(Uuid)
+    # JSON encoded handler arguments
+    args: Mapped[str] = mapped_column(default="{}")
+    # lower runs first
+    priority: Mapped[int] = mapped_column(default=50)
+    state: Mapped[enum.Enum] = mapped_column(Enum(JobState), default=JobState.queued)
+    attempts: Mapped[int] = mapped_column(default=0)
+    # process running it, jobs of a process that exited are queued again
+    owner: Mapped[Optional[str]]
+    progress: Mapped[float] = mapped_column(default=0.0)
+    error: Mapped[Optional[str]]
+    not_before: Mapped[datetime] = mapped_column(default=datetime.now)
+    created: Mapped[datetime] = mapped_column(default=datetime.now)
+    finished: Mapped[Optional[datetime]]
+
+
 class CollectionType(enum.Enum):
     playlist = 1
     series = 2
@@ -277,3 +777,7 @@ class Tag(Base):
 
     def __repr__(self) -> str:
         return f"{self.name}"
+
+
+# Tables whose writes leave the library itself unchanged
+BOOKKEEPING_CLASSES = (User, Job, MediaViews, Rendition, MediaHash)
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import time
+
+from quart.utils import run_sync
+
+# optional, vectorizes the Hamming distance search, a BK-tree is used without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+logger = logging.getLogger(__name__)
+
+MASK64 = (1 << 64) - 1
+
+# every frame without detail, black or a single color, hashes to 0
+FLAT_HASH = 0
+
+# at most 22 bit blocks, their run table stays at a few million entries
+MIN_BLOCKS = 3
+
+
+class DuplicateFinder():
+
+    def __init__(self, db, app_config):
+        self.db = db
+        self.threshold = app_config.getint("duplicates", "threshold")
+        self.max_distance = app_config.getint("duplicates", "max_distance")
+        self.index_ttl = app_config.getfloat("duplicates", "index_ttl")
+        self.index = None
+        # (library generation, monotonic time) the index was built at
+        self.built = None
+        self.lock = asyncio.Lock()
+
+    def check_distance(self, max_distance):
+        if max_distance is None:
+            return self.threshold
+        if not 0 <= max_distance <= self.max_distance:
+            raise ValueError(f"Distance must be between 0 and {self.max_distance}")
+        return max_distance
+
+    async def get_index(self):
+        # hashes arrive from background jobs, so the index is also rebuilt after a while
+        async with self.lock:
+            if self.built is not None:
+                generation, built = self.built
+                if generation == self.db.generation and time.monotonic() - built < self.index_ttl:
+                    return self.index
+            generation = self.db.generation
+            async with self.db.read_session() as session:
+                rows = await self.db.get_frame_hashes(session)
+            started = time.monotonic()
+            self.index = await run_sync(HashIndex)([row[0] for row in rows], [row[1] for row in rows])
+            logger.info(f"Indexed {len(rows)} frame hashes in {time.monotonic() - started:.2f}s")
+            self.built = (generation, time.monotonic())
+            return self.index
+
+    def invalidate(self):
+        self.built = None
+
+    async def find_duplicates(self, media_id, max_distance=None):
+        # (media id, distance) of media looking like this one, None when it has no hash yet
+        max_distance = self.check_distance(max_distance)
+        index = await self.get_index()
+        frame_hash = index.get_hash(media_id)
+        if frame_hash is None:
+            return None
+        return [
+            (other_id, distance)
+            for other_id, distance in index.find_near(frame_hash, max_distance)
+            if other_id != media_id
+        ]
+
+    async def find_groups(self, max_distance=None):
+        # lists of media ids within the distance of each other, largest first
+        max_distance = self.check_distance(max_distance)
+        index = await self.get_index()
+        return await run_sync(index.find_groups)(max_distance)
+
+
+class HashIndex():
+
+    def __init__(self, media_ids, frame_hashes):
+        # media sharing a hash are kept together, distances are only computed between distinct hashes
+        members = {}
+        self.media_hashes = {}
+        for media_id, frame_hash in zip(media_ids, frame_hashes):
+            if frame_hash == FLAT_HASH:
+                continue
+            members.setdefault(frame_hash, []).append(media_id)
+            self.media_hashes[media_id] = frame_hash
+        self.hashes = list(members)
+        self.members = list(members.values())
+        if numpy is not None:
+            # stored signed, compared as unsigned bits
+            self.array = numpy.array(self.hashes, dtype=numpy.int64).view(numpy.uint64)
+        else:
+            self.tree = BKTree()
+            for position, frame_hash in enumerate(self.hashes):
+                self.tree.add(frame_hash, position)
+
+    def __len__(self):
+        return len(self.media_hashes)
+
+    def get_hash(self, media_id):
+        return self.media_hashes.get(media_id)
+
+    def find_near(self, frame_hash, max_distance):
+        if numpy is not None:
+            target = numpy.array([frame_hash], dtype=numpy.int64).view(numpy.uint64)
+            distances = count_bits(self.array ^ target)
+            positions = numpy.nonzero(distances <= max_distance)[0]
+            matches = zip(positions.tolist(), distances[positions].tolist())
+        else:
+            matches = self.tree.find(frame_hash, max_distance)
+        return sorted(
+            (
+                (media_id, distance)
+                for position, distance in matches
+                for media_id in self.members[position]
+            ),
+            key=lambda match: match[1],
+        )
+
+    def find_groups(self, max_distance):
+        if numpy is not None:
+            pairs = self._find_pairs_vectorized(max_distance)
+        else:
+            pairs = self._find_pairs_tree(max_distance)
+        # connected hashes, then every media item sharing one of them
+        parents = {}
+        for first, second in pairs:
+            first_root, second_root = find_root(parents, first), find_root(parents, second)
+            if first_root != second_root:
+                parents[max(first_root, second_root)] = min(first_root, second_root)
+        grouped = {}
+        for position in parents:
+            grouped.setdefault(find_root(parents, position), []).append(position)
+        groups = [
+            [media_id for position in positions for media_id in self.members[position]]
+            for positions in grouped.values()
+        ]
+        # exact copies that are near nothing else
+        groups += [
+            media_ids for position, media_ids in enumerate(self.members)
+            if len(media_ids) > 1 and position not in parents
+        ]
+        return sorted(groups, key=len, reverse=True)
+
+    def _find_pairs_vectorized(self, max_distance):
+        # pigeonhole: split into blocks, hashes within max_distance differ by at most
+        # max_distance // blocks bits in one of them, kept at 0 or 1 so each block is
+        # looked up by its own key and every key one bit away
+        blocks = max(MIN_BLOCKS, max_distance // 2 + 1)
+        radius = max_distance // blocks
+        found = []
+        shift = 0
+        for block in range(blocks):
+            width = 64 // blocks + (1 if block < 64 % blocks else 0)
+            keys = ((self.array >> numpy.uint64(shift)) & numpy.uint64((1 << width) - 1)).astype(numpy.int32)
+            shift += width
+            # hashes sorted by key, with the run of positions each key has in them
+            order = numpy.argsort(keys)
+            sorted_keys = keys[order]
+            sorted_hashes = self.array[order]
+            run_lengths = numpy.bincount(sorted_keys, minlength=1 << width).astype(numpy.int32)
+            run_starts = numpy.cumsum(run_lengths, dtype=numpy.int32) - run_lengths
+            found.append(self._match_runs(
+                order, sorted_hashes, numpy.arange(len(order)), sorted_keys, run_starts, run_lengths,
+                max_distance, same_run=True,
+            ))
+            for bit in range(width) if radius else ():
+                # from the side with the bit clear only, every pair is found once
+                queries = numpy.nonzero((sorted_keys & (1 << bit)) == 0)[0]
+                found.append(self._match_runs(
+                    order, sorted_hashes, queries, sorted_keys[queries] | (1 << bit), run_starts, run_lengths,
+                    max_distance,
+                ))
+        pairs = numpy.concatenate(found)
+        pairs.sort(axis=1)
+        return numpy.unique(pairs, axis=0).tolist()
+
+    def _match_runs(self, order, sorted_hashes, queries, lookup, run_starts, run_lengths, max_distance, same_run=False):
+        # (position, position) of the queries close to any hash in the run of their lookup key
+        lengths = run_lengths[lookup]
+        has_run = numpy.nonzero(lengths)[0]
+        queries, first, lengths = queries[has_run], run_starts[lookup[has_run]], lengths[has_run]
+        if same_run:
+            # later positions of the own run only
+            first, lengths = queries + 1, first + lengths - queries - 1
+            has_run = numpy.nonzero(lengths)[0]
+            queries, first, lengths = queries[has_run], first[has_run], lengths[has_run]
+        if not len(queries):
+            return numpy.empty((0, 2), dtype=numpy.int64)
+        # every (query, candidate) in the runs, flattened
+        ends = numpy.cumsum(lengths)
+        candidates = numpy.arange(ends[-1]) + numpy.repeat(first - (ends - lengths), lengths)
+        queries = numpy.repeat(queries, lengths)
+        close = count_bits(sorted_hashes[queries] ^ sorted_hashes[candidates]) <= max_distance
+        return numpy.stack((order[queries[close]], order[candidates[close]]), axis=1)
+
+    def _find_pairs_tree(self, max_distance):
+        pairs = []
+        for position, frame_hash in enumerate(self.hashes):
+            for other, _ in self.tree.find(frame_hash, max_distance):
+                if other > position:
+                    pairs.append((position, other))
+        return pairs
+
+
+class BKTree():
+
+    def __init__(self):
+        # [hash, position, {distance: child node}]
+        self.root = None
+
+    def add(self, frame_hash, position):
+        node = [frame_hash, position, {}]
+        if self.root is None:
+            self.root = node
+            return
+        parent = self.root
+        while True:
+            distance = hamming_distance(frame_hash, parent[0])
+            child = parent[2].get(distance)
+            if child is None:
+                parent[2][distance] = node
+                return
+            parent = child
+
+    def find(self, frame_hash, max_distance):
+        # (position, distance) of every hash within max_distance
+        if self.root is None:
+            return []
+        matches = []
+        nodes = [self.root]
+        while nodes:
+            node_hash, position, children = nodes.pop()
+            distance = hamming_distance(frame_hash, node_hash)
+            if distance <= max_distance:
+                matches.append((position, distance))
+            # the triangle inequality rules out every other subtree
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return matches
+
+
+def hamming_distance(first_hash, second_hash):
+    return bin((first_hash ^ second_hash) & MASK64).count("1")
+
+def count_bits(values):
+    # set bits of every uint64
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(values)
+    return BYTE_BITS[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+def find_root(parents, position):
+    root = parents.setdefault(position, position)
+    while parents[root] != root:
+        root = parents[root]
+    # halve the path for later lookups
+    while parents[position] != root:
+        parents[position], position = root, parents[position]
+    return root
+
+
+if numpy is not None:
+    BYTE_BITS = numpy.array([bin(value).count("1") for value in range(256)], dtype=numpy.uint8)
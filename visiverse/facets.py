@@ -0,0 +1,195 @@
+import logging
+from uuid import UUID
+
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import text
+
+from visiverse.cache import LRUCache
+from visiverse.database import Media
+from visiverse.database import Organization
+from visiverse.database import Person
+from visiverse.database import assoc_media_organization_table
+from visiverse.database import assoc_media_person_table
+from visiverse.database import assoc_media_tag_table
+
+
+logger = logging.getLogger(__name__)
+
+# Facet name -> (association table, linked column, named object)
+FACETS = {
+    "tag": (assoc_media_tag_table, "tag_name", None),
+    "person": (assoc_media_person_table, "person_id", Person),
+    "organization": (assoc_media_organization_table, "organization_id", Organization),
+}
+
+SCHEMA = [
+    # media per facet value, ignoring missing media
+    """CREATE TABLE IF NOT EXISTS facet_counts (
+        facet TEXT NOT NULL,
+        value TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (facet, value)
+    )""",
+]
+
+for facet_name, (assoc_table, assoc_column, _) in FACETS.items():
+    SCHEMA += [
+        f"""CREATE TRIGGER IF NOT EXISTS facet_{facet_name}_insert
+        AFTER INSERT ON {assoc_table.name}
+        WHEN (SELECT missing FROM media WHERE id = NEW.media_id) = 0
+        BEGIN
+            INSERT INTO facet_counts (facet, value, count) VALUES ('{facet_name}', NEW.{assoc_column}, 1)
+            ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS facet_{facet_name}_delete
+        AFTER DELETE ON {assoc_table.name}
+        WHEN (SELECT missing FROM media WHERE id = OLD.media_id) = 0
+        BEGIN
+            UPDATE facet_counts SET count = count - 1
+            WHERE facet = '{facet_name}' AND value = OLD.{assoc_column};
+            DELETE FROM facet_counts
+            WHERE facet = '{facet_name}' AND value = OLD.{assoc_column} AND count <= 0;
+        END""",
+        # media going missing or coming back moves all of its links at once
+        f"""CREATE TRIGGER IF NOT EXISTS facet_{facet_name}_missing
+        AFTER UPDATE OF missing ON media
+        WHEN OLD.missing != NEW.missing
+        BEGIN
+            INSERT INTO facet_counts (facet, value, count)
+            SELECT '{facet_name}', {assoc_column}, 1 FROM {assoc_table.name}
+            WHERE media_id = NEW.id AND NEW.missing = 0
+            ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+            UPDATE facet_counts SET count = count - 1
+            WHERE facet = '{facet_name}' AND NEW.missing = 1 AND value IN
+                (SELECT {assoc_column} FROM {assoc_table.name} WHERE media_id = NEW.id);
+            DELETE FROM facet_counts WHERE facet = '{facet_name}' AND count <= 0;
+        END""",
+    ]
+
+REBUILD_COUNTS = [
+    f"""INSERT INTO facet_counts (facet, value, count)
+    SELECT '{facet_name}', a.{assoc_column}, count(*) FROM {assoc_table.name} a
+    JOIN media m ON m.id = a.media_id WHERE m.missing = 0
+    GROUP BY a.{assoc_column}"""
+    for facet_name, (assoc_table, assoc_column, _) in FACETS.items()
+]
+
+# links of present media against the summed counts, without joining every link to its media
+CHECK_COUNTS = [
+    f"""SELECT (SELECT count(*) FROM {assoc_table.name})
+        - (SELECT count(*) FROM {assoc_table.name} WHERE media_id IN (SELECT id FROM media WHERE missing = 1))
+        != (SELECT coalesce(sum(count), 0) FROM facet_counts WHERE facet = '{facet_name}')"""
+    for facet_name, (assoc_table, _, _) in FACETS.items()
+]
+
+SELECT_COUNTS = text(
+    "SELECT value, count FROM facet_counts WHERE facet = :facet "
+    "ORDER BY count DESC, value LIMIT :limit"
+)
+
+
+class FacetIndex():
+
+    def __init__(self, db, app_config):
+        self.db = db
+        self.limit = app_config.getint("facets", "limit")
+        # summary table kept by triggers, other dialects count on demand
+        self.enabled = db.engine.dialect.name == "sqlite"
+        # filtered counts, keyed by library generation so commits invalidate them,
+        # the ttl bounds staleness from commits of other processes
+        self.cache = LRUCache(app_config.getint("facets", "cache_size"), app_config.getfloat("facets", "cache_ttl"))
+
+    async def begin(self):
+        if not self.enabled:
+            logger.info("Facet summary table needs SQLite, counting on demand")
+            return
+        async with self.db.engine.begin() as conn:
+            for statement in SCHEMA:
+                await conn.execute(text(statement))
+            # counts written without the triggers are repaired, only when the totals show it
+            for statement in CHECK_COUNTS:
+                if (await conn.execute(text(statement))).scalar():
+                    break
+            else:
+                return
+            logger.info("Rebuilding facet counts")
+            await conn.execute(text("DELETE FROM facet_counts"))
+            for statement in REBUILD_COUNTS:
+                await conn.execute(text(statement))
+
+    # ********** Queries **********
+
+    async def counts(self, session, filters):
+        generation = self.db.generation
+        cache_key = (generation, filters)
+        facet_counts = self.cache.get(cache_key)
+        if facet_counts is not None:
+            return facet_counts
+        facet_counts = {}
+        for facet_name in FACETS:
+            if self.enabled and not filters:
+                value_counts = await self._select_summary(session, facet_name)
+            else:
+                value_counts = await self._select_filtered(session, facet_name, filters)
+            facet_counts[facet_name] = await self._name_values(session, facet_name, value_counts)
+        self.cache.set(cache_key, facet_counts)
+        return facet_counts
+
+    async def _select_summary(self, session, facet_name):
+        result = await session.execute(SELECT_COUNTS, {"facet": facet_name, "limit": self.limit})
+        _, _, named_class = FACETS[facet_name]
+        if named_class is None:
+            return result.all()
+        return [(UUID(value), count) for value, count in result]
+
+    async def _select_filtered(self, session, facet_name, filters):
+        assoc_table, assoc_column, _ = FACETS[facet_name]
+        value_column = assoc_table.c[assoc_column]
+        media_count = func.count(assoc_table.c.media_id)
+        result = await session.execute(
+            select(value_column, media_count)
+            .where(assoc_table.c.media_id.in_(
+                select(Media.id)
+                .where(Media.missing.is_(False), *build_filters(filters))
+            ))
+            .group_by(value_column)
+            .order_by(media_count.desc(), value_column)
+            .limit(self.limit)
+        )
+        return result.all()
+
+    async def _name_values(self, session, facet_name, value_counts):
+        _, _, named_class = FACETS[facet_name]
+        names = {}
+        if named_class is not None and value_counts:
+            result = await session.execute(
+                select(named_class.id, named_class.name)
+                .where(named_class.id.in_([value for value, _ in value_counts]))
+            )
+            names = dict(result.all())
+        return [
+            {"value": value, "name": names.get(value, value), "count": count}
+            for value, count in value_counts
+        ]
+
+
+def parse_filters(args):
+    # e.g. ?tag=a&tag=b&person=<uuid>, every value must match
+    filters = []
+    for facet_name, (_, _, named_class) in FACETS.items():
+        values = args.getlist(facet_name)
+        if named_class is not None:
+            values = [UUID(value) for value in values]
+        filters += [(facet_name, value) for value in sorted(set(values))]
+    return tuple(filters)
+
+def build_filters(filters):
+    where = []
+    for facet_name, value in filters:
+        assoc_table, assoc_column, _ = FACETS[facet_name]
+        where.append(Media.id.in_(
+            select(assoc_table.c.media_id)
+            .where(assoc_table.c[assoc_column] == value)
+        ))
+    return where
@@ -0,0 +1,523 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import json
+import logging
+import os
+from datetime import datetime
+from datetime import timedelta
+from uuid import uuid4
+
+from quart.utils import run_sync
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import update
+
+from visiverse.cache import AsyncSingleFlight
+from visiverse.database import Job
+from visiverse.database import JobState
+from visiverse.database import Media
+from visiverse.database import MediaHash
+from visiverse.database import MediaProbe
+from visiverse.database import Rendition
+from visiverse.library import probe_file
+from visiverse.server import ProcessLock
+from visiverse.transcoder import get_dir_size
+
+
+logger = logging.getLogger(__name__)
+
+# Job priorities, lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 50
+PRIORITY_BULK = 100
+
+PENDING_STATES = (JobState.queued, JobState.running)
+
+# Job kind -> arguments its handler reads
+REQUIRED_ARGS = {
+    "thumbnail": ("format",),
+    "rendition": ("height",),
+}
+
+
+class JobScheduler():
+
+    def __init__(self, db, transcoder, media_lookup, app_config):
+        self.db = db
+        self.transcoder = transcoder
+        self.media_lookup = media_lookup
+        self.workers = app_config.getint("jobs", "workers")
+        self.max_attempts = app_config.getint("jobs", "max_attempts")
+        self.retry_delay = app_config.getfloat("jobs", "retry_delay")
+        self.poll_interval = app_config.getfloat("jobs", "poll_interval")
+        self.retention = app_config.getfloat("jobs", "retention")
+        # held while this process lives, other processes see from it whether its jobs still run
+        self.owner = uuid4().hex
+        self.owners_path = os.path.join(app_config["storage"]["path"], "owners")
+        self.owner_lock = ProcessLock(self.get_owner_filename(self.owner))
+        # caps every ffmpeg process, queued jobs and on-demand work alike
+        self.slots = PrioritySlots(self.workers)
+        # on-demand segments, concurrent requests share a single ffmpeg run
+        self.segment_flight = AsyncSingleFlight()
+        self.handlers = {
+            "probe": self._run_probe,
+            "thumbnail": self._run_thumbnail,
+            "storyboard": self._run_storyboard,
+            "rendition": self._run_rendition,
+            "remux": self._run_remux,
+            "dhash": self._run_dhash,
+        }
+        # running job id -> fraction done, only written to the database at the end
+        self.progress = {}
+        # (kind, media id, args) -> futures of callers waiting for the outcome
+        self.waiters = {}
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    async def start(self, recover=True):
+        self.owner_lock.acquire(blocking=False)
+        if recover:
+            await self.recover()
+        async with self.db.async_session() as session, session.begin():
+            await session.execute(
+                delete(Job)
+                .where(Job.state == JobState.done)
+                .where(Job.finished < datetime.now() - timedelta(seconds=self.retention))
+            )
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # the jobs cut short are recovered by the primary process
+        self.owner_lock.release()
+        self._remove_owner_file(self.owner)
+
+    async def recover(self):
+        # jobs interrupted by a shutdown or crash run again, those of live processes are left alone
+        async with self.db.async_session() as session:
+            result = await session.execute(
+                select(Job.owner).where(Job.state == JobState.running).distinct()
+            )
+            owners = [owner for owner in result.scalars() if owner != self.owner]
+        recovered = 0
+        for owner in owners:
+            # jobs without an owner were started before owners were recorded
+            owner_lock = None if owner is None else ProcessLock(self.get_owner_filename(owner))
+            if owner_lock is not None and not owner_lock.acquire(blocking=False):
+                continue
+            try:
+                async with self.db.async_session() as session, session.begin():
+                    result = await session.execute(
+                        update(Job)
+                        .where(Job.state == JobState.running)
+                        .where(Job.owner.is_(None) if owner is None else Job.owner == owner)
+                        .values(state=JobState.queued, owner=None)
+                    )
+                    recovered += result.rowcount
+            finally:
+                if owner_lock is not None:
+                    owner_lock.release()
+                    self._remove_owner_file(owner)
+        if recovered:
+            logger.info(f"Recovered {recovered} interrupted jobs")
+            self.wakeup.set()
+        return recovered
+
+    def get_owner_filename(self, owner):
+        return os.path.join(self.owners_path, f"{owner}.lock")
+
+    def _remove_owner_file(self, owner):
+        try:
+            os.remove(self.get_owner_filename(owner))
+        except FileNotFoundError:
+            pass
+
+    def slot(self, priority=PRIORITY_INTERACTIVE):
+        # for ffmpeg work too short-lived to be worth persisting
+        return self.slots.slot(priority)
+
+    async def ensure_segment(self, media, index, priority=PRIORITY_INTERACTIVE, height=None):
+        segment_filename = self.transcoder.get_segment_filename(media.id, index, height)
+        if self.transcoder.segment_cache.touch(segment_filename):
+            return segment_filename
+        return await self.segment_flight.do(
+            segment_filename, self._create_segment, media, index, priority, height
+        )
+
+    async def _create_segment(self, media, index, priority, height):
+        async with self.slot(priority):
+            return await run_sync(self.transcoder.create_segment)(media, index, height)
+
+    # ********** Submission **********
+
+    async def submit(self, kind, media_id=None, priority=PRIORITY_DEFAULT, **args):
+        return await self._submit(kind, media_id, priority, args)
+
+    async def submit_bulk(self, kind, media_ids, **args):
+        # queue one job per media item in a single transaction, behind everything else
+        self.check_job(kind, args)
+        args = json.dumps(args, sort_keys=True)
+        media_ids = list(media_ids)
+        if not media_ids:
+            return
+        async with self.db.async_session() as session, session.begin():
+            result = await session.execute(
+                select(Job.media_id)
+                .where(Job.kind == kind, Job.media_id.in_(media_ids), Job.args == args)
+                .where(Job.state.in_(PENDING_STATES))
+            )
+            pending = set(result.scalars())
+            await self.db.insert_objects(session, Job, [
+                {"kind": kind, "media_id": media_id, "args": args, "priority": PRIORITY_BULK}
+                for media_id in media_ids if media_id not in pending
+            ])
+        self.wakeup.set()
+
+    async def run(self, kind, media_id=None, priority=PRIORITY_INTERACTIVE, **args):
+        # submit and wait for the outcome
+        waiter = asyncio.get_running_loop().create_future()
+        job_id = await self._submit(kind, media_id, priority, args, waiter)
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.shield(waiter), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            # claimed by another process, only its outcome reaches the database
+            async with self.db.async_session() as session:
+                result = await session.execute(select(Job.state, Job.error).where(Job.id == job_id))
+                state, error = result.one_or_none() or (JobState.done, None)
+            if state in PENDING_STATES:
+                continue
+            key = (kind, media_id, json.dumps(args, sort_keys=True))
+            waiters = self.waiters.get(key, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.waiters[key]
+            if waiter.done():
+                return waiter.result()
+            if state == JobState.failed:
+                raise JobError(error)
+            return None
+
+    async def _submit(self, kind, media_id, priority, args, waiter=None):
+        self.check_job(kind, args)
+        args = json.dumps(args, sort_keys=True)
+        # registered first so a job finishing meanwhile still resolves it
+        if waiter is not None:
+            self.waiters.setdefault((kind, media_id, args), []).append(waiter)
+        async with self.db.async_session() as session, session.begin():
+            # an identical pending job is reused, only ever becoming more urgent
+            result = await session.execute(
+                select(Job)
+                .where(Job.kind == kind, Job.media_id == media_id, Job.args == args)
+                .where(Job.state.in_(PENDING_STATES))
+            )
+            job = result.scalars().first()
+            if job is None:
+                job = Job(kind=kind, media_id=media_id, args=args, priority=priority)
+                session.add(job)
+                await session.flush()
+            elif priority < job.priority:
+                job.priority = priority
+            if waiter is not None and job.state == JobState.queued and job.not_before > datetime.now():
+                # a caller waiting for the outcome does not wait out the retry delay
+                job.not_before = datetime.now()
+            job_id = job.id
+        self.wakeup.set()
+        return job_id
+
+    def check_job(self, kind, args):
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        missing = [name for name in REQUIRED_ARGS.get(kind, ()) if name not in args]
+        if missing:
+            raise ValueError(f"Missing job argument {', '.join(missing)}")
+
+    async def submit_unless_failed(self, kind, media_id=None, priority=PRIORITY_DEFAULT, **args):
+        if args in await self.select_failed_args(kind, media_id):
+            return None
+        return await self._submit(kind, media_id, priority, args)
+
+    async def select_failed_args(self, kind, media_id):
+        # arguments of jobs that ran out of attempts lately, resubmitting them would fail again
+        async with self.db.async_session() as session:
+            result = await session.execute(
+                select(Job.args)
+                .where(Job.media_id == media_id, Job.kind == kind, Job.state == JobState.failed)
+                .where(Job.finished >= datetime.now() - timedelta(seconds=self.retention))
+            )
+            return [json.loads(args) for args in result.scalars()]
+
+    # ********** Execution **********
+
+    async def _work(self):
+        # claimed, but its outcome could not be written
+        stranded = None
+        while True:
+            job = None
+            try:
+                if stranded is not None:
+                    await self._requeue(stranded)
+                    stranded = None
+                priority = await self._next_priority()
+                if priority is None:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                async with self.slots.slot(priority):
+                    job = await self._claim()
+                    if job is not None:
+                        await self._execute(job)
+            except Exception as e:
+                # e.g. a locked database, the worker carries on after a pause
+                logger.error(f"Job worker failed: {type(e).__name__}: {e}")
+                if job is not None:
+                    stranded = job
+                await asyncio.sleep(self.poll_interval)
+
+    async def _next_priority(self):
+        async with self.db.async_session() as session:
+            result = await session.execute(select_next_job(Job.priority))
+            return result.scalar()
+
+    async def _claim(self):
+        async with self.db.async_session() as session, session.begin():
+            result = await session.execute(select_next_job(Job))
+            job = result.scalar()
+            if job is None:
+                return None
+            # another worker may have claimed it first
+            result = await session.execute(
+                update(Job)
+                .where(Job.id == job.id, Job.state == JobState.queued)
+                .values(state=JobState.running, attempts=Job.attempts + 1, owner=self.owner)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 0:
+                return None
+            job.attempts += 1
+            return job
+
+    async def _requeue(self, job):
+        async with self.db.async_session() as session, session.begin():
+            await session.execute(
+                update(Job)
+                .where(Job.id == job.id, Job.state == JobState.running, Job.owner == self.owner)
+                .values(state=JobState.queued, owner=None)
+            )
+
+    async def _execute(self, job):
+        args = json.loads(job.args)
+        try:
+            # queued by an older version or by hand, they fail the same way every time
+            self.check_job(job.kind, args)
+        except ValueError as e:
+            await self._fail(job, e)
+            return
+        self.progress[job.id] = 0.0
+        try:
+            result = await self.handlers[job.kind](job, args, self._progress_setter(job.id))
+        except Exception as e:
+            await self._fail(job, e)
+        else:
+            await self._finish(job, result)
+        finally:
+            self.progress.pop(job.id, None)
+
+    def _progress_setter(self, job_id):
+        # called from worker threads
+        def set_progress(fraction):
+            self.progress[job_id] = fraction
+        return set_progress
+
+    async def _finish(self, job, result):
+        async with self.db.async_session() as session, session.begin():
+            await session.execute(
+                update(Job)
+                .where(Job.id == job.id)
+                .values(state=JobState.done, progress=1.0, error=None, finished=datetime.now())
+            )
+        for waiter in self.waiters.pop((job.kind, job.media_id, job.args), []):
+            if not waiter.done():
+                waiter.set_result(result)
+
+    async def _fail(self, job, e):
+        error = f"{type(e).__name__}: {e}"
+        # bad arguments fail the same way every time
+        retry = not isinstance(e, ValueError) and job.attempts < self.max_attempts
+        values = {"error": error}
+        if retry:
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            values.update(state=JobState.queued, not_before=datetime.now() + timedelta(seconds=delay))
+            logger.warning(f"Job {job.id} ({job.kind}) failed, retrying in {delay:.0f}s: {error}")
+        else:
+            values.update(state=JobState.failed, finished=datetime.now())
+            logger.error(f"Job {job.id} ({job.kind}) failed: {error}")
+        async with self.db.async_session() as session, session.begin():
+            await session.execute(
+                update(Job)
+                .where(Job.id == job.id)
+                .values(**values)
+            )
+        # waiting callers are not held up by retries
+        for waiter in self.waiters.pop((job.kind, job.media_id, job.args), []):
+            if not waiter.done():
+                waiter.set_exception(JobError(error))
+
+    # ********** Handlers **********
+
+    async def _get_media(self, job):
+        media = await self.media_lookup.get(job.media_id)
+        if media is None:
+            raise ValueError("Media not found")
+        return media
+
+    async def _run_probe(self, job, args, progress):
+        media = await self._get_media(job)
+        media_args, media_probe, _ = await run_sync(self.transcoder.timed)(
+            "ffprobe", "probe", probe_file, media.filename, media.type
+        )
+        async with self.db.async_session() as session, session.begin():
+            if media_args:
+                await self.db.update_objects(session, Media, [{"id": media.id, **media_args}])
+            if media_probe is not None:
+                await self.db.upsert_objects(session, MediaProbe, [{"media_id": media.id, **media_probe}])
+        self.media_lookup.invalidate([media.id])
+        return media_args
+
+    async def _run_thumbnail(self, job, args, progress):
+        # one job per format renders every width
+        media = await self._get_media(job)
+        frame_hash = await run_sync(self.transcoder.ensure_thumbnails)(media, args["format"])
+        if frame_hash is not None:
+            await self._record_frame_hash(media, frame_hash)
+        return args["format"]
+
+    async def _run_dhash(self, job, args, progress):
+        media = await self._get_media(job)
+        frame_hash = await run_sync(self.transcoder.create_frame_hash)(media)
+        if frame_hash is None:
+            raise ValueError("No frame decoded")
+        await self._record_frame_hash(media, frame_hash)
+        return frame_hash
+
+    async def _run_storyboard(self, job, args, progress):
+        media = await self._get_media(job)
+        return await run_sync(self.transcoder.ensure_storyboard)(media, progress)
+
+    async def _run_rendition(self, job, args, progress):
+        media = await self._get_media(job)
+        rendition_dir = await run_sync(self.transcoder.ensure_rendition)(
+            media, args["height"], progress
+        )
+        await self._record_rendition(media, args["height"], rendition_dir)
+        return rendition_dir
+
+    async def _run_remux(self, job, args, progress):
+        media = await self._get_media(job)
+        rendition_dir = await run_sync(self.transcoder.ensure_remux)(media, progress)
+        # accounted as height 0
+        await self._record_rendition(media, 0, rendition_dir)
+        return rendition_dir
+
+    async def _record_rendition(self, media, height, rendition_dir):
+        rendition_size = await run_sync(get_dir_size)(rendition_dir)
+        async with self.db.async_session() as session, session.begin():
+            await self.db.upsert_objects(session, Rendition, [{
+                "media_id": media.id,
+                "height": height,
+                "size": rendition_size,
+                "created": datetime.now(),
+            }])
+
+    async def _record_frame_hash(self, media, frame_hash):
+        async with self.db.async_session() as session, session.begin():
+            await self.db.upsert_objects(session, MediaHash, [{
+                "media_id": media.id,
+                "dhash": frame_hash,
+                "created": datetime.now(),
+            }])
+
+    # ********** Status **********
+
+    async def list_jobs(self, session, state=None, limit=50):
+        query = select(Job).order_by(Job.id.desc()).limit(limit)
+        if state is not None:
+            query = query.where(Job.state == state)
+        jobs = (await session.execute(query)).scalars().all()
+        result = await session.execute(
+            select(Job.state, func.count())
+            .group_by(Job.state)
+        )
+        counts = {job_state.name: count for job_state, count in result.all()}
+        return jobs, counts
+
+    def get_progress(self, job):
+        return self.progress.get(job.id, job.progress)
+
+
+def select_next_job(*columns):
+    # most urgent job that is due, served by the state and priority index
+    return (
+        select(*(columns or (Job,)))
+        .where(Job.state == JobState.queued, Job.not_before <= datetime.now())
+        .order_by(Job.priority, Job.id)
+        .limit(1)
+    )
+
+
+class PrioritySlots():
+
+    def __init__(self, size):
+        self.free = size
+        # (priority, order, future) of callers waiting for a slot
+        self.waiters = []
+        self.order = itertools.count()
+
+    async def acquire(self, priority):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # handed a slot just as the caller gave up
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        # the most urgent waiter still waiting takes the slot over
+        while self.waiters:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.free += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class JobError(Exception):
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
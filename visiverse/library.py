@@ -0,0 +1,514 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import time
+from collections import defaultdict
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+
+from quart.utils import run_sync
+
+from visiverse.cache import LRUCache
+
+from visiverse.database import MediaType
+from visiverse.database import Media
+from visiverse.database import FileSignature
+from visiverse.database import MediaHash
+from visiverse.database import MediaProbe
+from visiverse.database import assoc_media_tag_table
+from visiverse.transcoder import clamp_thumb_seek
+from visiverse.transcoder import probe_media
+from visiverse.transcoder import render_thumbnails
+
+
+logger = logging.getLogger(__name__)
+
+# bytes read from each end of a file for the fast content hash
+HASH_CHUNK_SIZE = 64 * 1024
+
+# What file routes need to know about a media item
+MediaInfo = namedtuple("MediaInfo", [
+    "id", "filename", "type", "duration", "size", "mtime", "mimetype", "probe"
+])
+
+
+class Importer():
+
+    def __init__(self, db, transcoder, jobs, app_config):
+        self.db = db
+        self.transcoder = transcoder
+        self.jobs = jobs
+        self.app_config = app_config
+        self.media_path = app_config["library"]["media_path"]
+        self.workers = app_config.getint("import", "workers")
+        self.batch_size = app_config.getint("import", "batch_size")
+        self.thumbnails = app_config.getboolean("import", "thumbnails")
+        self.storyboards = app_config.getboolean("import", "storyboards")
+        self.content_hash = app_config.getboolean("import", "content_hash")
+        self.hash_backfill = app_config.getboolean("duplicates", "backfill")
+        self.progress = ImportProgress()
+        self.lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self.lock.locked()
+
+    # ********** Library Scanning **********
+
+    def scan(self, paths=None):
+        # filename -> (type, size, mtime), of the whole library or of files and directories in it
+        found = {}
+        for path in (self.media_path,) if paths is None else paths:
+            if not os.path.isdir(path):
+                self.scan_file(found, path)
+                continue
+            for parent_dir, _, filenames in os.walk(path):
+                for filename in filenames:
+                    self.scan_file(found, os.path.join(parent_dir, filename))
+        return found
+
+    def scan_file(self, found, media_filename):
+        media_type = guess_media_type(media_filename)
+        if media_type is None:
+            return
+        try:
+            stat = os.stat(media_filename)
+        except OSError:
+            return
+        found[media_filename] = (media_type, stat.st_size, stat.st_mtime_ns)
+
+    def plan(self, found, indexed):
+        plan = ImportPlan()
+        gone = []
+        for row in indexed:
+            entry = found.pop(row.filename, None)
+            if entry is None:
+                gone.append(row)
+                continue
+            media_type, size, mtime = entry
+            if row.missing:
+                plan.restored.append(row.id)
+            if row.size is None:
+                # imported before signatures were kept
+                plan.signatures.append(self.signature(row.id, row.filename, size, mtime))
+            elif (row.size, row.mtime) != (size, mtime):
+                plan.changed.append(self.pending(row.id, row.filename, media_type, size, mtime))
+            else:
+                plan.unchanged += 1
+        # match remaining files against vanished ones to detect moves
+        gone_by_size = defaultdict(list)
+        for row in gone:
+            if row.size is not None:
+                gone_by_size[row.size].append(row)
+        moved_ids = set()
+        for media_filename, (media_type, size, mtime) in sorted(found.items()):
+            content_hash = self.hash_file(media_filename)
+            match = None
+            for row in gone_by_size[size]:
+                if row.id in moved_ids:
+                    continue
+                if content_hash is not None and row.content_hash is not None:
+                    if content_hash == row.content_hash:
+                        match = row
+                        break
+                elif mtime == row.mtime:
+                    match = row
+                    break
+            if match is None:
+                plan.new.append(self.pending(
+                    uuid4(), media_filename, media_type, size, mtime, content_hash, is_new=True
+                ))
+                continue
+            moved_ids.add(match.id)
+            plan.moved.append({"id": match.id, "filename": media_filename, "missing": False})
+            plan.signatures.append({
+                "media_id": match.id,
+                "size": size,
+                "mtime": mtime,
+                "content_hash": content_hash,
+            })
+        plan.missing = [
+            row.id for row in gone
+            if row.id not in moved_ids and not row.missing
+        ]
+        return plan
+
+    def pending(self, media_id, media_filename, media_type, size, mtime, content_hash=None, is_new=False):
+        if content_hash is None:
+            content_hash = self.hash_file(media_filename)
+        media_args = {
+            "id": media_id,
+            "filename": media_filename,
+            "type": media_type,
+        }
+        # keep titles of existing media
+        if is_new:
+            media_args["title"] = os.path.basename(media_filename)
+        return PendingFile(
+            media_args,
+            {
+                "media_id": media_id,
+                "size": size,
+                "mtime": mtime,
+                "content_hash": content_hash,
+            },
+            is_new,
+        )
+
+    def signature(self, media_id, media_filename, size, mtime):
+        return {
+            "media_id": media_id,
+            "size": size,
+            "mtime": mtime,
+            "content_hash": self.hash_file(media_filename),
+        }
+
+    def hash_file(self, media_filename):
+        if not self.content_hash:
+            return None
+        try:
+            return fast_content_hash(media_filename)
+        except OSError:
+            return None
+
+    # ********** Bulk Import **********
+
+    async def import_library(self, tags=()):
+        if self.running:
+            raise RuntimeError("Import already running")
+        async with self.lock:
+            found = await run_sync(self.scan)()
+            async with self.db.async_session() as session, session.begin():
+                indexed = await self.db.get_file_index(session)
+                # resolve tags once for the whole import
+                tag_names = await self.db.upsert_tags(session, tags)
+            plan = await run_sync(self.plan)(found, indexed)
+            logger.info(f"Scanned '{self.media_path}': {plan}")
+            await self._apply_plan(plan)
+            # media imported before probing was stored
+            async with self.db.async_session() as session:
+                unprobed = await self.db.get_unprobed_media(session)
+            await self.jobs.submit_bulk("probe", unprobed)
+            pending = plan.new + plan.changed
+            self.progress.start(len(pending))
+            try:
+                await self._import_files(pending, tag_names)
+            finally:
+                self.progress.finish()
+            logger.info(f"Import finished: {self.progress}")
+            if self.hash_backfill:
+                # frame hashes of media thumbnailed elsewhere or before hashing
+                async with self.db.async_session() as session:
+                    unhashed = await self.db.get_unhashed_media(session)
+                await self.jobs.submit_bulk("dhash", unhashed)
+            return plan
+
+    async def import_paths(self, filenames, dirnames=(), tags=()):
+        # changes reported by the watcher, only media at or below these paths is touched
+        async with self.lock:
+            found = await run_sync(self.scan)([*filenames, *dirnames])
+            async with self.db.async_session() as session, session.begin():
+                indexed = await self.db.get_file_index(
+                    session, filenames, [os.path.join(dirname, "") for dirname in dirnames]
+                )
+                tag_names = await self.db.upsert_tags(session, tags)
+            plan = await run_sync(self.plan)(found, indexed)
+            if not plan.has_changes:
+                return plan
+            logger.info(f"Changes in '{self.media_path}': {plan}")
+            await self._apply_plan(plan)
+            pending = plan.new + plan.changed
+            if pending:
+                self.progress.start(len(pending))
+                try:
+                    await self._import_files(pending, tag_names)
+                finally:
+                    self.progress.finish()
+            return plan
+
+    async def _apply_plan(self, plan):
+        # changes that need no probing
+        changed_ids = [pending_file.media_args["id"] for pending_file in plan.changed]
+        async with self.db.async_session() as session, session.begin():
+            await self.db.update_objects(session, Media, plan.moved)
+            await self.db.update_objects(session, Media, [
+                {"id": media_id, "missing": False} for media_id in plan.restored
+            ])
+            await self.db.update_objects(session, Media, [
+                {"id": media_id, "missing": True} for media_id in plan.missing
+            ])
+            moved_ids = set(media_args["id"] for media_args in plan.moved)
+            await self.db.update_objects(session, FileSignature, [
+                signature for signature in plan.signatures
+                if signature["media_id"] in moved_ids
+            ])
+            await self.db.insert_objects(session, FileSignature, [
+                signature for signature in plan.signatures
+                if signature["media_id"] not in moved_ids
+            ])
+            await self.db.delete_renditions(session, changed_ids)
+            await self.db.delete_frame_hashes(session, changed_ids)
+        for media_id in changed_ids:
+            self.transcoder.discard_media_cache(media_id)
+
+    async def _import_files(self, pending, tag_names):
+        loop = asyncio.get_running_loop()
+        batch = []
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        in_flight = {}
+        try:
+            # bound the number of files queued on the pool at once
+            queue = iter(pending)
+            while True:
+                for pending_file in queue:
+                    media_args = pending_file.media_args
+                    thumb_filenames = None
+                    if self.thumbnails:
+                        thumb_filenames = {
+                            width: self.transcoder.get_thumb_filename(media_args["id"], width)
+                            for width in self.transcoder.thumb_widths
+                        }
+                    future = loop.run_in_executor(
+                        pool, probe_file, media_args["filename"], media_args["type"], thumb_filenames,
+                        self.transcoder.thumb_seek,
+                    )
+                    in_flight[future] = pending_file
+                    if len(in_flight) >= self.workers * 4:
+                        break
+                if not in_flight:
+                    break
+                done, _ = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    pending_file = in_flight.pop(future)
+                    try:
+                        media_args, pending_file.probe, pending_file.frame_hash = future.result()
+                        pending_file.media_args.update(media_args)
+                        batch.append(pending_file)
+                    except Exception as e:
+                        self.progress.failed += 1
+                        logger.warning(f"Failed to import '{pending_file.media_args['filename']}': {e}")
+                if len(batch) >= self.batch_size:
+                    await self._write_batch(batch, tag_names)
+                    batch = []
+        finally:
+            # a cancelled or failed import must not wait on the event loop for running ffmpeg processes
+            for future in in_flight:
+                future.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+        await self._write_batch(batch, tag_names)
+
+    async def _write_batch(self, batch, tag_names):
+        if not batch:
+            return
+        new_files = [f for f in batch if f.is_new]
+        changed_files = [f for f in batch if not f.is_new]
+        async with self.db.async_session() as session, session.begin():
+            await self.db.insert_objects(session, Media, [
+                f.media_args for f in new_files
+            ])
+            await self.db.insert_objects(session, FileSignature, [
+                f.signature for f in new_files
+            ])
+            await self.db.insert_associations(session, assoc_media_tag_table, [
+                {"media_id": f.media_args["id"], "tag_name": tag_name}
+                for f in new_files
+                for tag_name in tag_names
+            ])
+            await self.db.update_objects(session, Media, [
+                f.media_args for f in changed_files
+            ])
+            await self.db.update_objects(session, FileSignature, [
+                f.signature for f in changed_files
+            ])
+            await self.db.upsert_objects(session, MediaProbe, [
+                {"media_id": f.media_args["id"], **f.probe}
+                for f in batch if f.probe is not None
+            ])
+            await self.db.upsert_objects(session, MediaHash, [
+                {"media_id": f.media_args["id"], "dhash": f.frame_hash, "created": datetime.now()}
+                for f in batch if f.frame_hash is not None
+            ])
+        if self.storyboards:
+            # generated by the job workers once the import is out of the way
+            await self.jobs.submit_bulk("storyboard", [
+                f.media_args["id"] for f in batch
+                if MediaType.video == f.media_args.get("type") and f.media_args.get("duration")
+            ])
+        self.progress.done += len(batch)
+        logger.info(f"Imported {self.progress}")
+
+
+class MediaLookup():
+
+    def __init__(self, db, app_config):
+        self.db = db
+        self.cache = LRUCache(
+            app_config.getint("cache", "media_size"),
+            app_config.getfloat("cache", "media_ttl"),
+        )
+        db.on_media_changed(self.invalidate)
+
+    async def get(self, media_uuid):
+        media_info = self.cache.get(media_uuid)
+        if media_info is not None:
+            return media_info
+        async with self.db.read_session() as session:
+            media = await self.db.select_object(session, Media, media_uuid)
+            media_probe = await session.get(MediaProbe, media_uuid)
+        if media is None:
+            return None
+        media_info = await run_sync(get_media_info)(media, media_probe)
+        self.cache.set(media_uuid, media_info)
+        return media_info
+
+    def invalidate(self, media_ids=None):
+        if media_ids is None:
+            self.cache.clear()
+            return
+        for media_id in media_ids:
+            self.cache.discard(media_id)
+
+
+class PendingFile():
+
+    def __init__(self, media_args, signature, is_new):
+        self.media_args = media_args
+        self.signature = signature
+        self.is_new = is_new
+        # filled in by probe_file
+        self.probe = None
+        self.frame_hash = None
+
+
+class ImportPlan():
+
+    def __init__(self):
+        self.new = []
+        self.changed = []
+        self.moved = []
+        self.restored = []
+        self.missing = []
+        self.signatures = []
+        self.unchanged = 0
+
+    @property
+    def has_changes(self):
+        return any((self.new, self.changed, self.moved, self.restored, self.missing, self.signatures))
+
+    def to_dict(self):
+        return {
+            "new": len(self.new),
+            "changed": len(self.changed),
+            "moved": len(self.moved),
+            "restored": len(self.restored),
+            "missing": len(self.missing),
+            "unchanged": self.unchanged,
+        }
+
+    def __repr__(self) -> str:
+        return ", ".join(f"{count} {name}" for name, count in self.to_dict().items())
+
+
+class ImportProgress():
+
+    def __init__(self):
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+    def start(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return (self.done + self.failed) / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            "running": self.started is not None and self.finished is None,
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "elapsed": round(self.elapsed, 3),
+            "files_per_sec": round(self.rate, 2),
+        }
+
+    def __repr__(self) -> str:
+        return f"{self.done}/{self.total} files, {self.failed} failed ({self.rate:.1f} files/sec)"
+
+
+# Runs in a worker process
+def probe_file(media_filename, media_type, thumb_filenames=None, thumb_seek=5):
+    # returns media columns, the stored probe and the thumbnail frame hash
+    media_args = {}
+    if media_type not in (MediaType.video, MediaType.audio):
+        return media_args, None, None
+    media_probe = probe_media(media_filename)
+    frame_hash = None
+    if MediaType.video == media_type:
+        if media_probe["duration"] is not None:
+            media_args["duration"] = int(round(media_probe["duration"]))
+        if thumb_filenames is not None and media_probe["video_codec"] is not None:
+            # the same frame a thumbnail job picks, so the stored hash matches the dhash backfill
+            frame_hash = render_thumbnails(
+                media_filename, thumb_filenames, seek=clamp_thumb_seek(thumb_seek, media_probe["duration"]),
+            )
+    return media_args, media_probe, frame_hash
+
+# Hashes the size and both ends of a file, cheap enough for large videos
+def fast_content_hash(filename):
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as media_file:
+        size = os.fstat(media_file.fileno()).st_size
+        content_hash.update(size.to_bytes(8, "little"))
+        content_hash.update(media_file.read(HASH_CHUNK_SIZE))
+        if size > HASH_CHUNK_SIZE:
+            media_file.seek(max(HASH_CHUNK_SIZE, size - HASH_CHUNK_SIZE))
+            content_hash.update(media_file.read(HASH_CHUNK_SIZE))
+    return content_hash.hexdigest()
+
+def get_media_info(media, media_probe=None):
+    try:
+        stat = os.stat(media.filename)
+        size, mtime = stat.st_size, stat.st_mtime
+    except OSError:
+        size, mtime = None, None
+    mimetype, _ = mimetypes.guess_type(media.filename)
+    # the exact duration keeps the last segment from running past the end
+    duration = media.duration
+    if media_probe is not None and media_probe.duration is not None:
+        duration = media_probe.duration
+    return MediaInfo(
+        media.id, media.filename, media.type, duration, size, mtime, mimetype, media_probe
+    )
+
+def guess_media_type(filename):
+    mime_type, _ = mimetypes.guess_type(filename)
+    if mime_type is None:
+        return None
+    try:
+        return MediaType[mime_type.split("/")[0]]
+    except KeyError:
+        return None
@@ -0,0 +1,279 @@
+import contextlib
+import logging
+import re
+import threading
+import time
+from functools import lru_cache
+
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROCESS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# Operation and main table of a statement, for labels of bounded cardinality
+STATEMENT_PATTERN = re.compile(
+    r"^\s*(\w+)(?:.*?\b(?:FROM|INTO|UPDATE|TABLE|TRIGGER|INDEX)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?[\"`]?(\w+))?",
+    re.IGNORECASE | re.DOTALL,
+)
+KNOWN_OPERATIONS = {"select", "insert", "update", "delete", "create", "drop", "pragma", "with"}
+
+# LRUCache stats key, metric name and type
+CACHE_METRICS = (
+    ("size", "visiverse_cache_size", "gauge"),
+    ("hits", "visiverse_cache_hits_total", "counter"),
+    ("misses", "visiverse_cache_misses_total", "counter"),
+    ("evictions", "visiverse_cache_evictions_total", "counter"),
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metrics():
+
+    def __init__(self, app_config):
+        self.slow_query = app_config.getfloat("metrics", "slow_query")
+        self.public = app_config.getboolean("metrics", "public")
+        self.request_duration = Histogram(
+            "visiverse_http_request_duration_seconds",
+            "Time to produce response headers, by route",
+            ("method", "route", "status"),
+            LATENCY_BUCKETS,
+        )
+        self.requests_in_flight = Gauge(
+            "visiverse_http_requests_in_flight",
+            "Requests currently being handled, by route",
+            ("route",),
+        )
+        self.query_duration = Histogram(
+            "visiverse_db_query_duration_seconds",
+            "SQL statement execution time",
+            ("operation", "table"),
+            LATENCY_BUCKETS,
+        )
+        self.slow_queries = Counter(
+            "visiverse_db_slow_queries_total",
+            "SQL statements slower than the slow query threshold",
+            ("operation", "table"),
+        )
+        self.process_duration = Histogram(
+            "visiverse_process_duration_seconds",
+            "Wall time of ffmpeg and ffprobe runs",
+            ("tool", "task"),
+            PROCESS_BUCKETS,
+        )
+        self.process_runs = Counter(
+            "visiverse_process_runs_total",
+            "ffmpeg and ffprobe runs by exit status",
+            ("tool", "task", "status"),
+        )
+        self.metrics = [
+            self.request_duration,
+            self.requests_in_flight,
+            self.query_duration,
+            self.slow_queries,
+            self.process_duration,
+            self.process_runs,
+        ]
+        # name -> (description, type, callback returning [(labels, value)])
+        self.collectors = {}
+        # name -> LRUCache
+        self.caches = {}
+
+    # ********** Requests **********
+
+    def start_request(self, route):
+        self.requests_in_flight.inc((route,))
+        return time.perf_counter()
+
+    def finish_request(self, method, route, status, started):
+        self.request_duration.observe((method, route, str(status)), time.perf_counter() - started)
+
+    def end_request(self, route):
+        self.requests_in_flight.dec((route,))
+
+    # ********** Database **********
+
+    def instrument_engine(self, engine):
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(sync_engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        labels = parse_statement(statement)
+        self.query_duration.observe(labels, elapsed)
+        if elapsed >= self.slow_query:
+            self.slow_queries.inc(labels)
+            logger.warning(f"Slow query ({elapsed * 1000:.1f} ms): {statement}")
+            # parameters carry user data such as password hashes, only for debugging
+            if logger.isEnabledFor(logging.DEBUG):
+                if executemany:
+                    parameters = f"{len(parameters)} rows, first {parameters[:1]}"
+                logger.debug(f"Slow query parameters: {format_parameters(parameters)}")
+
+    def _handle_error(self, exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_started"):
+            conn.info["query_started"].pop()
+
+    # ********** External Processes **********
+
+    @contextlib.contextmanager
+    def time_process(self, tool, task):
+        started = time.perf_counter()
+        status = "0"
+        try:
+            yield
+        except Exception as e:
+            # exit status when the process ran, the error type otherwise
+            status = str(getattr(e, "returncode", None) or type(e).__name__)
+            raise
+        finally:
+            self.process_duration.observe((tool, task), time.perf_counter() - started)
+            self.process_runs.inc((tool, task, status))
+
+    # ********** Collected Values **********
+
+    def add_collector(self, name, description, metric_type, callback):
+        self.collectors[name] = (description, metric_type, callback)
+
+    def add_cache(self, cache_name, cache):
+        self.caches[cache_name] = cache
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for name, (description, metric_type, callback) in self.collectors.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+            for labels, value in callback():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        # one metric per LRUCache stat, labelled by cache
+        cache_stats = {cache_name: cache.stats() for cache_name, cache in self.caches.items()}
+        for key, name, metric_type in CACHE_METRICS:
+            lines += [f"# HELP {name} LRU cache {key}", f"# TYPE {name} {metric_type}"]
+            for cache_name, stats in cache_stats.items():
+                lines.append(f"{name}{format_labels({'cache': cache_name})} {format_value(stats[key])}")
+        return "\n".join(lines) + "\n"
+
+
+class Metric():
+
+    metric_type = None
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        # label values -> value
+        self.values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{format_labels(self._labels(label_values))} {format_value(value)}")
+        return lines
+
+    def _labels(self, label_values):
+        return dict(zip(self.label_names, label_values))
+
+
+class Counter(Metric):
+
+    metric_type = "counter"
+
+    def inc(self, label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+
+    metric_type = "gauge"
+
+    def inc(self, label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, label_values, amount=1):
+        self.inc(label_values, -amount)
+
+
+class Histogram(Metric):
+
+    metric_type = "histogram"
+
+    def __init__(self, name, description, label_names, buckets):
+        super().__init__(name, description, label_names)
+        self.buckets = buckets
+
+    def observe(self, label_values, value):
+        with self.lock:
+            # per-bucket counts, made cumulative when rendered
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            values = sorted((label_values, list(counts)) for label_values, counts in self.values.items())
+        for label_values, counts in values:
+            labels = self._labels(label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = {**labels, "le": str(bound)}
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+@lru_cache(maxsize=1024)
+def parse_statement(statement):
+    match = STATEMENT_PATTERN.match(statement)
+    if match is None:
+        return "other", ""
+    operation = match.group(1).lower()
+    if operation not in KNOWN_OPERATIONS:
+        operation = "other"
+    return operation, (match.group(2) or "").lower()
+
+def format_parameters(parameters, max_length=500):
+    text = repr(parameters)
+    if len(text) > max_length:
+        text = text[:max_length] + "..."
+    return text
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape_label(str(value))}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
@@ -0,0 +1,220 @@
+import logging
+import re
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import bindparam
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy import text
+
+from visiverse.database import MEDIA_LIST_COLUMNS
+from visiverse.database import Media
+from visiverse.facets import build_filters
+from visiverse.jobs import select_next_job
+from visiverse.playlists import CollectionStore
+from visiverse.playlists import POSITION_STEP
+
+
+logger = logging.getLogger(__name__)
+
+# Kept apart from Base so create_all never touches it
+schema_migrations_table = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String, nullable=False),
+    Column("applied", DateTime, nullable=False),
+)
+
+# Plan lines of a full table scan, worded "SCAN TABLE x" before SQLite 3.36
+FULL_SCAN_PATTERN = re.compile(r"^SCAN (?:TABLE )?(\w+)$")
+SORT_PATTERN = re.compile(r"^USE TEMP B-TREE FOR (?:RIGHT PART OF )?ORDER BY")
+
+
+class Migrator():
+
+    def __init__(self, db):
+        self.db = db
+
+    async def begin(self):
+        async with self.db.engine.begin() as conn:
+            await conn.run_sync(schema_migrations_table.create, checkfirst=True)
+            result = await conn.execute(select(schema_migrations_table.c.version))
+            applied = set(result.scalars())
+        for version, name, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            # each migration commits on its own, a failure leaves the earlier ones applied
+            async with self.db.engine.begin() as conn:
+                await conn.run_sync(migration)
+                await conn.execute(insert(schema_migrations_table).values(
+                    version=version, name=name, applied=datetime.now()
+                ))
+            logger.info(f"Applied schema migration {version}: {name}")
+
+    async def get_version(self):
+        async with self.db.engine.connect() as conn:
+            result = await conn.execute(
+                select(schema_migrations_table.c.version)
+                .order_by(schema_migrations_table.c.version.desc())
+                .limit(1)
+            )
+            return result.scalar() or 0
+
+    # ********** Query Plans **********
+
+    async def check_query_plans(self):
+        # (query name, statement, plan, problems) for every statement the hot queries run
+        if self.db.engine.dialect.name != "sqlite":
+            raise ValueError("Query plans can only be checked on SQLite")
+        reports = []
+        async with self.db.async_session() as session:
+            conn = await session.connection()
+            for name, run_query, allowed_scans in HOT_QUERIES:
+                statements = []
+                def capture(conn, cursor, statement, parameters, context, executemany):
+                    statements.append((statement, parameters))
+                event.listen(self.db.engine.sync_engine, "before_cursor_execute", capture)
+                try:
+                    await run_query(self.db, session)
+                finally:
+                    event.remove(self.db.engine.sync_engine, "before_cursor_execute", capture)
+                for statement, parameters in statements:
+                    result = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                    plan = [row[-1] for row in result.all()]
+                    reports.append((name, statement, plan, find_plan_problems(plan, allowed_scans)))
+        return reports
+
+
+# ********** Migrations **********
+
+def has_column(conn, table_name, column_name):
+    return any(column["name"] == column_name for column in inspect(conn).get_columns(table_name))
+
+def add_media_missing(conn):
+    # created by create_all on libraries newer than the column
+    if not has_column(conn, "media", "missing"):
+        conn.execute(text("ALTER TABLE media ADD COLUMN missing BOOLEAN NOT NULL DEFAULT FALSE"))
+
+def add_media_created(conn):
+    if not has_column(conn, "media", "created"):
+        # added nullable, SQLite only adds columns with constant defaults
+        conn.execute(text("ALTER TABLE media ADD COLUMN created DATETIME"))
+        conn.execute(
+            text("UPDATE media SET created = :now WHERE created IS NULL")
+            .bindparams(bindparam("now", datetime.now(), type_=DateTime))
+        )
+
+def add_collection_positions(conn):
+    if not has_column(conn, "assoc_media_collection", "position"):
+        conn.execute(text("ALTER TABLE assoc_media_collection ADD COLUMN position INTEGER NOT NULL DEFAULT 0"))
+        # existing members play in the order they joined the library
+        rows = conn.execute(text(
+            "SELECT a.collection_id, a.media_id FROM assoc_media_collection a "
+            "JOIN media m ON m.id = a.media_id ORDER BY a.collection_id, m.created, a.media_id"
+        )).all()
+        positions = []
+        index, last_collection = 0, None
+        for collection_id, media_id in rows:
+            index = index + 1 if collection_id == last_collection else 1
+            last_collection = collection_id
+            positions.append({"collection_id": collection_id, "media_id": media_id, "position": index * POSITION_STEP})
+        if positions:
+            conn.execute(text(
+                "UPDATE assoc_media_collection SET position = :position "
+                "WHERE collection_id = :collection_id AND media_id = :media_id"
+            ), positions)
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_assoc_media_collection_position "
+        "ON assoc_media_collection (collection_id, position, media_id)"
+    ))
+
+def add_job_owners(conn):
+    if not has_column(conn, "jobs", "owner"):
+        conn.execute(text("ALTER TABLE jobs ADD COLUMN owner VARCHAR"))
+
+def create_indexes(*statements):
+    def migration(conn):
+        for statement in statements:
+            conn.execute(text(statement))
+    return migration
+
+# (version, name, function given a connection), append only
+MIGRATIONS = [
+    (1, "media missing flag", add_media_missing),
+    (2, "media created time", add_media_created),
+    (3, "reverse association indexes", create_indexes(
+        "CREATE INDEX IF NOT EXISTS ix_assoc_media_tag_tag ON assoc_media_tag (tag_name, media_id)",
+        "CREATE INDEX IF NOT EXISTS ix_assoc_media_person_person ON assoc_media_person (person_id, media_id)",
+        "CREATE INDEX IF NOT EXISTS ix_assoc_media_organization_organization ON assoc_media_organization (organization_id, media_id)",
+        "CREATE INDEX IF NOT EXISTS ix_assoc_media_collection_collection ON assoc_media_collection (collection_id, media_id)",
+    )),
+    (4, "media sort indexes", create_indexes(
+        "CREATE INDEX IF NOT EXISTS ix_media_missing_created ON media (missing, created, id)",
+        "CREATE INDEX IF NOT EXISTS ix_media_title ON media (title)",
+    )),
+    (5, "job queue index", create_indexes(
+        "CREATE INDEX IF NOT EXISTS ix_jobs_state_priority ON jobs (state, priority, id)",
+        "CREATE INDEX IF NOT EXISTS ix_jobs_media ON jobs (media_id, kind)",
+    )),
+    (6, "collection positions", add_collection_positions),
+    (7, "job owners", add_job_owners),
+]
+
+
+# ********** Hot Queries **********
+
+# (name, coroutine function given the database and a session, tables it may scan in full)
+HOT_QUERIES = [
+    ("media page", lambda db, session: db.select_media_page(
+        session, None, 48, columns=MEDIA_LIST_COLUMNS
+    ), ()),
+    ("media page after cursor", lambda db, session: db.select_media_page(
+        session, (datetime.now(), uuid4()), 48, columns=MEDIA_LIST_COLUMNS
+    ), ()),
+    ("media page by tag", lambda db, session: db.select_media_page(
+        session, None, 48, columns=MEDIA_LIST_COLUMNS, where=build_filters([("tag", "tag")])
+    ), ()),
+    ("media page by person", lambda db, session: db.select_media_page(
+        session, None, 48, columns=MEDIA_LIST_COLUMNS, where=build_filters([("person", uuid4())])
+    ), ()),
+    ("media page by organization", lambda db, session: db.select_media_page(
+        session, None, 48, columns=MEDIA_LIST_COLUMNS, where=build_filters([("organization", uuid4())])
+    ), ()),
+    ("media by id", lambda db, session: db.select_object(session, Media, uuid4()), ()),
+    ("user by name", lambda db, session: db.get_user(session, "admin"), ()),
+    ("renditions of media", lambda db, session: db.delete_renditions(session, [uuid4()]), ()),
+    # reads every media row by design
+    ("file index", lambda db, session: db.get_file_index(session), ("media",)),
+    ("unprobed media", lambda db, session: db.get_unprobed_media(session), ("media",)),
+    ("next job", lambda db, session: session.execute(select_next_job()), ()),
+    ("collection members", lambda db, session: CollectionStore(db).select_members(
+        session, uuid4(), None, 48, MEDIA_LIST_COLUMNS
+    ), ()),
+    ("collection members after cursor", lambda db, session: CollectionStore(db).select_members(
+        session, uuid4(), (POSITION_STEP, uuid4()), 48, MEDIA_LIST_COLUMNS
+    ), ()),
+    ("previous in collection", lambda db, session: CollectionStore(db).select_previous(
+        session, uuid4(), (POSITION_STEP, uuid4()), MEDIA_LIST_COLUMNS
+    ), ()),
+]
+
+
+def find_plan_problems(plan, allowed_scans=()):
+    problems = []
+    for detail in plan:
+        match = FULL_SCAN_PATTERN.match(detail)
+        if match is not None and match.group(1) not in allowed_scans:
+            problems.append(f"full scan of {match.group(1)}")
+        elif SORT_PATTERN.match(detail):
+            problems.append("sort without an index")
+    return problems
@@ -0,0 +1,324 @@
+import logging
+import os
+
+from quart.utils import run_sync
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import update
+
+from visiverse.cache import LRUCache
+from visiverse.database import Collection
+from visiverse.database import Media
+from visiverse.database import MediaType
+from visiverse.database import assoc_media_collection_table
+from visiverse.database import build_columns
+from visiverse.jobs import PRIORITY_DEFAULT
+from visiverse.transcoder import PLAY_DIRECT
+from visiverse.transcoder import PLAY_REMUX
+from visiverse.transcoder import SOURCE_RENDITION
+
+
+logger = logging.getLogger(__name__)
+
+# spacing of member positions, a move only rewrites its own row until a gap runs out
+POSITION_STEP = 1 << 16
+
+# bytes at the end of a direct-play file, where players look for the index of an mp4
+TAIL_BYTES = 1024 ** 2
+
+members = assoc_media_collection_table
+
+
+class CollectionStore():
+
+    def __init__(self, db):
+        self.db = db
+
+    # ********** Queries **********
+
+    async def select_collections(self, session, limit=50, offset=0):
+        # one extra row tells whether another page exists
+        result = await session.execute(
+            select(Collection)
+            .order_by(Collection.name, Collection.id)
+            .limit(limit + 1)
+            .offset(offset)
+        )
+        collections = result.scalars().all()
+        return collections[:limit], len(collections) > limit
+
+    async def count_members(self, session, collection_id):
+        result = await session.execute(
+            select(func.count())
+            .select_from(members)
+            .join(Media, Media.id == members.c.media_id)
+            .where(members.c.collection_id == collection_id, Media.missing.is_(False))
+        )
+        return result.scalar()
+
+    async def select_members(self, session, collection_id, cursor=None, limit=50, columns=None):
+        # keyset pagination in playback order
+        columns = tuple(columns or ()) + tuple(c for c in ("id",) if c not in (columns or ()))
+        query = (
+            select(members.c.position, *build_columns(Media, columns))
+            .join(Media, Media.id == members.c.media_id)
+            .where(members.c.collection_id == collection_id, Media.missing.is_(False))
+            .order_by(members.c.position, members.c.media_id)
+            .limit(limit + 1)
+        )
+        if cursor is not None:
+            position, media_id = cursor
+            query = query.where(or_(
+                members.c.position > position,
+                and_(members.c.position == position, members.c.media_id > media_id),
+            ))
+        rows = (await session.execute(query)).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1].position, rows[-1].id)
+        return rows, next_cursor
+
+    async def select_neighbors(self, session, collection_id, media_id, count=1, columns=None):
+        # (previous row, next rows) around a member, None when it is not one
+        position = await self._get_position(session, collection_id, media_id)
+        if position is None:
+            return None
+        previous = await self.select_previous(session, collection_id, (position, media_id), columns)
+        next_rows, _ = await self.select_members(session, collection_id, (position, media_id), count, columns)
+        return previous, next_rows
+
+    async def select_previous(self, session, collection_id, cursor, columns=None):
+        position, media_id = cursor
+        columns = tuple(columns or ()) + tuple(c for c in ("id",) if c not in (columns or ()))
+        result = await session.execute(
+            select(members.c.position, *build_columns(Media, columns))
+            .join(Media, Media.id == members.c.media_id)
+            .where(members.c.collection_id == collection_id, Media.missing.is_(False))
+            .where(or_(
+                members.c.position < position,
+                and_(members.c.position == position, members.c.media_id < media_id),
+            ))
+            .order_by(members.c.position.desc(), members.c.media_id.desc())
+            .limit(1)
+        )
+        return result.first()
+
+    async def _get_position(self, session, collection_id, media_id):
+        result = await session.execute(
+            select(members.c.position)
+            .where(members.c.collection_id == collection_id, members.c.media_id == media_id)
+        )
+        return result.scalar()
+
+    # ********** Changes **********
+
+    async def add_members(self, session, collection_id, media_ids, after=None, before=None):
+        # new members in the given order, at the end unless placed next to a member
+        media_ids = list(dict.fromkeys(media_ids))
+        found = set((await session.execute(
+            select(Media.id).where(Media.id.in_(media_ids))
+        )).scalars())
+        unknown = [media_id for media_id in media_ids if media_id not in found]
+        if unknown:
+            raise ValueError(f"Unknown media {', '.join(str(media_id) for media_id in unknown)}")
+        existing = set((await session.execute(
+            select(members.c.media_id)
+            .where(members.c.collection_id == collection_id, members.c.media_id.in_(media_ids))
+        )).scalars())
+        media_ids = [media_id for media_id in media_ids if media_id not in existing]
+        if not media_ids:
+            return []
+        positions = await self._place(session, collection_id, len(media_ids), after, before)
+        # media_id in every row, the search index picks up the new collection names
+        await self.db.insert_associations(session, members, [
+            {"collection_id": collection_id, "media_id": media_id, "position": position}
+            for media_id, position in zip(media_ids, positions)
+        ])
+        return media_ids
+
+    async def remove_members(self, session, collection_id, media_ids):
+        media_ids = list(dict.fromkeys(media_ids))
+        if media_ids:
+            await session.execute(
+                delete(members)
+                .where(members.c.collection_id == bindparam("collection_id"))
+                .where(members.c.media_id == bindparam("media_id")),
+                [{"collection_id": collection_id, "media_id": media_id} for media_id in media_ids],
+            )
+
+    async def move_member(self, session, collection_id, media_id, after=None, before=None):
+        if await self._get_position(session, collection_id, media_id) is None:
+            raise ValueError(f"Media {media_id} is not in the collection")
+        if media_id in (after, before):
+            raise ValueError("Media cannot be moved next to itself")
+        position, = await self._place(session, collection_id, 1, after, before, moving=media_id)
+        await self._set_positions(session, collection_id, [(media_id, position)])
+
+    async def delete_collection(self, session, collection_id):
+        result = await session.execute(
+            select(members.c.media_id).where(members.c.collection_id == collection_id)
+        )
+        await self.remove_members(session, collection_id, result.scalars().all())
+        await session.execute(delete(Collection).where(Collection.id == collection_id))
+
+    async def renumber(self, session, collection_id):
+        result = await session.execute(
+            select(members.c.media_id)
+            .where(members.c.collection_id == collection_id)
+            .order_by(members.c.position, members.c.media_id)
+        )
+        await self._set_positions(session, collection_id, [
+            (media_id, (index + 1) * POSITION_STEP) for index, media_id in enumerate(result.scalars())
+        ])
+
+    async def _place(self, session, collection_id, count, after, before, moving=None):
+        # positions for count members between the anchor and its neighbor, renumbering once when full
+        for attempt in range(2):
+            low, high = await self._find_gap(session, collection_id, after, before, moving)
+            if high is None:
+                start = low if low is not None else 0
+                return [start + (index + 1) * POSITION_STEP for index in range(count)]
+            if low is None:
+                return [high - (count - index) * POSITION_STEP for index in range(count)]
+            if high - low > count:
+                return [low + (high - low) * (index + 1) // (count + 1) for index in range(count)]
+            await self.renumber(session, collection_id)
+        raise ValueError("No room between members")
+
+    async def _find_gap(self, session, collection_id, after, before, moving):
+        # (position below, position above) the new members, None for either end
+        if after is not None and before is not None:
+            raise ValueError("Give either after or before")
+        others = [members.c.collection_id == collection_id]
+        if moving is not None:
+            others.append(members.c.media_id != moving)
+        if after is None and before is None:
+            result = await session.execute(select(func.max(members.c.position)).where(*others))
+            return result.scalar(), None
+        anchor = after if after is not None else before
+        position = await self._get_position(session, collection_id, anchor)
+        if position is None:
+            raise ValueError(f"Media {anchor} is not in the collection")
+        if after is not None:
+            result = await session.execute(
+                select(func.min(members.c.position))
+                .where(*others, or_(
+                    members.c.position > position,
+                    and_(members.c.position == position, members.c.media_id > anchor),
+                ))
+            )
+            return position, result.scalar()
+        result = await session.execute(
+            select(func.max(members.c.position))
+            .where(*others, or_(
+                members.c.position < position,
+                and_(members.c.position == position, members.c.media_id < anchor),
+            ))
+        )
+        return result.scalar(), position
+
+    async def _set_positions(self, session, collection_id, positions):
+        # not named media_id, reordering leaves the search index alone
+        if positions:
+            await session.execute(
+                update(members)
+                .where(members.c.collection_id == bindparam("member_collection"))
+                .where(members.c.media_id == bindparam("member_id"))
+                .values(position=bindparam("member_position"))
+                .execution_options(synchronize_session=False),
+                [
+                    {"member_collection": collection_id, "member_id": media_id, "member_position": position}
+                    for media_id, position in positions
+                ],
+            )
+
+
+class Prefetcher():
+
+    def __init__(self, transcoder, jobs, media_lookup, app_config):
+        self.transcoder = transcoder
+        self.jobs = jobs
+        self.media_lookup = media_lookup
+        playback_config = app_config["playback"]
+        self.items = playback_config.getint("prefetch_items")
+        self.segments = playback_config.getint("prefetch_segments")
+        self.file_bytes = playback_config.getint("prefetch_bytes")
+        # media warmed lately are skipped until they age out
+        self.recent = LRUCache(1000, playback_config.getfloat("prefetch_ttl"))
+        self.warmed = 0
+
+    async def warm(self, media_ids):
+        # one item at a time, behind interactive requests for ffmpeg slots
+        for media_id in media_ids[:self.items]:
+            if self.recent.get(media_id) is not None:
+                continue
+            self.recent.set(media_id, True)
+            self.warmed += 1
+            try:
+                await self._warm_media(media_id)
+            except Exception as e:
+                logger.warning(f"Prefetching {media_id} failed: {type(e).__name__}: {e}")
+
+    async def _warm_media(self, media_id):
+        # lookup and probe data, then what the first seconds of playback need
+        media = await self.media_lookup.get(media_id)
+        if media is None:
+            return
+        await run_sync(read_ahead)(media.filename, 0, self.file_bytes)
+        if media.probe is None or media.duration is None:
+            # playback needs the probe first, the next play warms the rest
+            if MediaType.image != media.type:
+                await self.jobs.submit("probe", media_id, PRIORITY_DEFAULT)
+                self.recent.discard(media_id)
+            return
+        if MediaType.video == media.type and media.probe.video_codec is not None:
+            thumb_format = self.transcoder.thumb_formats[0]
+            thumb_width = self.transcoder.get_thumb_width()
+            if not os.path.isfile(self.transcoder.get_thumb_filename(media_id, thumb_width, thumb_format)):
+                await self.jobs.submit("thumbnail", media_id, PRIORITY_DEFAULT, format=thumb_format)
+        play_mode = self.transcoder.get_play_mode(media)
+        if play_mode == PLAY_DIRECT:
+            await run_sync(read_ahead)(media.filename, -TAIL_BYTES, TAIL_BYTES)
+            return
+        if play_mode == PLAY_REMUX and not self.transcoder.has_rendition(media_id, SOURCE_RENDITION):
+            await self.jobs.submit_unless_failed("remux", media_id, PRIORITY_DEFAULT)
+        # players start on the first variant of the master playlist
+        ladder = self.transcoder.get_ladder(media)
+        await self._warm_rendition(media, ladder[0].height if ladder else SOURCE_RENDITION)
+
+    async def _warm_rendition(self, media, height):
+        if self.transcoder.has_rendition(media.id, height):
+            rendition_dir = self.transcoder.get_rendition_dir(media.id, height)
+            filenames = ["index.m3u8", "init.mp4"] + [f"{index}.m4s" for index in range(self.segments)]
+            for filename in filenames:
+                await run_sync(read_ahead)(f"{rendition_dir}/{filename}", 0, self.file_bytes)
+            return
+        if height == SOURCE_RENDITION:
+            return
+        segment_count = self.transcoder.get_segment_count(media)
+        for index in range(min(self.segments, segment_count)):
+            await self.jobs.ensure_segment(media, index, PRIORITY_DEFAULT, height)
+
+
+def read_ahead(filename, offset, length):
+    # asks the kernel to read into the page cache without copying anything here
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        if offset < 0:
+            offset = max(0, os.fstat(fd).st_size + offset)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+        else:
+            # reading is the only way to fill the cache elsewhere
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.read(fd, length)
+    finally:
+        os.close(fd)
@@ -0,0 +1,253 @@
+import logging
+import re
+from uuid import UUID
+
+from sqlalchemy import bindparam
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import text
+
+from visiverse.database import Collection
+from visiverse.database import Media
+from visiverse.database import Organization
+from visiverse.database import Person
+from visiverse.database import Tag
+from visiverse.database import assoc_media_collection_table
+from visiverse.database import assoc_media_organization_table
+from visiverse.database import assoc_media_person_table
+from visiverse.database import assoc_media_tag_table
+from visiverse.database import build_columns
+from visiverse.database import MEDIA_LIST_COLUMNS
+
+
+logger = logging.getLogger(__name__)
+
+# Association tables feeding the index, keyed by the object they link
+LINKED_TABLES = {
+    Tag: (assoc_media_tag_table, "tag_name", "name"),
+    Person: (assoc_media_person_table, "person_id", "id"),
+    Organization: (assoc_media_organization_table, "organization_id", "id"),
+    Collection: (assoc_media_collection_table, "collection_id", "id"),
+}
+ASSOC_TABLE_NAMES = set(table.name for table, _, _ in LINKED_TABLES.values())
+
+# Column weights for bm25(), in index column order
+RANK_WEIGHTS = (10.0, 2.0, 4.0, 6.0, 6.0, 3.0)
+
+REINDEX_BATCH_SIZE = 500
+
+SCHEMA = [
+    # stable integer rowids for the FTS table, so updates never scan it
+    """CREATE TABLE IF NOT EXISTS media_search_docs (
+        docid INTEGER PRIMARY KEY,
+        media_id CHAR(32) NOT NULL UNIQUE
+    )""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(
+        title, description, tags, people, organizations, collections,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )""",
+]
+
+DELETE_DOCS = text(
+    "DELETE FROM media_fts WHERE rowid IN "
+    "(SELECT docid FROM media_search_docs WHERE media_id IN :media_ids)"
+).bindparams(bindparam("media_ids", expanding=True))
+
+INSERT_DOC_IDS = text(
+    "INSERT OR IGNORE INTO media_search_docs (media_id) "
+    "SELECT id FROM media WHERE id IN :media_ids"
+).bindparams(bindparam("media_ids", expanding=True))
+
+DELETE_DOC_IDS = text(
+    "DELETE FROM media_search_docs WHERE media_id IN :media_ids "
+    "AND media_id NOT IN (SELECT id FROM media WHERE id IN :media_ids)"
+).bindparams(bindparam("media_ids", expanding=True))
+
+INSERT_DOCS = text(
+    """INSERT INTO media_fts (rowid, title, description, tags, people, organizations, collections)
+    SELECT d.docid, m.title, coalesce(m.description, ''),
+        coalesce((SELECT group_concat(a.tag_name, ' ') FROM assoc_media_tag a
+            WHERE a.media_id = m.id), ''),
+        coalesce((SELECT group_concat(p.name, ' ') FROM assoc_media_person a
+            JOIN people p ON p.id = a.person_id WHERE a.media_id = m.id), ''),
+        coalesce((SELECT group_concat(o.name, ' ') FROM assoc_media_organization a
+            JOIN organizations o ON o.id = a.organization_id WHERE a.media_id = m.id), ''),
+        coalesce((SELECT group_concat(c.name, ' ') FROM assoc_media_collection a
+            JOIN collections c ON c.id = a.collection_id WHERE a.media_id = m.id), '')
+    FROM media m JOIN media_search_docs d ON d.media_id = m.id
+    WHERE m.id IN :media_ids"""
+).bindparams(bindparam("media_ids", expanding=True))
+
+# rank inside the FTS table before joining, so only one page is joined
+SEARCH_DOCS = text(
+    f"""SELECT d.media_id FROM (
+        SELECT rowid, bm25(media_fts, {", ".join(str(w) for w in RANK_WEIGHTS)}) AS score
+        FROM media_fts WHERE media_fts MATCH :query
+        ORDER BY score LIMIT :limit OFFSET :offset
+    ) AS f
+    JOIN media_search_docs d ON d.docid = f.rowid
+    ORDER BY f.score"""
+)
+
+
+class SearchIndex():
+
+    def __init__(self, db):
+        self.db = db
+        self.enabled = db.engine.dialect.name == "sqlite"
+        if self.enabled:
+            db.listen_session("before_flush", self._collect_flushing)
+            db.listen_session("after_flush", self._sync_pending)
+            db.listen_session("do_orm_execute", self._collect_executed)
+            db.listen_session("before_commit", self._sync_pending)
+            db.listen_session("after_rollback", self._discard_pending)
+
+    async def begin(self):
+        if not self.enabled:
+            logger.info("Full-text search needs SQLite, falling back to LIKE queries")
+            return
+        async with self.db.engine.begin() as conn:
+            for statement in SCHEMA:
+                await conn.execute(text(statement))
+            indexed = (await conn.execute(text("SELECT count(*) FROM media_search_docs"))).scalar()
+            total = (await conn.execute(text("SELECT count(*) FROM media"))).scalar()
+            if indexed != total:
+                await conn.run_sync(self._rebuild)
+
+    def _rebuild(self, conn):
+        logger.info("Rebuilding search index")
+        conn.execute(text("DELETE FROM media_fts"))
+        conn.execute(text("DELETE FROM media_search_docs"))
+        media_ids = conn.execute(text("SELECT id FROM media")).scalars().all()
+        for start in range(0, len(media_ids), REINDEX_BATCH_SIZE):
+            self._reindex(conn, media_ids[start:start + REINDEX_BATCH_SIZE])
+
+    def _reindex(self, conn, media_ids):
+        conn.execute(DELETE_DOCS, {"media_ids": media_ids})
+        conn.execute(DELETE_DOC_IDS, {"media_ids": media_ids})
+        conn.execute(INSERT_DOC_IDS, {"media_ids": media_ids})
+        conn.execute(INSERT_DOCS, {"media_ids": media_ids})
+
+    # ********** Change Tracking **********
+
+    def _pending(self, session):
+        return session.info.setdefault("search_pending", set())
+
+    def _collect_flushing(self, session, flush_context, instances):
+        if not self.db.owns_session(session):
+            return
+        pending = self._pending(session)
+        for changed_object in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(changed_object, Media):
+                pending.add(changed_object.id)
+            elif type(changed_object) in LINKED_TABLES and changed_object not in session.new:
+                # renamed or deleted, find linked media before the links change
+                assoc_table, assoc_column, key = LINKED_TABLES[type(changed_object)]
+                pending.update(session.connection().execute(
+                    select(assoc_table.c.media_id)
+                    .where(assoc_table.c[assoc_column] == getattr(changed_object, key))
+                ).scalars())
+
+    def _collect_executed(self, orm_execute_state):
+        # bulk statements skip the unit of work
+        if orm_execute_state.is_select:
+            return
+        session = orm_execute_state.session
+        if not self.db.owns_session(session):
+            return
+        statement = orm_execute_state.statement
+        table = getattr(statement, "table", None)
+        table_name = getattr(table, "name", None)
+        if table_name == Media.__tablename__:
+            id_key = "id"
+        elif table_name in ASSOC_TABLE_NAMES:
+            # links are only inserted or deleted, updates move collection positions
+            if orm_execute_state.is_update:
+                return
+            id_key = "media_id"
+        else:
+            return
+        parameters = orm_execute_state.parameters
+        if not isinstance(parameters, list):
+            parameters = [parameters] if parameters else []
+        pending = self._pending(session)
+        if parameters and all(id_key in p for p in parameters):
+            pending.update(p[id_key] for p in parameters)
+        elif orm_execute_state.is_update or orm_execute_state.is_delete:
+            # rows matched by a WHERE clause, found before they change
+            query = select(table.c[id_key])
+            if statement.whereclause is not None:
+                query = query.where(statement.whereclause)
+            conn = session.connection()
+            for p in parameters or [{}]:
+                pending.update(conn.execute(query, p).scalars())
+        else:
+            # inserted rows that name no media are unknown
+            pending.add(None)
+
+    def _sync_pending(self, session, *args):
+        if not self.db.owns_session(session):
+            return
+        pending = session.info.pop("search_pending", None)
+        if not pending:
+            return
+        conn = session.connection()
+        if None in pending:
+            self._rebuild(conn)
+            return
+        media_ids = [media_id.hex for media_id in pending]
+        for start in range(0, len(media_ids), REINDEX_BATCH_SIZE):
+            self._reindex(conn, media_ids[start:start + REINDEX_BATCH_SIZE])
+
+    def _discard_pending(self, session):
+        session.info.pop("search_pending", None)
+
+    # ********** Queries **********
+
+    async def search(self, session, query, limit=20, offset=0):
+        # one extra result tells whether another page exists
+        if self.enabled:
+            match_query = build_match_query(query)
+            if match_query is None:
+                return [], False
+            result = await session.execute(SEARCH_DOCS, {
+                "query": match_query,
+                "limit": limit + 1,
+                "offset": offset,
+            })
+            media_ids = [media_id for media_id in result.scalars()]
+            has_more = len(media_ids) > limit
+            media_ids = media_ids[:limit]
+            rows = await self.db.select_columns(
+                session, Media, MEDIA_LIST_COLUMNS,
+                Media.id.in_([UUID(media_id) for media_id in media_ids]),
+                Media.missing.is_(False),
+            )
+            # keep the ranked order
+            rows_by_id = {row.id.hex: row for row in rows}
+            rows = [rows_by_id[media_id] for media_id in media_ids if media_id in rows_by_id]
+            return rows, has_more
+        pattern = f"%{query.strip()}%"
+        result = await session.execute(
+            select(*build_columns(Media, MEDIA_LIST_COLUMNS))
+            .where(Media.missing.is_(False))
+            .where(or_(Media.title.ilike(pattern), Media.description.ilike(pattern)))
+            .order_by(Media.title)
+            .limit(limit + 1)
+            .offset(offset)
+        )
+        rows = result.all()
+        return rows[:limit], len(rows) > limit
+
+
+def build_match_query(query):
+    # every word must match, the last one as a prefix for search-as-you-type
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    # single letters would match most of the library, two and three have prefix indexes
+    if len(words[-1]) >= 2:
+        terms[-1] += "*"
+    return " ".join(terms)
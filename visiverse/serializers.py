@@ -0,0 +1,160 @@
+from operator import attrgetter
+
+from quart.json.provider import DefaultJSONProvider
+
+from visiverse.database import Collection
+from visiverse.database import Media
+from visiverse.database import Organization
+from visiverse.database import Person
+from visiverse.database import Tag
+
+# optional, several times faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# json.dumps arguments -> orjson option giving the same layout
+ORJSON_LAYOUTS = {
+    (): 0,
+    (("separators", (",", ":")),): 0,
+    (("indent", 2),): orjson.OPT_INDENT_2,
+} if orjson is not None else {}
+
+
+class Serializer():
+
+    def __init__(self, object_class, fields, relations=None, sort_key=None):
+        self.object_class = object_class
+        # field name -> value getter
+        self.fields = fields
+        # field name -> serializer of the related objects
+        self.relations = relations or {}
+        self.default_fields = (*self.fields, *self.relations)
+        # related objects come from sets, sorted for stable output
+        self.sort_key = sort_key
+        # field names -> [(field name, getter)]
+        self.compiled = {}
+
+    def parse_fields(self, fields_arg):
+        # e.g. ?fields=id,title,tags, every field when absent
+        if not fields_arg:
+            return self.default_fields
+        field_names = tuple(dict.fromkeys(
+            field_name.strip() for field_name in fields_arg.split(",") if field_name.strip()
+        ))
+        for field_name in field_names:
+            if field_name not in self.fields and field_name not in self.relations:
+                raise ValueError(f"Unknown field '{field_name}'")
+        return field_names
+
+    def get_load_plan(self, field_names):
+        # one IN (...) query per requested relationship, the others are never loaded
+        load_plan = {
+            field_name: "selectin" for field_name in field_names if field_name in self.relations
+        }
+        load_plan["*"] = "raise"
+        return load_plan
+
+    def serialize(self, target, field_names=None):
+        getters = self._get_getters(field_names or self.default_fields)
+        return {field_name: getter(target) for field_name, getter in getters}
+
+    def serialize_many(self, targets, field_names=None):
+        getters = self._get_getters(field_names or self.default_fields)
+        return [{field_name: getter(target) for field_name, getter in getters} for target in targets]
+
+    def _get_getters(self, field_names):
+        getters = self.compiled.get(field_names)
+        if getters is None:
+            getters = []
+            for field_name in field_names:
+                if field_name in self.fields:
+                    getters.append((field_name, self.fields[field_name]))
+                else:
+                    getters.append((field_name, related(field_name, self.relations[field_name])))
+            self.compiled[field_names] = getters
+        return getters
+
+
+class JSONProvider(DefaultJSONProvider):
+
+    def dumps(self, obj, **kwargs):
+        # response() asks for compact or indented output, other json module options fall back to it
+        option = ORJSON_LAYOUTS.get(tuple(sorted(kwargs.items()))) if orjson is not None else None
+        if option is None:
+            return super().dumps(obj, **kwargs)
+        # datetimes go through default as well, HTTP dates like the json module writes
+        return orjson.dumps(
+            obj,
+            default=self.default,
+            option=option | orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+def field(name, convert=None):
+    getter = attrgetter(name)
+    if convert is None:
+        return getter
+    def get_converted(target):
+        value = getter(target)
+        return None if value is None else convert(value)
+    return get_converted
+
+def related(name, serializer):
+    getter = attrgetter(name)
+    def get_related(target):
+        related_objects = getter(target)
+        if serializer.sort_key is not None:
+            related_objects = sorted(related_objects, key=serializer.sort_key)
+        return serializer.serialize_many(related_objects)
+    return get_related
+
+def isoformat(value):
+    return value.isoformat()
+
+
+# ********** Serializers **********
+
+TAG_SERIALIZER = Serializer(Tag, {
+    "name": field("name"),
+}, sort_key=attrgetter("name"))
+
+PERSON_SERIALIZER = Serializer(Person, {
+    "id": field("id", str),
+    "name": field("name"),
+}, sort_key=attrgetter("name"))
+
+ORGANIZATION_SERIALIZER = Serializer(Organization, {
+    "id": field("id", str),
+    "name": field("name"),
+}, sort_key=attrgetter("name"))
+
+COLLECTION_SERIALIZER = Serializer(Collection, {
+    "id": field("id", str),
+    "name": field("name"),
+    "description": field("description"),
+    "type": field("type.name"),
+}, sort_key=attrgetter("name"))
+
+# the file path stays private to the server
+MEDIA_SERIALIZER = Serializer(Media, {
+    "id": field("id", str),
+    "title": field("title"),
+    "description": field("description"),
+    "type": field("type.name"),
+    "duration": field("duration"),
+    "urls": field("urls"),
+    "missing": field("missing"),
+    "created": field("created", isoformat),
+}, relations={
+    "people": PERSON_SERIALIZER,
+    "organizations": ORGANIZATION_SERIALIZER,
+    "tags": TAG_SERIALIZER,
+    "collections": COLLECTION_SERIALIZER,
+})
@@ -0,0 +1,53 @@
+import os
+
+# Hypercorn is installed with Quart
+from hypercorn.config import Config as HypercornConfig
+
+# optional, advisory locks are skipped where fcntl is unavailable
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# evaluated in every worker process, each builds its own app
+APPLICATION_PATH = "visiverse:create_app()"
+
+
+class ProcessLock():
+
+    def __init__(self, filename):
+        # held until released or the process exits, however it exits
+        self.filename = filename
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        except BaseException:
+            os.close(fd)
+            raise
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+def get_server_config(app_config):
+    # workers share the database and storage, everything else is per process
+    server_config = HypercornConfig()
+    server_config.application_path = APPLICATION_PATH
+    server_config.bind = [bind.strip() for bind in app_config["server"]["bind"].split(",")]
+    server_config.workers = app_config.getint("server", "workers")
+    return server_config
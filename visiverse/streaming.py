@@ -0,0 +1,212 @@
+import asyncio
+import os
+import zlib
+from datetime import datetime
+from datetime import timezone
+from urllib.parse import quote
+from urllib.parse import unquote
+from uuid import uuid4
+
+from quart import Response
+
+
+# Response headers handing the file over to a reverse proxy
+OFFLOAD_HEADERS = {
+    "x-accel": "X-Accel-Redirect",
+    "x-sendfile": "X-Sendfile",
+}
+
+
+class MediaStreamer():
+
+    def __init__(self, app_config):
+        self.media_path = os.path.realpath(app_config["library"]["media_path"])
+        self.chunk_size = app_config.getint("streaming", "chunk_size")
+        self.max_ranges = app_config.getint("streaming", "max_ranges")
+        self.offload = app_config["streaming"]["offload"]
+        if self.offload != "none" and self.offload not in OFFLOAD_HEADERS:
+            raise ValueError(f"Unknown offload mode '{self.offload}'")
+        self.offload_prefix = app_config["streaming"]["offload_prefix"]
+        self.offload_local = app_config.getboolean("streaming", "offload_local")
+
+    async def send(self, request, filename, mimetype):
+        location = self.get_offload_location(filename)
+        if location is None:
+            return await self.stream(request, filename, mimetype)
+        # the proxy handles ranges and conditionals itself
+        response = Response(b"", mimetype=mimetype)
+        response.headers[OFFLOAD_HEADERS[self.offload]] = location
+        return response
+
+    async def stream(self, request, filename, mimetype):
+        stat = os.stat(filename)
+        file_size = stat.st_size
+        etag = file_etag(filename, stat)
+        last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+        if is_not_modified(request, etag, last_modified):
+            response = Response(b"", 304)
+        else:
+            ranges = self.get_ranges(request, file_size, etag, last_modified)
+            if ranges is None:
+                response = self._make_response(request, filename, [(b"", 0, file_size)], b"")
+                response.content_type = mimetype
+            elif not ranges:
+                response = Response(b"", 416)
+                response.headers["Content-Range"] = f"bytes */{file_size}"
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                response = self._make_response(request, filename, [(b"", start, end)], b"", 206)
+                response.content_type = mimetype
+                response.headers["Content-Range"] = f"bytes {start}-{end - 1}/{file_size}"
+            else:
+                boundary = uuid4().hex
+                parts = [multipart_part(boundary, mimetype, start, end, file_size) for start, end in ranges]
+                trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+                response = self._make_response(request, filename, parts, trailer, 206)
+                response.content_type = f"multipart/byteranges; boundary={boundary}"
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers["Accept-Ranges"] = "bytes"
+        return response
+
+    def _make_response(self, request, filename, parts, trailer, status=200):
+        content_length = len(trailer) + sum(
+            len(header) + end - start for header, start, end in parts
+        )
+        if request.method == "HEAD":
+            response = Response(b"", status)
+        else:
+            response = Response(self._iter_parts(filename, parts, trailer), status)
+            # long downloads must outlive RESPONSE_TIMEOUT
+            response.timeout = None
+        response.content_length = content_length
+        return response
+
+    async def _iter_parts(self, filename, parts, trailer):
+        # ASGI bodies are bytes, every chunk is copied once by a worker thread,
+        # which also waits out the page faults of a cold file instead of the event loop
+        loop = asyncio.get_running_loop()
+        fd = os.open(filename, os.O_RDONLY)
+        reading = None
+        try:
+            for header, start, end in parts:
+                if header:
+                    yield header
+                for offset in range(start, end, self.chunk_size):
+                    chunk_end = min(end, offset + self.chunk_size)
+                    # start reading the next chunk while this one is sent
+                    advise_willneed(fd, chunk_end, min(end, chunk_end + self.chunk_size))
+                    reading = loop.run_in_executor(None, os.pread, fd, chunk_end - offset, offset)
+                    yield await asyncio.shield(reading)
+            if trailer:
+                yield trailer
+        finally:
+            if reading is not None and not reading.done():
+                # the worker thread still reads from the descriptor
+                await asyncio.wait([reading])
+            os.close(fd)
+
+    def get_ranges(self, request, file_size, etag, last_modified):
+        # None serves the whole file, an empty list is unsatisfiable
+        request_ranges = parse_byte_ranges(request.headers.get("Range"))
+        if request_ranges is None:
+            return None
+        if_range = request.if_range
+        # strong comparison, a weak entity tag never satisfies If-Range
+        if if_range.etag is not None and (if_range.etag != etag or is_weak_etag(request.headers["If-Range"])):
+            return None
+        if if_range.date is not None and if_range.date != last_modified:
+            return None
+        ranges = []
+        for start, end in request_ranges:
+            if start < 0:
+                start, end = max(0, file_size + start), file_size
+            else:
+                end = file_size if end is None else min(end, file_size)
+            if start < end:
+                ranges.append((start, end))
+        # coalesce overlapping and adjacent ranges
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        if len(merged) > self.max_ranges:
+            return None
+        return merged
+
+    # ********** Reverse Proxy Offload **********
+
+    def get_offload_location(self, filename):
+        if self.offload == "none":
+            return None
+        filename = os.path.realpath(filename)
+        if self.offload == "x-sendfile":
+            return filename
+        relative_filename = os.path.relpath(filename, self.media_path)
+        if relative_filename.startswith(os.pardir):
+            # outside the proxied directory
+            return None
+        return self.offload_prefix + quote(relative_filename.replace(os.sep, "/"))
+
+    def get_offload_filename(self, location):
+        if self.offload == "x-sendfile":
+            return location
+        relative_filename = unquote(location[len(self.offload_prefix):])
+        return os.path.join(self.media_path, *relative_filename.split("/"))
+
+    async def resolve_offload(self, request, response):
+        # local stand-in for the proxy, for running without one
+        location = response.headers.get(OFFLOAD_HEADERS.get(self.offload, ""))
+        if location is None:
+            return response
+        return await self.stream(request, self.get_offload_filename(location), response.mimetype)
+
+
+def file_etag(filename, stat):
+    return f"{zlib.crc32(filename.encode()):x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def is_not_modified(request, etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    return request.if_modified_since is not None and last_modified <= request.if_modified_since
+
+def parse_byte_ranges(value):
+    # werkzeug rejects overlapping or unordered ranges, which RFC 9110 allows
+    if not value or "=" not in value:
+        return None
+    units, range_set = value.split("=", 1)
+    if units.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for range_spec in range_set.split(","):
+        start, dash, end = range_spec.strip().partition("-")
+        if not dash or not (start + end).isdigit():
+            return None
+        if not start:
+            # suffix range, the last N bytes, a zero-length one selects nothing
+            if int(end):
+                ranges.append((-int(end), None))
+        elif not end:
+            ranges.append((int(start), None))
+        elif int(start) <= int(end):
+            ranges.append((int(start), int(end) + 1))
+        else:
+            return None
+    return ranges
+
+def is_weak_etag(value):
+    return value.strip().startswith("W/")
+
+def multipart_part(boundary, mimetype, start, end, file_size):
+    header = (
+        f"\r\n--{boundary}\r\n"
+        f"Content-Type: {mimetype}\r\n"
+        f"Content-Range: bytes {start}-{end - 1}/{file_size}\r\n\r\n"
+    )
+    return header.encode("latin-1"), start, end
+
+def advise_willneed(fd, start, end):
+    if end > start and hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_WILLNEED)
@@ -32,7 +32,7 @@
         let response;
         try {
             // POST to login route
-            response = await fetch("{{ url_for('auth_login') }}", {
+            response = await fetch("{{ url_for('.auth_login') }}", {
                 method: "POST",
                 headers: {
                     "Accept": "application/json",
@@ -48,7 +48,7 @@
             doingLogin = false;
             if (response.ok) {
                 // submission successful
-                window.location.href = "{{ url_for('page_home') }}";
+                window.location.href = "{{ url_for('.page_home') }}";
             } else {
                 // throw error with server message
                 throw new Error(responseJson.message);
@@ -0,0 +1,48 @@
+(() => {
+
+    const tileGrid = document.getElementById("tileGrid");
+    const sentinel = document.getElementById("tileGridSentinel");
+
+    let loadingTiles = false;
+
+    async function loadNextPage() {
+        const cursor = sentinel.dataset.cursor;
+        // Nothing left to load, or already loading
+        if (cursor === "" || loadingTiles) {
+            return;
+        }
+        loadingTiles = true;
+        try {
+            const params = new URLSearchParams({ cursor: cursor });
+            const response = await fetch(`{{ url_for('.page_media_tiles') }}?${params}`);
+            if (!response.ok) {
+                throw new Error(`${response.status} - ${response.statusText}`);
+            }
+            tileGrid.insertAdjacentHTML("beforeend", await response.text());
+            sentinel.dataset.cursor = response.headers.get("X-Next-Cursor") || "";
+        } catch (error) {
+            console.error(`Error loading media: ${error.message}`);
+        } finally {
+            loadingTiles = false;
+        }
+        // Keep loading while the sentinel is still visible
+        if (sentinel.dataset.cursor === "") {
+            observer.disconnect();
+        } else if (sentinelVisible()) {
+            loadNextPage();
+        }
+    }
+
+    function sentinelVisible() {
+        return sentinel.getBoundingClientRect().top < window.innerHeight;
+    }
+
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadNextPage();
+        }
+    }, { rootMargin: "400px" });
+
+    observer.observe(sentinel);
+
+})();
@@ -0,0 +1,28 @@
+(() => {
+
+    const player = document.getElementById("mediaPlayer");
+    const masterUrl = player.dataset.hlsSrc;
+
+    // Images, audio and unprobed files keep the original source
+    if (masterUrl === undefined) {
+        return;
+    }
+
+    if (window.Hls !== undefined && Hls.isSupported()) {
+        const hls = new Hls({ capLevelToPlayerSize: true });
+        hls.on(Hls.Events.ERROR, (event, data) => {
+            // Fall back to the original file if streaming breaks
+            if (data.fatal) {
+                console.error("HLS playback failed:", data.details);
+                hls.destroy();
+                player.load();
+            }
+        });
+        hls.loadSource(masterUrl);
+        hls.attachMedia(player);
+    } else if (player.canPlayType("application/vnd.apple.mpegurl")) {
+        // Native HLS, e.g. Safari
+        player.src = masterUrl;
+    }
+
+})();
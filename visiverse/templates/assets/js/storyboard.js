@@ -0,0 +1,61 @@
+(() => {
+
+    const player = document.getElementById("mediaPlayer");
+    const preview = document.getElementById("storyboardPreview");
+    const track = Array.from(player.textTracks).find(t => t.label === "storyboard");
+
+    if (track === undefined) {
+        return;
+    }
+    // Load cues without displaying them
+    track.mode = "hidden";
+    const trackUrl = new URL(player.querySelector("track").src, window.location.href);
+
+    // Approximate height of the native seek bar area
+    const seekBarHeight = 40;
+
+    function findCue(time) {
+        const cues = track.cues;
+        if (cues === null) {
+            return null;
+        }
+        for (let i = 0; i < cues.length; i++) {
+            if (cues[i].startTime <= time && time < cues[i].endTime) {
+                return cues[i];
+            }
+        }
+        return null;
+    }
+
+    function showPreview(e) {
+        const bounds = player.getBoundingClientRect();
+        const x = e.clientX - bounds.left;
+        if (bounds.bottom - e.clientY > seekBarHeight || !player.duration) {
+            hidePreview();
+            return;
+        }
+        const cue = findCue(player.duration * x / bounds.width);
+        if (cue === null) {
+            hidePreview();
+            return;
+        }
+        // Cue text is "<sheet>.jpg#xywh=x,y,w,h"
+        const [sheet, region] = cue.text.trim().split("#xywh=");
+        const [tileX, tileY, tileWidth, tileHeight] = region.split(",").map(Number);
+        preview.style.width = `${tileWidth}px`;
+        preview.style.height = `${tileHeight}px`;
+        preview.style.backgroundImage = `url("${new URL(sheet, trackUrl)}")`;
+        preview.style.backgroundPosition = `-${tileX}px -${tileY}px`;
+        const left = Math.min(Math.max(x - tileWidth / 2, 0), bounds.width - tileWidth);
+        preview.style.left = `${left}px`;
+        preview.style.display = "block";
+    }
+
+    function hidePreview() {
+        preview.style.display = "none";
+    }
+
+    player.addEventListener("mousemove", showPreview);
+    player.addEventListener("mouseleave", hidePreview);
+
+})();
@@ -1,39 +1,718 @@
+import contextlib
+import json
+import logging
+import math
 import os
+import shutil
+import subprocess
+import threading
+from collections import namedtuple
+from uuid import uuid4
 
 import ffmpeg
 
+from visiverse.cache import DiskCache
+from visiverse.cache import SingleFlight
+from visiverse.database import MediaType
+
+
+logger = logging.getLogger(__name__)
+
+# Thumbnail format -> (extension, mime type, encoder options)
+THUMB_FORMATS = {
+    "jpeg": ("jpg", "image/jpeg", {"vcodec": "mjpeg", "q:v": 3}),
+    "webp": ("webp", "image/webp", {"vcodec": "libwebp", "quality": 75}),
+    "avif": ("avif", "image/avif", {"vcodec": "libaom-av1", "crf": 35, "still-picture": 1}),
+}
+
+# One step of the adaptive bitrate ladder, bitrates in bits per second
+LadderRung = namedtuple("LadderRung", ["height", "video_bitrate", "audio_bitrate"])
+
+# Streams every HLS and MP4 capable browser can decode as they are
+DIRECT_VIDEO_CODECS = {"h264"}
+DIRECT_PIXEL_FORMATS = {"yuv420p", "yuvj420p"}
+DIRECT_AUDIO_CODECS = {"aac", "mp3"}
+# ffprobe names every file of the mov demuxer "mov,mp4,...", the file type tells MP4 apart
+DIRECT_MIMETYPES = {"video/mp4"}
+
+# How the original reaches the player, cheapest first
+PLAY_DIRECT = "direct"
+PLAY_REMUX = "remux"
+PLAY_TRANSCODE = "transcode"
+
+# Rendition directory holding the remuxed original
+SOURCE_RENDITION = "source"
+
+# H.264 levels as (level_idc, macroblocks per frame, macroblocks per second), lowest first
+AVC_LEVELS = [
+    (30, 1620, 40500),
+    (31, 3600, 108000),
+    (32, 5120, 216000),
+    (40, 8192, 245760),
+    (42, 8704, 522240),
+    (50, 22080, 589824),
+    (51, 36864, 983040),
+    (52, 36864, 2073600),
+]
+
+# RFC 6381 names of the audio codecs variants carry
+AUDIO_CODEC_NAMES = {"aac": "mp4a.40.2", "mp3": "mp4a.40.34"}
+
+# Grayscale frame size of the perceptual hash, one bit per horizontally adjacent pixel pair
+DHASH_SIZE = (9, 8)
+
 
 class Transcoder():
 
-    def __init__(self, app_config):
+    def __init__(self, app_config, metrics=None):
         self.app_config = app_config
+        # records ffmpeg and ffprobe runs when set
+        self.metrics = metrics
+        # HLS segmenting
+        self.segment_duration = app_config.getint("hls", "segment_duration")
+        self.readahead = app_config.getint("hls", "readahead")
+        self.segment_cache = DiskCache(
+            self.get_storage_dir("segments"),
+            app_config.getint("hls", "cache_size"),
+            app_config.getfloat("hls", "cache_rescan"),
+        )
+        # adaptive bitrate renditions
+        self.ladder = parse_ladder(app_config["renditions"]["ladder"])
+        self.rendition_flight = SingleFlight()
+        # thumbnails
+        self.thumb_widths = sorted(parse_list(app_config["thumbs"]["widths"], int))
+        self.thumb_formats = check_thumb_formats(parse_list(app_config["thumbs"]["formats"]))
+        self.thumb_seek = app_config.getfloat("thumbs", "seek")
+        self.thumb_flight = SingleFlight()
+        # storyboards
+        self.storyboard_interval = app_config.getfloat("storyboard", "interval")
+        self.storyboard_tile_size = (
+            app_config.getint("storyboard", "tile_width"),
+            app_config.getint("storyboard", "tile_height"),
+        )
+        self.storyboard_grid = (
+            app_config.getint("storyboard", "columns"),
+            app_config.getint("storyboard", "rows"),
+        )
+        self.storyboard_keyframes_only = app_config.getboolean("storyboard", "keyframes_only")
+        self.storyboard_flight = SingleFlight()
 
-    def ensure_segment(media_filename):
-        pass
+    # ********** HLS Segments **********
 
-    def create_thumbnail(self, media, seek=5):
-        thumb_filename = self.get_thumb_filename(media.id)
-        ensure_parent_dir(thumb_filename)
-        (
-            ffmpeg
-            .input(media.filename, ss=seek)
-            .filter("scale", 720, -1)
-            .output(thumb_filename, vframes=1)
-            .overwrite_output()
-            .run()
+    def get_segment_count(self, media):
+        if media.duration is None:
+            raise ValueError("Media duration unknown")
+        return max(1, math.ceil(media.duration / self.segment_duration))
+
+    def get_play_mode(self, media):
+        probe = media.probe
+        if probe is None or probe.video_codec is None:
+            return PLAY_TRANSCODE
+        if probe.video_codec not in DIRECT_VIDEO_CODECS or probe.pixel_format not in DIRECT_PIXEL_FORMATS:
+            return PLAY_TRANSCODE
+        audio_direct = probe.audio_codec is None or probe.audio_codec in DIRECT_AUDIO_CODECS
+        if audio_direct and "mp4" in (probe.container or "").split(",") and media.mimetype in DIRECT_MIMETYPES:
+            return PLAY_DIRECT
+        # video is copied as is, audio converted if needed
+        return PLAY_REMUX
+
+    def get_ladder(self, media):
+        # never upscale, the remuxed source covers the top once it exists
+        probe = media.probe
+        if probe is None or not probe.height:
+            return self.ladder
+        ladder = [rung for rung in self.ladder if rung.height < probe.height]
+        if not ladder and not self.has_rendition(media.id, SOURCE_RENDITION):
+            ladder = self.ladder[:1]
+        return ladder
+
+    def create_master_playlist(self, media):
+        # CODECS lets players skip variants they cannot decode without fetching them
+        probe = media.probe
+        has_audio = probe is None or probe.audio_codec is not None
+        frame_rate = probe.frame_rate if probe is not None else None
+        lines = ["#EXTM3U"]
+        for rung in self.get_ladder(media):
+            stream_info = f"BANDWIDTH={rung.video_bitrate + rung.audio_bitrate}"
+            if probe is not None and probe.width and probe.height:
+                width = round(probe.width * rung.height / probe.height / 2) * 2
+                stream_info += f",RESOLUTION={width}x{rung.height}"
+            else:
+                width = round(rung.height * 16 / 9)
+            codecs = get_codecs(width, rung.height, frame_rate, "aac" if has_audio else None)
+            lines.append(f'#EXT-X-STREAM-INF:{stream_info},CODECS="{codecs}"')
+            lines.append(f"{rung.height}/index.m3u8")
+        if self.has_rendition(media.id, SOURCE_RENDITION):
+            bandwidth = probe.bitrate or sum(self.ladder[-1][1:])
+            audio_codec = probe.audio_codec
+            if audio_codec is not None and audio_codec not in DIRECT_AUDIO_CODECS:
+                # converted by the remux
+                audio_codec = "aac"
+            codecs = get_codecs(probe.width, probe.height, probe.frame_rate, audio_codec)
+            lines.append(
+                f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={probe.width}x{probe.height}"
+                f',CODECS="{codecs}"'
+            )
+            lines.append(f"{SOURCE_RENDITION}/index.m3u8")
+        return "\n".join(lines) + "\n"
+
+    def create_playlist(self, media):
+        segment_count = self.get_segment_count(media)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{self.segment_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+        ]
+        for index in range(segment_count):
+            start = index * self.segment_duration
+            length = min(self.segment_duration, media.duration - start)
+            lines.append(f"#EXTINF:{max(length, 0):.3f},")
+            lines.append(f"{index}.ts")
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def create_segment(self, media, index, height=None):
+        segment_filename = self.get_segment_filename(media.id, index, height)
+        # another request or worker process may have finished it in the meantime
+        if self.segment_cache.touch(segment_filename):
+            return segment_filename
+        ensure_parent_dir(segment_filename)
+        start = index * self.segment_duration
+        # unique, other processes may be writing the same segment
+        temp_filename = f"{segment_filename}.{uuid4().hex}.part"
+        output_options = {}
+        if height is not None:
+            output_options = get_rung_options(self.get_rung(height))
+        try:
+            self.timed(
+                "ffmpeg", "segment", run_ffmpeg,
+                ffmpeg
+                .input(media.filename, ss=start, t=self.segment_duration)
+                .output(
+                    temp_filename,
+                    format="mpegts",
+                    vcodec="libx264",
+                    acodec="aac",
+                    preset="veryfast",
+                    pix_fmt="yuv420p",
+                    output_ts_offset=start,
+                    **output_options,
+                )
+                .overwrite_output()
+            )
+        except BaseException:
+            try:
+                os.remove(temp_filename)
+            except FileNotFoundError:
+                pass
+            raise
+        # only expose complete segments, the same segment from another process is replaced atomically
+        os.replace(temp_filename, segment_filename)
+        self.segment_cache.add(segment_filename)
+        return segment_filename
+
+    def get_segment_filename(self, media_id, index, height=None):
+        if height is None:
+            return f"{self.get_storage_dir('segments')}/{media_id}/{index}.ts"
+        return f"{self.get_storage_dir('segments')}/{media_id}/{height}/{index}.ts"
+
+    def discard_segments(self, media_id):
+        self.segment_cache.discard_dir(f"{self.get_storage_dir('segments')}/{media_id}")
+
+    def discard_media_cache(self, media_id):
+        # drop everything derived from a media file that changed
+        self.discard_segments(media_id)
+        shutil.rmtree(f"{self.get_storage_dir('thumbs')}/{media_id}", ignore_errors=True)
+        shutil.rmtree(self.get_storyboard_dir(media_id), ignore_errors=True)
+        shutil.rmtree(f"{self.get_storage_dir('renditions')}/{media_id}", ignore_errors=True)
+
+    # ********** Renditions **********
+
+    def get_rung(self, height):
+        for rung in self.ladder:
+            if rung.height == height:
+                return rung
+        raise ValueError(f"No rendition with height {height}")
+
+    def has_rendition(self, media_id, height):
+        return os.path.isdir(self.get_rendition_dir(media_id, height))
+
+    def ensure_rendition(self, media, height, progress=None):
+        if MediaType.video != media.type:
+            raise ValueError("Media has no renditions")
+        if media.duration is None:
+            raise ValueError("Media duration unknown")
+        self.get_rung(height)
+        rendition_dir = self.get_rendition_dir(media.id, height)
+        if os.path.isdir(rendition_dir):
+            return rendition_dir
+        return self.rendition_flight.do(
+            rendition_dir, self.create_rendition, media, height, progress
+        )
+
+    def ensure_remux(self, media, progress=None):
+        if self.get_play_mode(media) == PLAY_TRANSCODE:
+            raise ValueError("Media needs transcoding")
+        rendition_dir = self.get_rendition_dir(media.id, SOURCE_RENDITION)
+        if os.path.isdir(rendition_dir):
+            return rendition_dir
+        return self.rendition_flight.do(rendition_dir, self.create_remux, media, progress)
+
+    def create_remux(self, media, progress=None):
+        rendition_dir = self.get_rendition_dir(media.id, SOURCE_RENDITION)
+        if os.path.isdir(rendition_dir):
+            return rendition_dir
+        with build_dir(rendition_dir) as temp_dir:
+            audio_codec = media.probe.audio_codec
+            # segments split on the source keyframes, no decoding involved
+            self.timed(
+                "ffmpeg", "remux", run_ffmpeg,
+                ffmpeg
+                .input(media.filename)
+                .output(
+                    f"{temp_dir}/index.m3u8",
+                    format="hls",
+                    vcodec="copy",
+                    acodec="copy" if audio_codec in DIRECT_AUDIO_CODECS else "aac",
+                    hls_time=self.segment_duration,
+                    hls_playlist_type="vod",
+                    hls_segment_type="fmp4",
+                    hls_fmp4_init_filename="init.mp4",
+                    hls_segment_filename=f"{temp_dir}/%d.m4s",
+                )
+                .overwrite_output(),
+                media.duration,
+                progress,
+            )
+        return rendition_dir
+
+    def create_rendition(self, media, height, progress=None):
+        rendition_dir = self.get_rendition_dir(media.id, height)
+        if os.path.isdir(rendition_dir):
+            return rendition_dir
+        # only expose complete renditions
+        with build_dir(rendition_dir) as temp_dir:
+            # keyframes on segment boundaries keep variants switchable, on-demand ones included
+            self.timed(
+                "ffmpeg", "rendition", run_ffmpeg,
+                ffmpeg
+                .input(media.filename)
+                .output(
+                    f"{temp_dir}/index.m3u8",
+                    format="hls",
+                    vcodec="libx264",
+                    acodec="aac",
+                    preset="veryfast",
+                    pix_fmt="yuv420p",
+                    force_key_frames=f"expr:gte(t,n_forced*{self.segment_duration})",
+                    sc_threshold=0,
+                    hls_time=self.segment_duration,
+                    hls_playlist_type="vod",
+                    hls_segment_type="fmp4",
+                    hls_fmp4_init_filename="init.mp4",
+                    hls_segment_filename=f"{temp_dir}/%d.m4s",
+                    **get_rung_options(self.get_rung(height)),
+                )
+                .overwrite_output(),
+                media.duration,
+                progress,
+            )
+        return rendition_dir
+
+    def get_rendition_dir(self, media_id, height):
+        return f"{self.get_storage_dir('renditions')}/{media_id}/{height}"
+
+    # ********** Thumbnails **********
+
+    def get_thumb_width(self, width=None):
+        # smallest configured width covering the request
+        if width is None:
+            return self.thumb_widths[-1]
+        for thumb_width in self.thumb_widths:
+            if thumb_width >= width:
+                return thumb_width
+        return self.thumb_widths[-1]
+
+    def check_thumbnail(self, media, thumb_format):
+        if MediaType.audio == media.type:
+            raise ValueError("Media has no thumbnail")
+        if media.probe is not None and media.probe.video_codec is None:
+            raise ValueError("Media has no video stream")
+        if thumb_format not in self.thumb_formats:
+            raise ValueError(f"Unsupported thumbnail format '{thumb_format}'")
+
+    def ensure_thumbnails(self, media, thumb_format):
+        # every width of a format is rendered by one ffmpeg run,
+        # the frame hash is returned when they were rendered just now
+        self.check_thumbnail(media, thumb_format)
+        return self.thumb_flight.do(
+            (media.id, thumb_format), self.create_thumbnails, media, thumb_format
         )
 
-    def get_thumb_filename(self, media_id):
+    def create_thumbnails(self, media, thumb_format):
+        thumb_filenames = {
+            width: self.get_thumb_filename(media.id, width, thumb_format)
+            for width in self.thumb_widths
+        }
+        if all(os.path.isfile(f) for f in thumb_filenames.values()):
+            return None
+        return self.timed(
+            "ffmpeg", "thumbnail", render_thumbnails,
+            media.filename, thumb_filenames, thumb_format, self.get_thumb_seek(media),
+        )
+
+    def create_frame_hash(self, media):
+        # the frame thumbnails show, for media thumbnailed before hashing
+        if MediaType.audio == media.type:
+            raise ValueError("Media has no thumbnail")
+        if media.probe is not None and media.probe.video_codec is None:
+            raise ValueError("Media has no video stream")
+        return self.timed(
+            "ffmpeg", "dhash", render_thumbnails,
+            media.filename, {}, seek=self.get_thumb_seek(media),
+        )
+
+    def get_thumb_seek(self, media):
+        if MediaType.video != media.type:
+            return 0
+        return clamp_thumb_seek(self.thumb_seek, media.duration)
+
+    def get_thumb_filename(self, media_id, width=720, thumb_format="jpeg"):
+        extension = THUMB_FORMATS[thumb_format][0]
+        return f"{self.get_storage_dir('thumbs')}/{media_id}/{width}.{extension}"
+
+    # ********** Storyboards **********
+
+    def check_storyboard(self, media):
+        if MediaType.video != media.type:
+            raise ValueError("Media has no storyboard")
+        if media.duration is None:
+            raise ValueError("Media duration unknown")
+
+    def ensure_storyboard(self, media, progress=None):
+        self.check_storyboard(media)
+        storyboard_dir = self.get_storyboard_dir(media.id)
+        if os.path.isdir(storyboard_dir):
+            return storyboard_dir
+        return self.storyboard_flight.do(media.id, self.create_storyboard, media, progress)
+
+    def create_storyboard(self, media, progress=None):
+        storyboard_dir = self.get_storyboard_dir(media.id)
+        if os.path.isdir(storyboard_dir):
+            return storyboard_dir
+        # only expose complete storyboards
+        with build_dir(storyboard_dir) as temp_dir:
+            tile_width, tile_height = self.storyboard_tile_size
+            columns, rows = self.storyboard_grid
+            input_options = {}
+            if self.storyboard_keyframes_only:
+                input_options["skip_frame"] = "nokey"
+            # sample, scale and pack every frame in a single decode pass
+            self.timed(
+                "ffmpeg", "storyboard", run_ffmpeg,
+                ffmpeg
+                .input(media.filename, **input_options)
+                .video
+                .filter("fps", fps=f"1/{self.storyboard_interval}")
+                .filter("scale", tile_width, tile_height, force_original_aspect_ratio="decrease")
+                .filter("pad", tile_width, tile_height, "(ow-iw)/2", "(oh-ih)/2")
+                .filter("tile", f"{columns}x{rows}")
+                .output(f"{temp_dir}/%d.jpg", start_number=0, vsync="vfr", **{"q:v": 5})
+                .overwrite_output(),
+                media.duration,
+                progress,
+            )
+            with open(f"{temp_dir}/storyboard.vtt", "w") as vtt_file:
+                vtt_file.write(self.create_storyboard_vtt(media))
+        return storyboard_dir
+
+    def create_storyboard_vtt(self, media):
+        tile_width, tile_height = self.storyboard_tile_size
+        columns, rows = self.storyboard_grid
+        frame_count = max(1, math.ceil(media.duration / self.storyboard_interval))
+        lines = ["WEBVTT", ""]
+        for index in range(frame_count):
+            start = index * self.storyboard_interval
+            end = min(start + self.storyboard_interval, media.duration)
+            sheet, position = divmod(index, columns * rows)
+            row, column = divmod(position, columns)
+            lines.append(f"{format_vtt_time(start)} --> {format_vtt_time(end)}")
+            lines.append(
+                f"{sheet}.jpg#xywh={column * tile_width},{row * tile_height},{tile_width},{tile_height}"
+            )
+            lines.append("")
+        return "\n".join(lines)
+
+    def get_storyboard_dir(self, media_id):
+        return f"{self.get_storage_dir('storyboards')}/{media_id}"
+
+    # ********** Helpers **********
+
+    def timed(self, tool, task, func, *args, **kwargs):
+        if self.metrics is None:
+            return func(*args, **kwargs)
+        with self.metrics.time_process(tool, task):
+            return func(*args, **kwargs)
+
+    def get_storage_dir(self, name):
         storage_path = self.app_config["storage"]["path"]
-        thumb_suffix = self.app_config["storage"]["thumb_suffix"]
-        return f"{storage_path}/thumbs/{media_id}{thumb_suffix}"
+        return f"{storage_path}/{name}"
 
 
 def ensure_parent_dir(filename):
     parent_dir = os.path.dirname(filename)
     if not os.path.exists(parent_dir):
-        os.makedirs(parent_dir)
+        os.makedirs(parent_dir, exist_ok=True)
+
+def run_ffmpeg(stream, duration=None, progress=None):
+    # progress is called with the fraction of the duration written so far,
+    # otherwise what ffmpeg wrote to stdout is returned
+    if progress is None or not duration:
+        process = stream.run_async(pipe_stdout=True, pipe_stderr=True)
+        stdout, stderr = process.communicate()
+    else:
+        stdout = None
+        process = (
+            stream
+            .global_args("-progress", "pipe:1", "-nostats", "-loglevel", "error")
+            .run_async(pipe_stdout=True, pipe_stderr=True)
+        )
+        # drained alongside, ffmpeg blocks once either pipe fills up
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()))
+        stderr_reader.start()
+        for line in process.stdout:
+            key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+            # out_time_ms is in microseconds as well, older builds only send it
+            if key in ("out_time_us", "out_time_ms") and value.isdigit():
+                progress(min(1.0, int(value) / 1000000 / duration))
+        stderr_reader.join()
+        stderr = b"".join(stderr_chunks)
+    if process.wait() != 0:
+        raise ProcessError("ffmpeg", process.returncode, stderr)
+    if progress is not None:
+        progress(1.0)
+    return stdout
+
+def render_thumbnails(media_filename, thumb_filenames, thumb_format="jpeg", seek=5):
+    # decode one frame and scale it to every width, never upscaling,
+    # the perceptual hash of the same frame is returned
+    encoder_options = THUMB_FORMATS[thumb_format][2]
+    frames = ffmpeg.input(media_filename, ss=seek).video.filter_multi_output(
+        "split", len(thumb_filenames) + 1
+    )
+    outputs = []
+    temp_filenames = {}
+    for index, (width, thumb_filename) in enumerate(thumb_filenames.items()):
+        ensure_parent_dir(thumb_filename)
+        base_filename, extension = os.path.splitext(thumb_filename)
+        # unique, the importer, thumbnail jobs and other processes may render the same media
+        temp_filenames[thumb_filename] = f"{base_filename}.{uuid4().hex}.part{extension}"
+        outputs.append(
+            frames[index]
+            .filter("scale", f"min(iw,{width})", -2)
+            .output(temp_filenames[thumb_filename], vframes=1, **encoder_options)
+        )
+    outputs.append(
+        frames[len(thumb_filenames)]
+        .filter("format", "gray")
+        .filter("scale", *DHASH_SIZE, flags="area")
+        .output("pipe:", vframes=1, format="rawvideo", pix_fmt="gray")
+    )
+    try:
+        pixels = run_ffmpeg(ffmpeg.merge_outputs(*outputs).overwrite_output())
+    except BaseException:
+        for temp_filename in temp_filenames.values():
+            try:
+                os.remove(temp_filename)
+            except FileNotFoundError:
+                pass
+        raise
+    # only expose complete thumbnails
+    for thumb_filename, temp_filename in temp_filenames.items():
+        os.replace(temp_filename, thumb_filename)
+    return compute_dhash(pixels)
+
+@contextlib.contextmanager
+def build_dir(target_dir):
+    # unique, other processes may be building the same directory
+    temp_dir = f"{target_dir}.{uuid4().hex}.part"
+    os.makedirs(temp_dir)
+    try:
+        yield temp_dir
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    try:
+        os.replace(temp_dir, target_dir)
+    except OSError:
+        # published by another process first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        if not os.path.isdir(target_dir):
+            raise
+
+def clamp_thumb_seek(thumb_seek, duration):
+    # clips shorter than the seek show their middle frame
+    if duration is not None:
+        return min(thumb_seek, duration / 2)
+    return thumb_seek
+
+def compute_dhash(pixels):
+    # 64 bits, set where a pixel is brighter than its right neighbour,
+    # signed to fit a 64-bit integer column
+    width, height = DHASH_SIZE
+    if pixels is None or len(pixels) != width * height:
+        return None
+    value = 0
+    for row in range(0, width * height, width):
+        for column in range(row, row + width - 1):
+            value = value << 1 | (pixels[column] > pixels[column + 1])
+    return value - (1 << 64) if value >> 63 else value
+
+def format_vtt_time(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02}:{minutes:02}:{seconds:06.3f}"
+
+def get_rung_options(rung):
+    # scale down to the rung, never up, in the profile the master playlist declares
+    return {
+        "vf": f"scale=-2:'min(ih,{rung.height})'",
+        "profile:v": "high",
+        "video_bitrate": rung.video_bitrate,
+        "maxrate": rung.video_bitrate,
+        "bufsize": 2 * rung.video_bitrate,
+        "audio_bitrate": rung.audio_bitrate,
+    }
+
+def get_codecs(width, height, frame_rate, audio_codec):
+    # High profile at the lowest level covering the frame size and rate,
+    # originals of an unknown profile are declared as High too, which decodes the others
+    macroblocks = math.ceil(width / 16) * math.ceil(height / 16)
+    macroblock_rate = macroblocks * (frame_rate or 30)
+    level = next(
+        (
+            level for level, max_frame, max_rate in AVC_LEVELS
+            if macroblocks <= max_frame and macroblock_rate <= max_rate
+        ),
+        AVC_LEVELS[-1][0],
+    )
+    codecs = [f"avc1.6400{level:02x}"]
+    if audio_codec is not None:
+        codecs.append(AUDIO_CODEC_NAMES.get(audio_codec, AUDIO_CODEC_NAMES["aac"]))
+    return ",".join(codecs)
+
+def get_dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(parent_dir, filename))
+        for parent_dir, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+def parse_ladder(value):
+    # e.g. "360:800k:96k,720:2800k:128k"
+    ladder = []
+    for rung in parse_list(value):
+        height, video_bitrate, audio_bitrate = rung.split(":")
+        ladder.append(LadderRung(int(height), parse_bitrate(video_bitrate), parse_bitrate(audio_bitrate)))
+    return sorted(ladder)
+
+def parse_bitrate(value):
+    value = value.strip().lower()
+    multiplier = {"k": 1000, "m": 1000000}.get(value[-1:], 1)
+    return int(float(value.rstrip("km")) * multiplier)
+
+def parse_list(value, item_type=str):
+    return [item_type(item.strip()) for item in value.split(",") if item.strip()]
+
+# Everything later stages need to know about a file, from a single ffprobe run
+def probe_media(filename):
+    probe = ffmpeg.probe(filename)
+    media_format = probe.get("format", {})
+    streams = probe.get("streams", [])
+    # cover art is stored as a video stream
+    video_streams = [
+        stream for stream in streams
+        if stream.get("codec_type") == "video"
+        and not stream.get("disposition", {}).get("attached_pic")
+    ]
+    audio_streams = [stream for stream in streams if stream.get("codec_type") == "audio"]
+    video = video_streams[0] if video_streams else {}
+    audio = audio_streams[0] if audio_streams else {}
+    return {
+        "container": media_format.get("format_name"),
+        "duration": parse_number(media_format.get("duration"), float),
+        "bitrate": parse_number(media_format.get("bit_rate"), int),
+        "video_codec": video.get("codec_name"),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "frame_rate": parse_frame_rate(video.get("avg_frame_rate") or video.get("r_frame_rate")),
+        "pixel_format": video.get("pix_fmt"),
+        "audio_codec": audio.get("codec_name"),
+        "audio_channels": audio.get("channels"),
+        "audio_tracks": json.dumps([
+            {
+                "codec": stream.get("codec_name"),
+                "channels": stream.get("channels"),
+                "language": stream.get("tags", {}).get("language"),
+            }
+            for stream in audio_streams
+        ]),
+    }
+
+def check_thumb_formats(thumb_formats):
+    # unknown formats are configuration errors, formats this ffmpeg build cannot encode are left out
+    for thumb_format in thumb_formats:
+        if thumb_format not in THUMB_FORMATS:
+            raise ValueError(f"Unknown thumbnail format '{thumb_format}'")
+    encoders = get_encoders()
+    if encoders is None:
+        return thumb_formats
+    usable_formats = []
+    for thumb_format in thumb_formats:
+        encoder = THUMB_FORMATS[thumb_format][2]["vcodec"]
+        if encoder in encoders:
+            usable_formats.append(thumb_format)
+        else:
+            logger.warning(f"Thumbnail format '{thumb_format}' disabled, ffmpeg has no '{encoder}' encoder")
+    if not usable_formats:
+        raise ValueError("No configured thumbnail format can be encoded")
+    return usable_formats
+
+def get_encoders():
+    # encoder names of the ffmpeg build, None when it cannot be run
+    try:
+        output = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # e.g. " V....D libx264              libx264 H.264 / AVC ..."
+    return {
+        fields[1] for fields in map(str.split, output.decode("utf-8", "replace").splitlines())
+        if len(fields) >= 2 and len(fields[0]) == 6 and fields[1] != "="
+    }
+
+def parse_number(value, number_type):
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_frame_rate(value):
+    # e.g. "30000/1001"
+    numerator, _, denominator = (value or "").partition("/")
+    numerator = parse_number(numerator, float)
+    denominator = parse_number(denominator or "1", float)
+    if not numerator or not denominator:
+        return None
+    return numerator / denominator
+
+
+class ProcessError(ffmpeg.Error):
 
-# Gets video duration in seconds
-def get_video_duration(filename):
-    return int(round(float(ffmpeg.probe(filename)["format"]["duration"])))
\ No newline at end of file
+    def __init__(self, cmd, returncode, stderr):
+        self.returncode = returncode
+        super().__init__(cmd, b"", stderr)
@@ -0,0 +1,1091 @@
+import base64
+import hashlib
+import json
+import os
+from datetime import datetime
+from functools import partial
+from functools import wraps
+from traceback import format_exception
+from uuid import UUID, uuid4
+
+# Quart
+from quart import Blueprint
+from quart import current_app
+from quart import jsonify
+from quart import redirect
+from quart import render_template
+from quart import request
+from quart import send_file
+from quart import url_for
+from quart.helpers import safe_join
+# Quart-Auth extenstion
+from quart_auth import AuthUser as QuartAuthUser
+from quart_auth import current_user
+from quart_auth import login_user
+from quart_auth import login_required
+from quart_auth import logout_user
+from quart_auth import Unauthorized
+# Werkzeug library
+from werkzeug.exceptions import HTTPException
+
+# Custom authenticator class
+from visiverse.authenticator import AuthError
+# Custom database and types
+from visiverse.database import Collection
+from visiverse.database import CollectionType
+from visiverse.database import MediaType
+from visiverse.database import Media
+from visiverse.database import Person
+from visiverse.database import Organization
+from visiverse.database import MEDIA_LIST_COLUMNS
+from visiverse.database import MEDIA_TILE_LOAD
+from visiverse.database import MEDIA_VIEW_LOAD
+# Faceted browsing
+from visiverse.facets import build_filters
+from visiverse.facets import parse_filters
+# Background jobs
+from visiverse.jobs import JobError
+from visiverse.jobs import JobState
+from visiverse.jobs import PRIORITY_DEFAULT
+from visiverse.jobs import PRIORITY_INTERACTIVE
+# Instrumentation
+from visiverse.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+# JSON serialization
+from visiverse.serializers import COLLECTION_SERIALIZER
+from visiverse.serializers import MEDIA_SERIALIZER
+from visiverse.serializers import ORGANIZATION_SERIALIZER
+from visiverse.serializers import PERSON_SERIALIZER
+# Media file streaming
+from visiverse.streaming import file_etag
+# Custom FFmpeg wrapper
+from visiverse.transcoder import PLAY_DIRECT
+from visiverse.transcoder import PLAY_REMUX
+from visiverse.transcoder import SOURCE_RENDITION
+from visiverse.transcoder import THUMB_FORMATS
+
+
+# pages, API and files, registered on the app by create_app
+bp = Blueprint("visiverse", __name__)
+
+
+# ********** Response Cache **********
+
+# set again for every response
+UNCACHED_HEADERS = {"content-length", "set-cookie", "date", "etag", "cache-control", "vary"}
+
+def cache_response(route):
+    # for GET routes whose output only depends on the library, the arguments and the user
+    @wraps(route)
+    async def cached_route(*args, **kwargs):
+        return await send_cached_response(partial(route, *args, **kwargs))
+    return cached_route
+
+async def send_cached_response(build_response):
+    if current_app.response_cache is None or request.method != "GET":
+        return await build_response()
+    # commits bump the generation, leaving older entries to age out
+    cache_key = (
+        current_app.db.generation,
+        request.endpoint,
+        tuple(sorted(request.view_args.items())),
+        tuple(sorted(request.args.items(multi=True))),
+        current_user.auth_id,
+    )
+    entry = current_app.response_cache.get(cache_key)
+    if entry is None:
+        response = await current_app.make_response(await build_response())
+        if response.status_code != 200:
+            return response
+        body = await response.get_data()
+        headers = [
+            (name, value) for name, value in response.headers.items()
+            if name.lower() not in UNCACHED_HEADERS
+        ]
+        entry = (hashlib.blake2b(body, digest_size=16).hexdigest(), body, headers)
+        current_app.response_cache.set(cache_key, entry)
+    etag, body, headers = entry
+    response = current_app.response_class(body, 200, headers)
+    response.set_etag(etag, weak=True)
+    # browsers revalidate every time, unchanged pages cost a 304
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return await response.make_conditional(request)
+
+
+# ********** Frontend Page Routes **********
+
+@bp.route("/")
+@cache_response
+async def page_home():
+    try:
+        cursor, limit = get_page_args()
+        async with current_app.db.read_session() as session:
+            media_items, next_cursor = await current_app.db.select_media_page(
+                session, cursor, limit, load=MEDIA_TILE_LOAD
+            )
+            return await render_template(
+                "pages/home.html",
+                media_items=media_items,
+                next_cursor=encode_cursor(next_cursor),
+            )
+    except ValueError as e:
+        return await page_exception(e)
+
+@bp.route("/fragments/media_tiles")
+@cache_response
+async def page_media_tiles():
+    try:
+        cursor, limit = get_page_args()
+        async with current_app.db.read_session() as session:
+            media_items, next_cursor = await current_app.db.select_media_page(
+                session, cursor, limit, load=MEDIA_TILE_LOAD
+            )
+            tiles = await render_template("features/media_tiles.html", media_items=media_items)
+            return tiles, 200, {"X-Next-Cursor": encode_cursor(next_cursor) or ""}
+    except ValueError as e:
+        return await page_exception(e)
+
+@bp.route("/view/<string:media_id>")
+async def page_view(media_id: str):
+    try:
+        media_uuid = b64_to_uuid(media_id)
+        media_info = await current_app.media_lookup.get(media_uuid)
+        if media_info is None:
+            return await page_error("Not found", 404)
+        # counted even when the page comes from the response cache
+        current_app.add_background_task(record_view, media_info)
+        collection_id = request.args.get("collection")
+        if collection_id:
+            current_app.add_background_task(prefetch_next, UUID(collection_id), media_uuid)
+        return await send_cached_response(partial(render_view_page, media_uuid, media_info))
+    except ValueError as e:
+        return await page_exception(e)
+
+async def render_view_page(media_uuid, media_info):
+    async with current_app.db.read_session() as session:
+        result = await current_app.db.select_object(session, Media, media_uuid, load=MEDIA_VIEW_LOAD)
+        if result is None:
+            return await page_error("Not found", 404)
+        # TODO render page
+        return await render_template(
+            "pages/view.html",
+            media=result,
+            media_info=media_info,
+            play_mode=current_app.transcoder.get_play_mode(media_info),
+        )
+
+@bp.route("/search")
+@cache_response
+async def page_search():
+    query = request.args.get("q", "")
+    async with current_app.db.read_session() as session:
+        media_items, _ = await current_app.search.search(
+            session, query, current_app.app_config.getint("library", "page_size")
+        )
+    return await render_template("pages/search.html", query=query, media_items=media_items)
+
+@bp.route("/login")
+async def page_login():
+    return await render_template("pages/login.html")
+
+
+# ********** Frontend Error Templates **********
+
+async def page_error(message, code=400):
+    # TODO render error page
+    return api_error(message, code)
+
+async def page_exception(e, code=400):
+    return await page_error(f"{type(e).__name__}: {e}", code)
+
+
+# ********** Backend API Routes **********
+
+@bp.route("/api/media/info/<string:media_id>")
+@cache_response
+async def api_media_info(media_id: str):
+    try:
+        media_uuid = UUID(media_id)
+        field_names = MEDIA_SERIALIZER.parse_fields(request.args.get("fields"))
+        async with current_app.db.read_session() as session:
+            result = await current_app.db.select_object(
+                session, Media, media_uuid, load=MEDIA_SERIALIZER.get_load_plan(field_names)
+            )
+            if result is None:
+                return api_error("Not found", 404)
+            return api_success(MEDIA_SERIALIZER.serialize(result, field_names))
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/media/batch", methods=["GET", "POST"])
+@cache_response
+async def api_media_batch():
+    return await send_object_batch(Media, MEDIA_SERIALIZER)
+
+@bp.route("/api/media/<string:media_id>/duplicates")
+async def api_media_duplicates(media_id: str):
+    try:
+        media_uuid = UUID(media_id)
+        if await current_app.media_lookup.get(media_uuid) is None:
+            return api_error("Not found", 404)
+        matches = await current_app.duplicates.find_duplicates(media_uuid, request.args.get("distance", type=int))
+        if matches is None:
+            return api_error("Media has no frame hash yet", 404)
+        matches = matches[:current_app.app_config.getint("library", "max_page_size")]
+        async with current_app.db.read_session() as session:
+            found = await current_app.db.select_objects(
+                session, Media, [match_id for match_id, _ in matches], load={"*": "raise"}
+            )
+            found = {target.id: target for target in found}
+            # closest first
+            return api_success({
+                "items": [
+                    {**MEDIA_SERIALIZER.serialize(found[match_id], MEDIA_LIST_COLUMNS), "distance": distance}
+                    for match_id, distance in matches if match_id in found
+                ],
+            })
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/media/list")
+@cache_response
+async def api_media_list():
+    try:
+        cursor, limit = get_page_args()
+        async with current_app.db.read_session() as session:
+            media_items, next_cursor = await current_app.db.select_media_page(
+                session, cursor, limit, columns=MEDIA_LIST_COLUMNS
+            )
+            return api_success({
+                "items": MEDIA_SERIALIZER.serialize_many(media_items, MEDIA_LIST_COLUMNS),
+                "next_cursor": encode_cursor(next_cursor),
+            })
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/media/browse")
+@cache_response
+async def api_media_browse():
+    try:
+        filters = parse_filters(request.args)
+        cursor, limit = get_page_args()
+        async with current_app.db.read_session() as session:
+            media_items, next_cursor = await current_app.db.select_media_page(
+                session, cursor, limit, columns=MEDIA_LIST_COLUMNS, where=build_filters(filters)
+            )
+            facet_counts = await current_app.facets.counts(session, filters)
+            return api_success({
+                "items": MEDIA_SERIALIZER.serialize_many(media_items, MEDIA_LIST_COLUMNS),
+                "next_cursor": encode_cursor(next_cursor),
+                "facets": facet_counts,
+            })
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/search")
+@cache_response
+async def api_search():
+    query = request.args.get("q", "")
+    limit = max(1, min(request.args.get("limit", 20, type=int), current_app.app_config.getint("library", "max_page_size")))
+    page = max(1, request.args.get("page", 1, type=int))
+    async with current_app.db.read_session() as session:
+        rows, has_more = await current_app.search.search(session, query, limit, (page - 1) * limit)
+    return api_success({
+        "items": MEDIA_SERIALIZER.serialize_many(rows, MEDIA_LIST_COLUMNS),
+        "page": page,
+        "has_more": has_more,
+    })
+
+@bp.route("/api/person/info/<string:person_id>")
+@cache_response
+async def api_person_info(person_id: str):
+    try:
+        person_uuid = UUID(person_id)
+        field_names = PERSON_SERIALIZER.parse_fields(request.args.get("fields"))
+        async with current_app.db.read_session() as session:
+            result = await current_app.db.select_object(
+                session, Person, person_uuid, load=PERSON_SERIALIZER.get_load_plan(field_names)
+            )
+            if result is None:
+                return api_error("Not found", 404)
+            return api_success(PERSON_SERIALIZER.serialize(result, field_names))
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/person/batch", methods=["GET", "POST"])
+@cache_response
+async def api_person_batch():
+    return await send_object_batch(Person, PERSON_SERIALIZER)
+
+@bp.route("/api/organization/info/<string:org_id>")
+@cache_response
+async def api_organization_info(org_id: str):
+    try:
+        org_uuid = UUID(org_id)
+        field_names = ORGANIZATION_SERIALIZER.parse_fields(request.args.get("fields"))
+        async with current_app.db.read_session() as session:
+            result = await current_app.db.select_object(
+                session, Organization, org_uuid, load=ORGANIZATION_SERIALIZER.get_load_plan(field_names)
+            )
+            if result is None:
+                return api_error("Not found", 404)
+            return api_success(ORGANIZATION_SERIALIZER.serialize(result, field_names))
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/organization/batch", methods=["GET", "POST"])
+@cache_response
+async def api_organization_batch():
+    return await send_object_batch(Organization, ORGANIZATION_SERIALIZER)
+
+async def send_object_batch(object_class, serializer):
+    # ?ids=a,b&fields=..., or a JSON body {"ids": [...]} for long lists
+    try:
+        if request.method == "POST":
+            batch_options = await request.get_json(silent=True) or {}
+            if not isinstance(batch_options, dict):
+                raise ValueError("Expected a JSON object")
+            object_ids = batch_options.get("ids", [])
+            fields_arg = batch_options.get("fields")
+            if isinstance(fields_arg, list):
+                fields_arg = ",".join(map(str, fields_arg))
+        else:
+            object_ids = [
+                object_id for ids_arg in request.args.getlist("ids") for object_id in ids_arg.split(",")
+            ]
+            fields_arg = request.args.get("fields")
+        object_uuids = list(dict.fromkeys(UUID(str(object_id)) for object_id in object_ids if object_id))
+        if len(object_uuids) > current_app.app_config.getint("library", "max_page_size"):
+            raise ValueError(f"At most {current_app.app_config.getint('library', 'max_page_size')} ids per batch")
+        field_names = serializer.parse_fields(fields_arg)
+        async with current_app.db.read_session() as session:
+            found = await current_app.db.select_objects(
+                session, object_class, object_uuids, load=serializer.get_load_plan(field_names)
+            )
+            found = {target.id: target for target in found}
+            # in the order asked for
+            return api_success({
+                "items": [
+                    serializer.serialize(found[object_uuid], field_names)
+                    for object_uuid in object_uuids if object_uuid in found
+                ],
+                "missing": [str(object_uuid) for object_uuid in object_uuids if object_uuid not in found],
+            })
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/collection/list")
+@cache_response
+async def api_collection_list():
+    limit = max(1, min(request.args.get("limit", 50, type=int), current_app.app_config.getint("library", "max_page_size")))
+    page = max(1, request.args.get("page", 1, type=int))
+    async with current_app.db.read_session() as session:
+        collections, has_more = await current_app.collections.select_collections(session, limit, (page - 1) * limit)
+    return api_success({
+        "items": COLLECTION_SERIALIZER.serialize_many(collections),
+        "page": page,
+        "has_more": has_more,
+    })
+
+@bp.route("/api/collection/create", methods=["POST"])
+@login_required
+async def api_collection_create():
+    try:
+        collection_data = await get_json_object()
+        collection = Collection(
+            id=uuid4(),
+            name=get_collection_name(collection_data),
+            description=collection_data.get("description"),
+            type=get_collection_type(collection_data.get("type", "playlist")),
+        )
+        async with current_app.db.async_session() as session, session.begin():
+            await current_app.db.insert_object(session, collection)
+        return api_success(COLLECTION_SERIALIZER.serialize(collection))
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/collection/info/<string:collection_id>")
+@cache_response
+async def api_collection_info(collection_id: str):
+    try:
+        collection_uuid = UUID(collection_id)
+        async with current_app.db.read_session() as session:
+            collection = await current_app.db.select_object(session, Collection, collection_uuid, load={"*": "raise"})
+            if collection is None:
+                return api_error("Not found", 404)
+            return api_success({
+                **COLLECTION_SERIALIZER.serialize(collection),
+                "count": await current_app.collections.count_members(session, collection_uuid),
+            })
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/collection/<string:collection_id>/update", methods=["POST"])
+@login_required
+async def api_collection_update(collection_id: str):
+    try:
+        collection_uuid = UUID(collection_id)
+        collection_data = await get_json_object()
+        async with current_app.db.async_session() as session, session.begin():
+            # through the unit of work, a rename reaches the search index
+            collection = await current_app.db.select_object(session, Collection, collection_uuid, load={"*": "raise"})
+            if collection is None:
+                return api_error("Not found", 404)
+            if "name" in collection_data:
+                collection.name = get_collection_name(collection_data)
+            if "description" in collection_data:
+                collection.description = collection_data["description"]
+            if "type" in collection_data:
+                collection.type = get_collection_type(collection_data["type"])
+        return api_success(COLLECTION_SERIALIZER.serialize(collection))
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/collection/<string:collection_id>/delete", methods=["POST"])
+@login_required
+async def api_collection_delete(collection_id: str):
+    try:
+        collection_uuid = UUID(collection_id)
+        async with current_app.db.async_session() as session, session.begin():
+            if await current_app.db.select_object(session, Collection, collection_uuid, load={"*": "raise"}) is None:
+                return api_error("Not found", 404)
+            await current_app.collections.delete_collection(session, collection_uuid)
+        return api_success()
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/collection/<string:collection_id>/members")
+@cache_response
+async def api_collection_members(collection_id: str):
+    try:
+        collection_uuid = UUID(collection_id)
+        cursor, limit = get_page_args(decode_position_cursor)
+        async with current_app.db.read_session() as session:
+            rows, next_cursor = await current_app.collections.select_members(
+                session, collection_uuid, cursor, limit, MEDIA_LIST_COLUMNS
+            )
+            return api_success({
+                "items": serialize_members(rows),
+                "next_cursor": encode_position_cursor(next_cursor),
+            })
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/collection/<string:collection_id>/members", methods=["POST"])
+@login_required
+async def api_collection_add(collection_id: str):
+    # {"media_ids": [...], "after": id} or "before", appended when neither is given
+    try:
+        collection_uuid = UUID(collection_id)
+        member_data = await get_json_object()
+        media_uuids = get_media_uuids(member_data)
+        after, before = get_anchor(member_data, "after"), get_anchor(member_data, "before")
+        async with current_app.db.async_session() as session, session.begin():
+            if await current_app.db.select_object(session, Collection, collection_uuid, load={"*": "raise"}) is None:
+                return api_error("Not found", 404)
+            added = await current_app.collections.add_members(session, collection_uuid, media_uuids, after, before)
+        return api_success({"added": [str(media_uuid) for media_uuid in added]})
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/collection/<string:collection_id>/members/remove", methods=["POST"])
+@login_required
+async def api_collection_remove(collection_id: str):
+    try:
+        collection_uuid = UUID(collection_id)
+        media_uuids = get_media_uuids(await get_json_object())
+        async with current_app.db.async_session() as session, session.begin():
+            await current_app.collections.remove_members(session, collection_uuid, media_uuids)
+        return api_success()
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/collection/<string:collection_id>/move", methods=["POST"])
+@login_required
+async def api_collection_move(collection_id: str):
+    # {"media_id": id, "after": id} or "before", to the end when neither is given
+    try:
+        collection_uuid = UUID(collection_id)
+        move_data = await get_json_object()
+        media_uuid = UUID(str(move_data.get("media_id")))
+        after, before = get_anchor(move_data, "after"), get_anchor(move_data, "before")
+        async with current_app.db.async_session() as session, session.begin():
+            await current_app.collections.move_member(session, collection_uuid, media_uuid, after, before)
+        return api_success()
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/collection/<string:collection_id>/play/<string:media_id>")
+async def api_collection_play(collection_id: str, media_id: str):
+    # what comes before and after, with the next items warmed in the background
+    try:
+        collection_uuid = UUID(collection_id)
+        media_uuid = UUID(media_id)
+        count = max(1, min(request.args.get("next", 1, type=int), current_app.app_config.getint("library", "max_page_size")))
+        async with current_app.db.read_session() as session:
+            neighbors = await current_app.collections.select_neighbors(
+                session, collection_uuid, media_uuid, count, MEDIA_LIST_COLUMNS
+            )
+        if neighbors is None:
+            return api_error("Not found", 404)
+        previous, next_rows = neighbors
+        current_app.add_background_task(current_app.prefetcher.warm, [row.id for row in next_rows])
+        return api_success({
+            "previous": serialize_members([previous])[0] if previous is not None else None,
+            "next": serialize_members(next_rows),
+        })
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/library/import", methods=["POST"])
+@login_required
+async def api_library_import():
+    if current_app.importer.running:
+        return api_error("Import already running", 409)
+    import_options = await request.get_json(silent=True) or {}
+    current_app.add_background_task(
+        current_app.importer.import_library,
+        tags=import_options.get("tags", []),
+    )
+    return api_success()
+
+@bp.route("/api/library/import")
+@login_required
+async def api_library_import_status():
+    return api_success({
+        **current_app.importer.progress.to_dict(),
+        "watcher": current_app.watcher.stats() if current_app.watcher is not None else None,
+    })
+
+@bp.route("/api/library/duplicates")
+@login_required
+async def api_library_duplicates():
+    try:
+        limit = max(1, min(request.args.get("limit", 50, type=int), current_app.app_config.getint("library", "max_page_size")))
+        groups = await current_app.duplicates.find_groups(request.args.get("distance", type=int))
+        return api_success({
+            "groups": [[str(media_id) for media_id in group] for group in groups[:limit]],
+            "total_groups": len(groups),
+            "total_media": sum(len(group) for group in groups),
+        })
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/jobs")
+@login_required
+async def api_jobs():
+    try:
+        state = request.args.get("state")
+        if state is not None:
+            state = JobState[state]
+        limit = max(1, min(request.args.get("limit", 50, type=int), current_app.app_config.getint("library", "max_page_size")))
+        async with current_app.db.async_session() as session:
+            jobs, counts = await current_app.jobs.list_jobs(session, state, limit)
+        return api_success({
+            "items": [
+                {
+                    "id": job.id,
+                    "kind": job.kind,
+                    "media_id": job.media_id,
+                    "args": json.loads(job.args),
+                    "priority": job.priority,
+                    "state": job.state.name,
+                    "attempts": job.attempts,
+                    "progress": current_app.jobs.get_progress(job),
+                    "error": job.error,
+                    "created": job.created.isoformat(),
+                    "finished": job.finished.isoformat() if job.finished else None,
+                }
+                for job in jobs
+            ],
+            "counts": counts,
+            "running": len(current_app.jobs.progress),
+            "workers": current_app.jobs.workers,
+        })
+    except KeyError as e:
+        return api_error(f"Unknown job state {e}")
+
+@bp.route("/api/jobs", methods=["POST"])
+@login_required
+async def api_jobs_submit():
+    try:
+        job_options = await get_json_object()
+        media_id = job_options.get("media_id")
+        job_args = job_options.get("args", {})
+        if not isinstance(job_args, dict):
+            raise ValueError("Job args must be an object")
+        job_id = await current_app.jobs.submit(
+            job_options.get("kind"),
+            UUID(media_id) if media_id else None,
+            int(job_options.get("priority", PRIORITY_DEFAULT)),
+            **job_args,
+        )
+        return api_success({"id": job_id})
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/api/stats/cache")
+@login_required
+async def api_cache_stats():
+    return api_success({
+        "media_lookup": current_app.media_lookup.cache.stats(),
+        "facets": current_app.facets.cache.stats(),
+        "responses": current_app.response_cache.stats() if current_app.response_cache is not None else None,
+    })
+
+@bp.route("/metrics")
+async def api_metrics():
+    # scrapers cannot log in, public metrics must stay on an internal network
+    if not current_app.metrics.public and not await current_user.is_authenticated:
+        raise Unauthorized()
+    return current_app.metrics.render(), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
+@bp.route("/api/stats/renditions")
+@login_required
+async def api_rendition_stats():
+    async with current_app.db.read_session() as session:
+        usage = await current_app.db.get_rendition_usage(session)
+    return api_success({
+        "count": sum(count for _, count, _ in usage),
+        "size": sum(size for _, _, size in usage),
+        "heights": {height: {"count": count, "size": size} for height, count, size in usage},
+    })
+
+@bp.route("/api/stats/auth")
+@login_required
+async def api_auth_stats():
+    return api_success(current_app.auth.stats())
+
+
+# ********** Backend Files Routes **********
+
+@bp.route("/assets/<path:filename>")
+async def template_assets(filename: str):
+    return await render_template(safe_join("assets", filename))
+
+@bp.route("/files/media/<string:media_id>")
+async def files_media(media_id: str):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        return await current_app.streamer.send(request, result.filename, result.mimetype)
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/files/thumbs/<string:media_id>")
+async def files_thumbs(media_id: str):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        thumb_width = current_app.transcoder.get_thumb_width(request.args.get("w", type=int))
+        thumb_format = request.args.get("fmt") or negotiate_thumb_format()
+        current_app.transcoder.check_thumbnail(result, thumb_format)
+        thumb_filename = current_app.transcoder.get_thumb_filename(media_uuid, thumb_width, thumb_format)
+        if not os.path.isfile(thumb_filename):
+            await current_app.jobs.run("thumbnail", media_uuid, format=thumb_format)
+        response = await send_cached_file(
+            thumb_filename,
+            THUMB_FORMATS[thumb_format][1],
+            current_app.app_config.getint("thumbs", "max_age"),
+        )
+        response.vary.add("Accept")
+        return response
+    except JobError as e:
+        return api_error(f"Thumbnail unavailable: {e}", 503)
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/files/storyboard/<string:media_id>/<string:filename>")
+async def files_storyboard(media_id: str, filename: str):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        current_app.transcoder.check_storyboard(result)
+        storyboard_dir = current_app.transcoder.get_storyboard_dir(media_uuid)
+        if not os.path.isdir(storyboard_dir):
+            await current_app.jobs.run("storyboard", media_uuid)
+        storyboard_filename = safe_join(storyboard_dir, filename)
+        if not os.path.isfile(storyboard_filename):
+            return api_error("Not found", 404)
+        mimetype = "text/vtt" if filename.endswith(".vtt") else "image/jpeg"
+        return await send_cached_file(
+            storyboard_filename, mimetype, current_app.app_config.getint("storyboard", "max_age")
+        )
+    except JobError as e:
+        return api_error(f"Storyboard unavailable: {e}", 503)
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/files/hls/<string:media_id>/index.m3u8")
+async def files_hls_playlist(media_id: str):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        playlist = current_app.transcoder.create_playlist(result)
+        return playlist, 200, {"Content-Type": "application/vnd.apple.mpegurl"}
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/files/hls/<string:media_id>/master.m3u8")
+async def files_hls_master(media_id: str):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        current_app.transcoder.get_segment_count(result)
+        if current_app.transcoder.get_play_mode(result) == PLAY_REMUX:
+            # copying the original takes a moment, it joins the playlist once done,
+            # after a failure the ladder alone plays it
+            if not current_app.transcoder.has_rendition(media_uuid, SOURCE_RENDITION):
+                await current_app.jobs.submit_unless_failed("remux", media_uuid, PRIORITY_INTERACTIVE)
+        playlist = current_app.transcoder.create_master_playlist(result)
+        return playlist, 200, {"Content-Type": "application/vnd.apple.mpegurl"}
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/files/hls/<string:media_id>/<int:height>/index.m3u8")
+async def files_hls_variant(media_id: str, height: int):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        current_app.transcoder.get_rung(height)
+        # transcoded renditions replace the on-demand segments
+        if current_app.transcoder.has_rendition(media_uuid, height):
+            rendition_dir = current_app.transcoder.get_rendition_dir(media_uuid, height)
+            return await send_file(
+                f"{rendition_dir}/index.m3u8", mimetype="application/vnd.apple.mpegurl"
+            )
+        playlist = current_app.transcoder.create_playlist(result)
+        return playlist, 200, {"Content-Type": "application/vnd.apple.mpegurl"}
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/files/hls/<string:media_id>/source/<string:filename>")
+async def files_hls_source(media_id: str, filename: str):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        rendition_dir = current_app.transcoder.get_rendition_dir(media_uuid, SOURCE_RENDITION)
+        source_filename = safe_join(rendition_dir, filename)
+        if not os.path.isfile(source_filename):
+            return api_error("Not found", 404)
+        if filename.endswith(".m3u8"):
+            return await send_file(source_filename, mimetype="application/vnd.apple.mpegurl")
+        if not filename.endswith((".mp4", ".m4s")):
+            return api_error("Not found", 404)
+        return await send_cached_file(
+            source_filename, "video/mp4", current_app.app_config.getint("renditions", "max_age")
+        )
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/files/hls/<string:media_id>/<int:height>/<int:segment>.ts")
+async def files_hls_variant_segment(media_id: str, height: int, segment: int):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        current_app.transcoder.get_rung(height)
+        segment_count = current_app.transcoder.get_segment_count(result)
+        if segment >= segment_count:
+            return api_error("Not found", 404)
+        segment_filename = await current_app.jobs.ensure_segment(result, segment, PRIORITY_INTERACTIVE, height)
+        readahead_end = min(segment_count, segment + 1 + current_app.transcoder.readahead)
+        for next_segment in range(segment + 1, readahead_end):
+            current_app.add_background_task(
+                current_app.jobs.ensure_segment, result, next_segment, PRIORITY_DEFAULT, height
+            )
+        return await send_file(segment_filename, mimetype="video/mp2t")
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/files/hls/<string:media_id>/<int:height>/<string:filename>")
+async def files_hls_rendition(media_id: str, height: int, filename: str):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        rendition_dir = current_app.transcoder.get_rendition_dir(media_uuid, height)
+        rendition_filename = safe_join(rendition_dir, filename)
+        if not filename.endswith((".mp4", ".m4s")) or not os.path.isfile(rendition_filename):
+            return api_error("Not found", 404)
+        return await send_cached_file(
+            rendition_filename, "video/mp4", current_app.app_config.getint("renditions", "max_age")
+        )
+    except ValueError as e:
+        return api_exception(e)
+
+@bp.route("/files/hls/<string:media_id>/<int:segment>.ts")
+async def files_hls_segment(media_id: str, segment: int):
+    try:
+        media_uuid = UUID(media_id)
+        result = await current_app.media_lookup.get(media_uuid)
+        if result is None:
+            return api_error("Not found", 404)
+        segment_count = current_app.transcoder.get_segment_count(result)
+        if segment >= segment_count:
+            return api_error("Not found", 404)
+        segment_filename = await current_app.jobs.ensure_segment(result, segment, PRIORITY_INTERACTIVE)
+        # prepare the next few segments in the background
+        readahead_end = min(segment_count, segment + 1 + current_app.transcoder.readahead)
+        for next_segment in range(segment + 1, readahead_end):
+            current_app.add_background_task(current_app.jobs.ensure_segment, result, next_segment, PRIORITY_DEFAULT)
+        return await send_file(segment_filename, mimetype="video/mp2t")
+    except ValueError as e:
+        return api_exception(e)
+
+async def send_cached_file(filename, mimetype, max_age):
+    # derived files only change along with their source, which replaces them
+    response = await send_file(
+        filename,
+        mimetype=mimetype,
+        add_etags=False,
+        cache_timeout=max_age,
+    )
+    stat = os.stat(filename)
+    response.set_etag(file_etag(filename, stat))
+    response.cache_control.immutable = True
+    return await response.make_conditional(
+        request, accept_ranges=True, complete_length=stat.st_size
+    )
+
+
+# ********** Authentication & Routes **********
+
+class AuthUser(QuartAuthUser):
+
+    def __init__(self, auth_id):
+        super().__init__(auth_id)
+        self._resolved = False
+        self._db_user = None
+
+    async def _resolve(self):
+        # users are loaded for each request, resolve once per request
+        if not self._resolved:
+            self._db_user = await current_app.auth.get_user(self.auth_id)
+            self._resolved = True
+
+    @property
+    async def db_user(self):
+        await self._resolve()
+        return self._db_user
+
+
+@bp.route("/auth/login", methods=["POST"])
+async def auth_login():
+    try:
+        login_data = await request.get_json()
+        user = await current_app.auth.authenticate(
+            login_data["username"],
+            login_data["password"],
+        )
+    except KeyError:
+        return api_error("Missing credentials")
+    except AuthError as e:
+        return api_error(e.message)
+    login_user(AuthUser(user.username))
+    return api_success()
+
+@bp.route("/auth/logout")
+async def auth_logout():
+    logout_user()
+    return api_success()
+
+
+# ********** Backend Response Templates **********
+
+def api_success(data={}):
+    return jsonify({
+        "result": "success",
+        "data": data
+    }), 200
+
+def api_error(message, code=400):
+    return jsonify({
+        "result": "error",
+        "message": message
+    }), code
+
+def api_exception(e, code=400):
+    return api_error(f"{type(e).__name__}: {e}", code)
+
+
+# ********** Library Operations **********
+
+async def record_view(media):
+    async with current_app.db.async_session() as session, session.begin():
+        views = await current_app.db.count_view(session, media.id)
+    if MediaType.video != media.type or media.duration is None:
+        return
+    # popular media is transcoded ahead of time, the long tail on demand
+    if views < current_app.app_config.getint("renditions", "popular_views"):
+        return
+    # browsers play the original itself
+    if current_app.transcoder.get_play_mode(media) == PLAY_DIRECT:
+        return
+    missing = [
+        rung for rung in current_app.transcoder.get_ladder(media)
+        if not current_app.transcoder.has_rendition(media.id, rung.height)
+    ]
+    if not missing:
+        return
+    # failed rungs are left to on-demand segments until the failure ages out
+    failed_args = await current_app.jobs.select_failed_args("rendition", media.id)
+    for rung in missing:
+        if {"height": rung.height} not in failed_args:
+            await current_app.jobs.submit("rendition", media.id, PRIORITY_DEFAULT, height=rung.height)
+
+async def prefetch_next(collection_uuid, media_uuid):
+    async with current_app.db.read_session() as session:
+        neighbors = await current_app.collections.select_neighbors(
+            session, collection_uuid, media_uuid, current_app.prefetcher.items
+        )
+    if neighbors is not None:
+        await current_app.prefetcher.warm([row.id for row in neighbors[1]])
+
+
+# ********** Template & Request Helpers **********
+
+@bp.app_context_processor
+def utility_processor():
+    # Template utility functions
+    return dict(
+        uuid_to_b64=uuid_to_b64,
+        format_duration=format_duration,
+        thumb_formats=current_app.transcoder.thumb_formats,
+        thumb_mimetype=lambda thumb_format: THUMB_FORMATS[thumb_format][1],
+        thumb_srcset=thumb_srcset,
+        # tile widths from the grid breakpoints in custom.css
+        thumb_sizes="(min-width: 1200px) 340px, (min-width: 700px) 33vw, 100vw",
+    )
+
+@bp.app_errorhandler(Unauthorized)
+async def redirect_to_login(*_: Exception):
+    return redirect(url_for("visiverse.page_login"))
+
+@bp.app_errorhandler(Exception)
+async def handle_exception(e: Exception):
+    # pass through HTTP errors
+    if isinstance(e, HTTPException):
+        return e
+    current_app.logger.error(f"Uncaught exception")
+    for line in format_exception(e):
+        current_app.logger.error(line.rstrip("\n"))
+    return api_exception(e, 500)
+
+def uuid_to_b64(uuid_value):
+    return base64.urlsafe_b64encode(uuid_value.bytes).decode("utf-8").rstrip("=")
+
+def b64_to_uuid(b64_value):
+    return UUID(bytes=base64.urlsafe_b64decode(b64_value + "=="))
+
+def thumb_srcset(media_id, thumb_format):
+    return ", ".join(
+        f"{url_for('.files_thumbs', media_id=media_id, w=width, fmt=thumb_format)} {width}w"
+        for width in current_app.transcoder.thumb_widths
+    )
+
+def negotiate_thumb_format():
+    # best configured format the client names explicitly, wildcards only promise jpeg
+    accepted = set(mimetype for mimetype, quality in request.accept_mimetypes if quality > 0)
+    for thumb_format in current_app.transcoder.thumb_formats:
+        if THUMB_FORMATS[thumb_format][1] in accepted:
+            return thumb_format
+    return "jpeg"
+
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+    created, media_id = cursor
+    cursor_value = f"{created.isoformat()}|{media_id.hex}"
+    return base64.urlsafe_b64encode(cursor_value.encode("utf-8")).decode("utf-8").rstrip("=")
+
+def decode_cursor(b64_value):
+    cursor_value = base64.urlsafe_b64decode(b64_value + "==").decode("utf-8")
+    created, media_id = cursor_value.split("|")
+    return datetime.fromisoformat(created), UUID(media_id)
+
+def encode_position_cursor(cursor):
+    if cursor is None:
+        return None
+    position, media_id = cursor
+    cursor_value = f"{position}|{media_id.hex}"
+    return base64.urlsafe_b64encode(cursor_value.encode("utf-8")).decode("utf-8").rstrip("=")
+
+def decode_position_cursor(b64_value):
+    cursor_value = base64.urlsafe_b64decode(b64_value + "==").decode("utf-8")
+    position, media_id = cursor_value.split("|")
+    return int(position), UUID(media_id)
+
+def get_page_args(decode=decode_cursor):
+    # cursor and page size from the query string
+    cursor = request.args.get("cursor")
+    if cursor:
+        cursor = decode(cursor)
+    else:
+        cursor = None
+    max_page_size = current_app.app_config.getint("library", "max_page_size")
+    limit = request.args.get("limit", current_app.app_config.getint("library", "page_size"), type=int)
+    return cursor, max(1, min(limit, max_page_size))
+
+async def get_json_object():
+    request_data = await request.get_json(silent=True)
+    if not isinstance(request_data, dict):
+        raise ValueError("Expected a JSON object")
+    return request_data
+
+def get_collection_name(collection_data):
+    name = collection_data.get("name")
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("Missing collection name")
+    return name.strip()
+
+def get_collection_type(type_name):
+    try:
+        return CollectionType[type_name]
+    except KeyError:
+        raise ValueError(f"Unknown collection type '{type_name}'")
+
+def get_media_uuids(member_data):
+    media_ids = member_data.get("media_ids")
+    if not isinstance(media_ids, list) or not media_ids:
+        raise ValueError("Missing media_ids")
+    if len(media_ids) > current_app.app_config.getint("library", "max_page_size"):
+        raise ValueError(f"At most {current_app.app_config.getint('library', 'max_page_size')} media per request")
+    return [UUID(str(media_id)) for media_id in media_ids]
+
+def get_anchor(member_data, key):
+    anchor = member_data.get(key)
+    return None if anchor is None else UUID(str(anchor))
+
+def serialize_members(rows):
+    return [
+        {**MEDIA_SERIALIZER.serialize(row, MEDIA_LIST_COLUMNS), "position": row.position}
+        for row in rows
+    ]
+
+def format_duration(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours == 0:
+        return f"{minutes}:{seconds:02}"
+    else:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+
+
@@ -0,0 +1,299 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import time
+
+from visiverse.library import guess_media_type
+
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+# wd, mask, cookie and name length ahead of every event
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+# debounce delays a vanished path waits for its new name while other files settle
+GONE_HOLD = 10
+
+
+class LibraryWatcher():
+
+    def __init__(self, importer, app_config):
+        self.importer = importer
+        self.media_path = app_config["library"]["media_path"]
+        watcher_config = app_config["watcher"]
+        self.backend = watcher_config["backend"]
+        self.debounce = watcher_config.getfloat("debounce")
+        self.poll_interval = watcher_config.getfloat("poll_interval")
+        self.max_pending = watcher_config.getint("max_pending")
+        self.batch_size = app_config.getint("import", "batch_size")
+        self.initial_import = watcher_config.getboolean("initial_import")
+        # path -> [last event time, last (size, mtime), is directory], one entry per path however many events
+        self.pending = {}
+        # too many changes to follow one by one, the next pass scans the whole library
+        self.rescan = False
+        self.inotify = None
+        self.tasks = []
+
+    async def start(self):
+        if self.backend in ("auto", "inotify"):
+            try:
+                self.inotify = Inotify()
+                await asyncio.get_running_loop().run_in_executor(None, self.inotify.add_tree, self.media_path)
+            except OSError as e:
+                if self.inotify is not None:
+                    self.inotify.close()
+                    self.inotify = None
+                if self.backend == "inotify":
+                    raise
+                logger.warning(f"Cannot watch '{self.media_path}' with inotify, polling instead: {e}")
+        if self.inotify is not None:
+            asyncio.get_running_loop().add_reader(self.inotify.fd, self._read_inotify)
+        else:
+            self.tasks.append(asyncio.create_task(self._poll()))
+        self.tasks.append(asyncio.create_task(self._settle()))
+        logger.info(f"Watching '{self.media_path}' ({'inotify' if self.inotify else 'polling'})")
+
+    async def close(self):
+        if self.inotify is not None:
+            asyncio.get_running_loop().remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self):
+        return {
+            "backend": "inotify" if self.inotify is not None else "polling",
+            "pending": len(self.pending),
+            "watches": len(self.inotify.paths) if self.inotify is not None else 0,
+        }
+
+    # ********** Events **********
+
+    def add_change(self, path, is_dir=False):
+        entry = self.pending.get(path)
+        if entry is None:
+            if len(self.pending) >= self.max_pending:
+                logger.warning(f"More than {self.max_pending} pending changes, rescanning the library")
+                self.pending.clear()
+                self.rescan = True
+            if self.rescan or not (is_dir or guess_media_type(path)):
+                return
+            self.pending[path] = [time.monotonic(), None, is_dir]
+        else:
+            entry[0] = time.monotonic()
+            entry[2] = entry[2] or is_dir
+
+    def _read_inotify(self):
+        try:
+            events = self.inotify.read_events()
+        except OSError as e:
+            logger.error(f"Reading inotify events failed: {e}")
+            return
+        for path, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, rescanning the library")
+                self.pending.clear()
+                self.rescan = True
+                continue
+            is_dir = bool(mask & IN_ISDIR)
+            if is_dir and mask & IN_MOVED_FROM:
+                self.inotify.remove_tree(path)
+            elif is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                # files written before the watch was added are found by scanning the directory
+                try:
+                    self.inotify.add_tree(path)
+                except OSError as e:
+                    logger.warning(f"Cannot watch '{path}': {e}")
+            if mask & IN_DELETE_SELF:
+                continue
+            self.add_change(path, is_dir)
+
+    # ********** Ingest **********
+
+    async def _settle(self):
+        interval = max(0.1, self.debounce / 2)
+        if self.initial_import:
+            await self._import_library()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self.rescan:
+                    await self._import_library()
+                    continue
+                filenames, dirnames = await self._take_settled()
+                if filenames or dirnames:
+                    await self.importer.import_paths(filenames, dirnames)
+            except Exception as e:
+                logger.error(f"Importing library changes failed: {type(e).__name__}: {e}")
+
+    async def _take_settled(self):
+        # files that stopped growing, vanished paths and directories, all quiet for the debounce delay
+        now = time.monotonic()
+        quiet = [
+            (path, last_stat, is_dir) for path, (last_event, last_stat, is_dir) in self.pending.items()
+            if now - last_event >= self.debounce
+        ]
+        waiting = len(quiet) < len(self.pending)
+        checked = await asyncio.get_running_loop().run_in_executor(None, check_paths, quiet)
+        settled, gone = [], []
+        for path, state, file_stat in checked:
+            entry = self.pending.get(path)
+            if entry is None or entry[0] > now:
+                # changed again meanwhile
+                waiting = True
+                continue
+            if state == "growing":
+                entry[1] = file_stat
+                waiting = True
+            elif state == "gone":
+                gone.append((path, entry[2], entry[0]))
+            else:
+                settled.append((path, state == "dir"))
+        # a move shows up as a vanished and a new path, imported together to keep the media,
+        # but files that never stop growing hold deletions back only for so long
+        settled += [
+            (path, is_dir) for path, is_dir, last_event in gone
+            if not waiting or settled or now - last_event >= self.debounce * GONE_HOLD
+        ]
+        filenames, dirnames = [], []
+        for path, is_dir in settled[:self.batch_size]:
+            if self.pending.pop(path, None) is not None:
+                (dirnames if is_dir else filenames).append(path)
+        return filenames, dirnames
+
+    async def _import_library(self):
+        if self.importer.running:
+            return
+        self.rescan = False
+        try:
+            await self.importer.import_library()
+        except Exception as e:
+            logger.error(f"Importing library failed: {type(e).__name__}: {e}")
+
+    async def _poll(self):
+        # without inotify, successive scans are compared and changed paths settle like events
+        loop = asyncio.get_running_loop()
+        previous = await loop.run_in_executor(None, self.importer.scan)
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            found = await loop.run_in_executor(None, self.importer.scan)
+            for path in found.keys() | previous.keys():
+                if found.get(path) != previous.get(path):
+                    self.add_change(path)
+            previous = found
+
+
+class Inotify():
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify needs Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.inotify_rm_watch = libc.inotify_rm_watch
+        self.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise_errno("inotify_init1")
+        # watch descriptor -> directory
+        self.paths = {}
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.paths.clear()
+
+    def add_tree(self, path):
+        # inotify is not recursive, every directory needs its own watch
+        for parent_dir, _, _ in os.walk(path):
+            wd = self.inotify_add_watch(self.fd, os.fsencode(parent_dir), WATCH_MASK | IN_ONLYDIR)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # removed while walking
+                    continue
+                raise_errno(f"inotify_add_watch '{parent_dir}'", error)
+            # a directory watched again under a new name keeps its descriptor
+            self.paths[wd] = parent_dir
+
+    def remove_tree(self, path):
+        prefix = os.path.join(path, "")
+        for wd, watched_path in list(self.paths.items()):
+            if watched_path == path or watched_path.startswith(prefix):
+                self.inotify_rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    def read_events(self):
+        # (path, mask) of every queued event
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + name_length].rstrip(b"\0")
+                offset += name_length
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    continue
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+                parent_dir = self.paths.get(wd)
+                if parent_dir is None:
+                    continue
+                path = os.path.join(parent_dir, os.fsdecode(name)) if name else parent_dir
+                events.append((path, mask))
+
+
+def check_paths(paths):
+    # (path, state, (size, mtime)) of each (path, last (size, mtime), is directory)
+    checked = []
+    for path, last_stat, is_dir in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            checked.append((path, "gone", None))
+            continue
+        if is_dir or os.path.isdir(path):
+            checked.append((path, "dir", None))
+            continue
+        file_stat = (stat.st_size, stat.st_mtime_ns)
+        checked.append((path, "settled" if file_stat == last_stat else "growing", file_stat))
+    return checked
+
+def raise_errno(operation, error=None):
+    error = error or ctypes.get_errno()
+    raise OSError(error, f"{operation}: {os.strerror(error)}")